@@ -0,0 +1,138 @@
+"""Runs nodes as asyncio tasks on a single event loop (Python 3 only).
+
+Shim needs a thread per node, since a connected Node blocks in its event
+loop. AsyncShim runs the same Node subclasses without threads: each node is
+a task on one event loop with its own connection to the debugger, so a
+single process can run thousands of them. Handlers are unchanged; they are
+called on the event loop between reads, so they should not block.
+
+    sh = AsyncShim()
+    for i in range(1000):
+        sh.add_node(GossipNode, 'n%d' % i)
+    sh.run()
+"""
+
+import asyncio
+import json
+import struct
+from bodies import BodyCodec
+from record import Recorder, INBOUND, OUTBOUND
+from shim import StateStore, register_message, registered_codec
+
+_header = struct.Struct('!I')
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(_header.size)
+    return await reader.readexactly(_header.unpack(header)[0])
+
+
+def write_frame(writer, payload):
+    writer.writelines([_header.pack(len(payload)), payload])
+
+
+class AsyncConnection(object):
+    """A registered connection to the debugger, as shim.Connection.
+
+    A node's handler runs between receiving an event and sending its
+    response without yielding to the event loop, so the frames a recording
+    connection writes to the log are in the order the events were handled.
+    """
+
+    def __init__(self, reader, writer, codec, recorder=None, connection=None):
+        self.reader = reader
+        self.writer = writer
+        self.codec = codec
+        self.recorder = recorder
+        self.connection = connection
+
+    def _record(self, kind, payload):
+        if self.recorder is not None:
+            self.recorder.write(kind, self.connection, payload)
+
+    async def send(self, obj):
+        payload = self.codec.encode(obj)
+        self._record(OUTBOUND, payload)
+        write_frame(self.writer, payload)
+        await self.writer.drain()
+
+    async def recv(self):
+        payload = await read_frame(self.reader)
+        self._record(INBOUND, payload)
+        return self.codec.decode(payload)
+
+    def close(self):
+        self.writer.close()
+
+
+async def register(raddr, rport, msg, codec='json', recorder=None, bodies=None):
+    (reader, writer) = await asyncio.open_connection(raddr, rport)
+    write_frame(writer, json.dumps(register_message(msg, codec, bodies)).encode('utf-8'))
+    resp = json.loads((await read_frame(reader)).decode('utf-8'))
+    codec = registered_codec(resp, bodies)
+    if recorder is None:
+        return AsyncConnection(reader, writer, codec)
+    connection = recorder.register([msg['name']], codec.name,
+                                   codec.cache if isinstance(codec, BodyCodec) else None)
+    return AsyncConnection(reader, writer, codec, recorder, connection)
+
+
+class AsyncShim(object):
+    """Runs a set of nodes against the debugger, as Shim does, but as tasks
+    on one event loop.
+
+    At most max_connecting nodes register at a time, so starting a large
+    system doesn't overflow the debugger's accept backlog. With record=path
+    the session is recorded to path, symmetry groups and their addresses are
+    declared, handlers are memoized in memo and bodies are content-addressed
+    through bodies, as with Shim.
+    """
+
+    def __init__(self, raddr='localhost', rport=4343, store_size=10000, codec='json',
+                 session=None, max_connecting=64, record=None, symmetry=(), memo=None,
+                 bodies=None, addresses=()):
+        self.raddr = raddr
+        self.rport = rport
+        self.codec = codec
+        self.record = record
+        self.memo = memo
+        self.bodies = bodies
+        self.store = StateStore(store_size)
+        self.nodes = []
+        self.max_connecting = max_connecting
+        self._session_fields = {} if session is None else {'id': session}
+        if symmetry:
+            self._session_fields['symmetry'] = [list(group) for group in symmetry]
+            self._session_fields['addresses'] = list(addresses)
+
+    def add_node(self, cls, *args, **kwargs):
+        self.nodes.append((cls, args, kwargs))
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        connecting = asyncio.Semaphore(self.max_connecting)
+        nodes = [cls(*args, connect=False, store=self.store, memo=self.memo, **kwargs)
+                 for (cls, args, kwargs) in self.nodes]
+        recorder = None if self.record is None else Recorder(self.record)
+        try:
+            await asyncio.gather(*[self._run_node(node, connecting, recorder)
+                                   for node in nodes])
+        finally:
+            if recorder is not None:
+                recorder.close()
+
+    async def _run_node(self, node, connecting, recorder):
+        async with connecting:
+            conn = await register(self.raddr, self.rport,
+                                  dict(self._session_fields, name=node._name),
+                                  self.codec, recorder, self.bodies)
+        try:
+            while True:
+                resp = node._handle(await conn.recv())
+                if resp is None:
+                    break
+                await conn.send(resp)
+        finally:
+            conn.close()
@@ -0,0 +1,374 @@
+"""Benchmarks the shims by driving the example systems as fast as they go.
+
+A StandIn plays the debugger's side of the wire protocol on a local port:
+it accepts the nodes' registrations (agreeing on a codec as the debugger
+does), starts the nodes, then delivers msg and timeout events one at a time
+in a seeded random order, keeping track of the messages in flight and the
+timeouts set as the debugger's model checker does, and finally sends quit.
+The system under test runs in a child process, so its peak RSS is measured
+on its own.
+
+    python bench.py raft mutex --nodes 5 --events 5000 --mode multiplex
+
+reports, for each system, events per second, the latency of a round trip
+in microseconds (p50, p90, p99 and max), the bytes sent and received,
+framing included, and the peak RSS of the shim process (of its largest
+process with --mode processes). --state-size pads every node's state and
+--message-size every message body with a string of that many characters;
+--bodies N has message bodies of N bytes or more sent by reference (see
+bodies.py), --json prints the results as JSON lines for comparing runs,
+and --instrument has the shim print where its time went (see
+instrument.py) to stderr.
+
+The generals system has a fixed number of nodes; --nodes sets the number
+of Raft servers and mutex nodes and the size of the statetest and
+mcheckertest rings.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sys
+import time
+import shim
+from bodies import BodyCache
+from codec import make_codec, CODECS
+from instrument import Instruments
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def raft_system(n):
+    import raft
+    cluster = ['S%d' % i for i in range(1, n + 1)]
+    nodes = [(raft.RaftClient, ('client',),
+              {'cfg': {'cluster': cluster,
+                       # Enough to keep the log growing, and compacting,
+                       # for as long as the run goes
+                       'workload': 10**9}})]
+    return nodes + [(raft.RaftServer, (node,), {'cfg': {'cluster': cluster}})
+                    for node in cluster]
+
+
+def mutex_system(n):
+    import mutex
+    return [(mutex.MutexServer, (i,), {'cfg': {'nodes': n}}) for i in range(1, n + 1)]
+
+
+def generals_system(n):
+    import generals
+    return [(generals.Client, ('Client',), {}), (generals.Server, ('Server',), {})]
+
+
+def ring_system(module_name):
+    def system(n):
+        module = __import__(module_name)
+        # The ring's nodes find their successor through N_NODES
+        module.N_NODES = n
+        return [(module.Node, ('Node%d' % i,), {}) for i in range(n)]
+    return system
+
+
+SYSTEMS = {'raft': raft_system,
+           'mutex': mutex_system,
+           'generals': generals_system,
+           'statetest': ring_system('statetest'),
+           'mcheckertest': ring_system('mcheckertest')}
+
+
+def padded(cls, state_size, message_size):
+    """A subclass of the node class cls whose state and message bodies are
+    padded with strings of state_size and message_size characters."""
+    if not state_size and not message_size:
+        return cls
+
+    class Padded(cls):
+        def start_handler(self, name, ret):
+            cls.start_handler(self, name, ret)
+            if not state_size:
+                return
+            if isinstance(ret, shim.HandlerReturn):
+                ret.set('padding', 'x' * state_size)
+            else:
+                ret.state['padding'] = 'x' * state_size
+
+        def _handler_return(self):
+            ret = cls._handler_return(self)
+            if message_size:
+                send = ret.send
+                ret.send = lambda dst, type, body: send(
+                    dst, type, dict(body, padding='x' * message_size))
+            return ret
+
+    Padded.__name__ = cls.__name__
+    return Padded
+
+
+def peak_rss():
+    """The peak RSS in kilobytes of this process or, if larger, of any of
+    its children that have exited."""
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def run_shim(system, nodes, port, options, results):
+    """Runs the system under test and puts its peak RSS on the results
+    queue; the target of the child process."""
+    sys.stdout = open(os.devnull, 'w')
+    kwargs = {'rport': port, 'codec': options.codec}
+    instruments = None
+    if options.instrument and options.mode in ('threaded', 'multiplex'):
+        instruments = kwargs['instruments'] = Instruments()
+    if options.bodies is not None:
+        kwargs['bodies'] = BodyCache(options.bodies)
+    if options.mode == 'async':
+        from aioshim import AsyncShim
+        sh = AsyncShim(**kwargs)
+    else:
+        sh = shim.Shim(multiplex=options.mode == 'multiplex',
+                       processes=options.processes if options.mode == 'processes' else 0,
+                       **kwargs)
+    for (cls, args, kw) in SYSTEMS[system](nodes):
+        sh.add_node(padded(cls, options.state_size, options.message_size), *args, **kw)
+    sh.run()
+    if instruments is not None:
+        instruments.dump()
+    results.put(peak_rss())
+
+
+def event_key(event):
+    return json.dumps([event['to'], event['type'], event['body']], sort_keys=True)
+
+
+def body_key(body):
+    return json.dumps(body, sort_keys=True)
+
+
+class StandInBodies(object):
+    """The debugger's side of content-addressed bodies (see bodies.py and
+    codec.clj), for all the connections."""
+
+    def __init__(self):
+        self.bodies = {}
+        self.fingerprints = {}
+
+    def resolve(self, frame):
+        for fp in frame.pop('released', ()):
+            del self.fingerprints[body_key(self.bodies.pop(fp))]
+        for (fp, body) in frame.pop('bodies', {}).items():
+            self.bodies[fp] = body
+            self.fingerprints[body_key(body)] = fp
+        for resp in [frame] + frame.get('responses', []):
+            for message in resp.get('send-messages', ()):
+                fp = message.pop('body-ref', None)
+                if fp is not None:
+                    message['body'] = self.bodies[fp]
+        return frame
+
+    def refer(self, frame):
+        frame = self._refer_event(frame)
+        if 'events' in frame:
+            frame = dict(frame, events=[self._refer_event(e) for e in frame['events']])
+        return frame
+
+    def _refer_event(self, event):
+        if event.get('msgtype') != 'msg':
+            return event
+        fp = self.fingerprints.get(body_key(event['body']))
+        if fp is None:
+            return event
+        event = dict(event, **{'body-ref': fp})
+        del event['body']
+        return event
+
+
+class StandInConnection(object):
+    """One node connection, counting the bytes that go over it."""
+
+    def __init__(self, sock, stats):
+        self.sock = sock
+        self.codec = make_codec('json')
+        self.bodies = None
+        self.stats = stats
+        self._reader = shim.FrameReader(sock)
+
+    def send(self, obj):
+        if self.bodies is not None:
+            obj = self.bodies.refer(obj)
+        payload = self.codec.encode(obj)
+        self.stats['bytes-sent'] += len(payload) + 4
+        shim.send_frame(self.sock, payload)
+
+    def recv(self):
+        payload = self._reader.read()
+        self.stats['bytes-received'] += len(payload) + 4
+        msg = self.codec.decode(payload)
+        if self.bodies is not None:
+            msg = self.bodies.resolve(msg)
+        return msg
+
+
+class StandIn(object):
+    """A stand-in for the debugger, enough of it to drive a system."""
+
+    def __init__(self, seed=0):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('localhost', 0))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1]
+        self.random = random.Random(seed)
+        self.stats = {'bytes-sent': 0, 'bytes-received': 0}
+        self.bodies = StandInBodies()
+        self.connections = {}
+        self.messages = []
+        self.timeouts = {}
+
+    def accept(self, n):
+        """Accept registrations until n nodes have registered."""
+        while len(self.connections) < n:
+            (sock, _) = self.listener.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = StandInConnection(sock, self.stats)
+            msg = conn.recv()
+            reply = {'ok': True}
+            codec = next((c for c in msg.get('codecs', []) if c in CODECS), 'json')
+            if codec != 'json':
+                reply['codec'] = codec
+            if msg.get('bodies'):
+                reply['bodies'] = True
+            conn.send(reply)
+            conn.codec = make_codec(codec)
+            if msg.get('bodies'):
+                conn.bodies = self.bodies
+            for name in msg.get('names', [msg.get('name')]):
+                self.connections[name] = conn
+
+    def deliver(self, event):
+        """Send event to its node and wait for the response; returns the
+        round trip time."""
+        conn = self.connections[event['to']]
+        begin = timer()
+        conn.send(event)
+        resp = conn.recv()
+        elapsed = timer() - begin
+        if event['msgtype'] == 'msg':
+            self.messages.remove(event)
+        for t in resp['cleared-timeouts']:
+            self.timeouts.pop(event_key(t), None)
+        for t in resp['set-timeouts']:
+            self.timeouts[event_key(t)] = dict(t, msgtype='timeout')
+        self.messages.extend(dict(m, msgtype='msg') for m in resp['send-messages']
+                             if m['to'] in self.connections)
+        return elapsed
+
+    def start(self):
+        self.messages = []
+        self.timeouts = {}
+        for name in sorted(self.connections, key=str):
+            self.deliver({'msgtype': 'start', 'to': name})
+
+    def run(self, events):
+        """Deliver events randomly chosen msg and timeout events, starting
+        the system over whenever nothing is left to deliver; returns the
+        latencies of the events."""
+        latencies = []
+        self.start()
+        while len(latencies) < events:
+            pending = self.messages + sorted(self.timeouts.values(), key=event_key)
+            if not pending:
+                self.start()
+                continue
+            latencies.append(self.deliver(self.random.choice(pending)))
+        return latencies
+
+    def quit(self):
+        for conn in set(self.connections.values()):
+            conn.send({'msgtype': 'quit'})
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+def benchmark(system, options):
+    nodes = len(SYSTEMS[system](options.nodes))
+    standin = StandIn(options.seed)
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=run_shim,
+                                    args=(system, options.nodes, standin.port, options,
+                                          results))
+    child.start()
+    try:
+        standin.accept(nodes)
+        begin = timer()
+        latencies = standin.run(options.events)
+        elapsed = timer() - begin
+        standin.quit()
+        rss = results.get()
+    finally:
+        child.join()
+        standin.listener.close()
+    ordered = sorted(latencies)
+    return {'system': system, 'mode': options.mode, 'codec': options.codec,
+            'bodies': options.bodies,
+            'nodes': nodes, 'events': len(latencies),
+            'events-per-sec': len(latencies) / elapsed,
+            'latency-us': dict(('p%d' % p, percentile(ordered, p) * 1e6)
+                               for p in (50, 90, 99)),
+            'max-latency-us': ordered[-1] * 1e6,
+            'bytes-sent': standin.stats['bytes-sent'],
+            'bytes-received': standin.stats['bytes-received'],
+            'peak-rss-kb': rss}
+
+
+def report(result):
+    latency = result['latency-us']
+    print('%-13s %-9s %-6s %5d nodes %9.0f ev/s  p50 %7.0fus  p90 %7.0fus  '
+          'p99 %7.0fus  max %8.0fus  sent %10d B  received %10d B  rss %7d KB'
+          % (result['system'], result['mode'], result['codec'], result['nodes'],
+             result['events-per-sec'], latency['p50'], latency['p90'], latency['p99'],
+             result['max-latency-us'], result['bytes-sent'], result['bytes-received'],
+             result['peak-rss-kb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the shims.')
+    parser.add_argument('systems', nargs='*', metavar='system',
+                        help='any of %s (default: all)' % ', '.join(sorted(SYSTEMS)))
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--state-size', type=int, default=0)
+    parser.add_argument('--message-size', type=int, default=0)
+    parser.add_argument('--mode', default='threaded',
+                        choices=['threaded', 'multiplex', 'processes', 'async'])
+    parser.add_argument('--processes', type=int, default=2)
+    parser.add_argument('--codec', default='json', choices=sorted(CODECS))
+    parser.add_argument('--bodies', type=int, metavar='N',
+                        help='send message bodies of N bytes or more by reference')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--instrument', action='store_true')
+    options = parser.parse_args(argv)
+    for system in options.systems:
+        if system not in SYSTEMS:
+            parser.error('unknown system %s' % system)
+    for system in options.systems or sorted(SYSTEMS):
+        result = benchmark(system, options)
+        if options.json:
+            print(json.dumps(result, sort_keys=True))
+        else:
+            report(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""Content-addressed message bodies.
+
+Nodes often send the same large body over and over: a Raft leader sends
+the same entries in every heartbeat and retransmission until they are
+acknowledged. Pass a BodyCache to Shim (or AsyncShim) as bodies= and each
+connection ships such a body to the debugger once, and after that, in
+both directions, only its fingerprint (see fingerprint.py).
+
+A connection asks for this by registering with "bodies": true, and uses
+it once the debugger says "bodies": true in its reply. From then on:
+
+  - In the responses a node sends, each message whose body encodes to at
+    least threshold bytes of JSON (near enough, see json_size) has
+    "body-ref", the body's fingerprint, instead of "body". The first time
+    a body is referred to on a connection, the frame also carries it under
+    "bodies", a map from fingerprints to bodies.
+  - The debugger keeps the bodies it has been sent, for all of a session's
+    connections, and delivers a message whose body it has with "body-ref"
+    in place of the body, to any connection of the session. It can deliver
+    a message any number of times, from any state it goes back to.
+  - The shim keeps the bodies it has sent up to max_bytes of them, in
+    JSON. Past that it drops the least recently used when it next gets an
+    event other than a start, and says so in the "released" list of its
+    response. The debugger drops them too, before taking in any bodies the
+    response defines, and the next message with such a body defines it
+    again. The debugger waits for the response before sending anything
+    else, so it never refers to a body the shim has dropped. Starts are
+    the exception: a session with one connection gets all of its starts
+    before any reply, which is why they release nothing.
+
+Events and responses are otherwise unchanged, so nodes and the debugger's
+model checker and UI never see references. The cache is shared by all of a
+Shim's connections, since a body one node sends is delivered to another.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from itertools import chain
+from cow import freeze, thaw
+from fingerprint import fingerprint
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+
+def json_size(value, limit):
+    """About how many bytes value takes in JSON, looking no further into it
+    than it takes to get to limit."""
+    size = 0
+    stack = [iter((value,))]
+    while stack:
+        for v in stack[-1]:
+            if isinstance(v, dict):
+                # Braces, and a ": " per item and ", " between them
+                size += 4 * len(v) or 2
+                stack.append(chain.from_iterable(v.items()))
+            elif isinstance(v, (list, tuple)):
+                size += 2 * len(v) or 2
+                stack.append(iter(v))
+            elif isinstance(v, string_types):
+                size += len(v) + 2
+            else:
+                size += len(str(v))
+            if size >= limit:
+                return size
+            if isinstance(v, (dict, list, tuple)):
+                break
+        else:
+            stack.pop()
+    return size
+
+
+class BodyCache(object):
+    """The bodies of a shim's messages the debugger has, by fingerprint,
+    up to max_bytes of them."""
+
+    def __init__(self, threshold=1024, max_bytes=64 * 2**20):
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.defined = 0
+        self.referenced = 0
+        self.released = 0
+        # (body, size) by fingerprint, least recently used first
+        self._bodies = OrderedDict()
+        self._bytes = 0
+        # The connections each body has been sent on
+        self._sent_on = {}
+        self._lock = threading.Lock()
+
+    def refer(self, body, connection):
+        """The fingerprint to send body as on connection and whether body
+        must be sent along, or None to send it as it is."""
+        if not isinstance(body, (dict, list)) or not body:
+            return None
+        # Only bodies that go by reference are fingerprinted
+        if json_size(body, self.threshold) < self.threshold:
+            return None
+        fp = fingerprint(body)
+        with self._lock:
+            connections = self._sent_on.get(fp)
+            if connections is not None and connection in connections:
+                self._touch(fp)
+                self.referenced += 1
+                return (fp, False)
+        size = len(json.dumps(body)) if connections is None else None
+        with self._lock:
+            if fp in self._bodies:
+                self._touch(fp)
+            else:
+                if size is None:
+                    # Dropped since we looked
+                    size = len(json.dumps(body))
+                self._bodies[fp] = (freeze(body), size)
+                self._bytes += size
+                self._sent_on[fp] = set()
+            self._sent_on[fp].add(connection)
+            self.defined += 1
+        return (fp, True)
+
+    def _touch(self, fp):
+        self._bodies[fp] = self._bodies.pop(fp)
+
+    def body(self, fp):
+        with self._lock:
+            entry = self._bodies.get(fp)
+            if entry is not None:
+                self._touch(fp)
+        if entry is None:
+            raise KeyError('Unknown body %s' % fp)
+        # Handlers are free to change the body they are given
+        return thaw(entry[0])
+
+    def evict(self):
+        """Drop the least recently used bodies until they fit in max_bytes;
+        returns their fingerprints."""
+        evicted = []
+        with self._lock:
+            while self._bytes > self.max_bytes and self._bodies:
+                (fp, (_, size)) = self._bodies.popitem(last=False)
+                del self._sent_on[fp]
+                self._bytes -= size
+                evicted.append(fp)
+            self.released += len(evicted)
+        return evicted
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def stats(self):
+        with self._lock:
+            return {'bodies': len(self._bodies), 'bytes': self._bytes,
+                    'defined': self.defined, 'referenced': self.referenced,
+                    'released': self.released}
+
+
+class BodyCodec(object):
+    """Wraps one connection's codec (see codec.py) to send and receive
+    message bodies through cache. A replayed connection (see record.py)
+    has a codec of its own for each direction, the second as encoder."""
+
+    def __init__(self, codec, cache, encoder=None):
+        self.codec = codec
+        self.encoder = encoder if encoder is not None else codec
+        self.cache = cache
+        self.name = codec.name
+        # Dropped from the cache, to tell the debugger in the next response
+        self._released = []
+
+    def encode(self, obj):
+        return self.encoder.encode(self._refer_frame(obj))
+
+    def decode(self, data):
+        frame = self._resolve_frame(self.codec.decode(data))
+        if isinstance(frame, dict) and frame.get('msgtype') != 'start':
+            self._released.extend(self.cache.evict())
+        return frame
+
+    def _refer_frame(self, frame):
+        if not isinstance(frame, dict):
+            return frame
+        bodies = {}
+        frame = self._refer_response(frame, bodies)
+        if 'responses' in frame:
+            frame = dict(frame, responses=[self._refer_response(r, bodies)
+                                           for r in frame['responses']])
+        if bodies:
+            frame = dict(frame, bodies=bodies)
+        if self._released:
+            frame = dict(frame, released=self._released)
+            self._released = []
+        return frame
+
+    def _refer_response(self, resp, bodies):
+        # Responses may be cached (see memo.py), so they are copied, never
+        # changed
+        if not isinstance(resp, dict) or not resp.get('send-messages'):
+            return resp
+        messages = [self._refer_message(m, bodies) for m in resp['send-messages']]
+        return dict(resp, **{'send-messages': messages})
+
+    def _refer_message(self, message, bodies):
+        ref = self.cache.refer(message.get('body'), self)
+        if ref is None:
+            return message
+        (fp, define) = ref
+        if define:
+            bodies[fp] = message['body']
+        message = dict(message, **{'body-ref': fp})
+        del message['body']
+        return message
+
+    def _resolve_frame(self, frame):
+        if not isinstance(frame, dict):
+            return frame
+        frame = self._resolve_event(frame)
+        if 'events' in frame:
+            frame['events'] = [self._resolve_event(e) for e in frame['events']]
+        return frame
+
+    def _resolve_event(self, event):
+        fp = event.pop('body-ref', None)
+        if fp is not None:
+            event['body'] = self.cache.body(fp)
+        return event
@@ -0,0 +1,220 @@
+"""Wire codecs for the connection to the debugger.
+
+Frames are JSON unless the register handshake settles on the binary codec:
+the node lists the codecs it would like to use in order under "codecs", and
+the debugger answers with the one it picked under "codec". Each side of a
+connection has its own codec object, since the binary codec remembers the
+strings it has seen.
+
+The binary codec encodes a value as a one byte tag followed by its body;
+all numbers are big-endian:
+
+  0 null, 1 false, 2 true
+  3 int32, 4 int64, 5 float64
+  6 string: uint32 length, UTF-8 bytes
+  7 new interned string: uint16 length, UTF-8 bytes
+  8 interned string: uint16 index
+  9 list: uint32 count, values
+  10 map: uint32 count, key and value for each entry
+
+Short strings (keys, message types, node names) are interned: the first
+time one is sent it is added to the end of the sender's table, and after
+that it is sent as its index in the table. The receiver keeps the same
+table by adding every new interned string it reads. Map keys are always
+sent as strings, with non-string keys converted the way JSON converts them.
+
+Node state is frozen and shared between events (see cow.py), so the same
+containers are sent over and over, e.g. log entries in every AppendEntries.
+Once all of a frozen container's strings are interned its encoding can no
+longer change, so the encoder remembers it and reuses it next time.
+"""
+
+import json
+import struct
+import weakref
+from cow import FROZEN
+
+try:
+    text_type = unicode
+    string_types = (str, unicode)
+    integer_types = (int, long)
+except NameError:
+    text_type = str
+    string_types = (str,)
+    integer_types = (int,)
+
+NULL, FALSE, TRUE, INT32, INT64, FLOAT64, STRING, DEFINE, REF, LIST, MAP = range(11)
+
+MAX_INTERNED_LENGTH = 64
+MAX_TABLE_SIZE = 65536
+
+_tag = struct.Struct('!B')
+_int32 = struct.Struct('!Bi')
+_int64 = struct.Struct('!Bq')
+_float64 = struct.Struct('!Bd')
+_long_string = struct.Struct('!BI')
+_short_string = struct.Struct('!BH')
+_u16 = struct.Struct('!H')
+_u32 = struct.Struct('!I')
+_i32 = struct.Struct('!i')
+_i64 = struct.Struct('!q')
+_f64 = struct.Struct('!d')
+_NULL = _tag.pack(NULL)
+_TRUE = _tag.pack(TRUE)
+_FALSE = _tag.pack(FALSE)
+
+
+class JsonCodec(object):
+    name = 'json'
+
+    def encode(self, obj):
+        s = json.dumps(obj)
+        if not isinstance(s, bytes):
+            s = s.encode('utf-8')
+        return s
+
+    def decode(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class BinaryCodec(object):
+    name = 'binary'
+
+    def __init__(self):
+        self._sent = {}
+        self._received = []
+        self._encoded = {}
+
+    def encode(self, obj):
+        out = []
+        self._encode(obj, out.append)
+        return b''.join(out)
+
+    def _encode_string(self, s, write):
+        i = self._sent.get(s)
+        if i is not None:
+            write(_short_string.pack(REF, i))
+            return
+        b = s.encode('utf-8') if isinstance(s, text_type) else s
+        if len(b) <= MAX_INTERNED_LENGTH and len(self._sent) < MAX_TABLE_SIZE:
+            self._sent[s] = len(self._sent)
+            write(_short_string.pack(DEFINE, len(b)))
+        else:
+            write(_long_string.pack(STRING, len(b)))
+        write(b)
+
+    def _encode(self, v, write):
+        # Hot path: locals and the common cases first
+        sent = self._sent
+        pack_ref = _short_string.pack
+        if isinstance(v, string_types):
+            i = sent.get(v)
+            if i is None:
+                self._encode_string(v, write)
+            else:
+                write(pack_ref(REF, i))
+        elif isinstance(v, FROZEN):
+            self._encode_frozen(v, write)
+        elif isinstance(v, dict):
+            write(_long_string.pack(MAP, len(v)))
+            encode = self._encode
+            for (k, child) in v.items():
+                i = sent.get(k)
+                if i is not None:
+                    write(pack_ref(REF, i))
+                else:
+                    if not isinstance(k, string_types):
+                        k = json.dumps(k)
+                    self._encode_string(k, write)
+                encode(child, write)
+        elif isinstance(v, (list, tuple)):
+            write(_long_string.pack(LIST, len(v)))
+            encode = self._encode
+            for child in v:
+                encode(child, write)
+        elif v is None:
+            write(_NULL)
+        elif v is True:
+            write(_TRUE)
+        elif v is False:
+            write(_FALSE)
+        elif isinstance(v, integer_types):
+            if -2**31 <= v < 2**31:
+                write(_int32.pack(INT32, v))
+            else:
+                write(_int64.pack(INT64, v))
+        elif isinstance(v, float):
+            write(_float64.pack(FLOAT64, v))
+        else:
+            raise TypeError('Cannot encode %r' % (v,))
+
+    def _encode_frozen(self, v, write):
+        cached = self._encoded.get(id(v))
+        if cached is not None and cached[0]() is v:
+            write(cached[1])
+            return
+        n_interned = len(self._sent)
+        out = []
+        if isinstance(v, dict):
+            self._encode(dict(v), out.append)
+        else:
+            self._encode(list(v), out.append)
+        encoded = b''.join(out)
+        if len(self._sent) == n_interned:
+            key = id(v)
+            forget = lambda ref: self._encoded.pop(key, None)
+            self._encoded[key] = (weakref.ref(v, forget), encoded)
+        write(encoded)
+
+    def decode(self, data):
+        return self._decode(bytes(data), 0)[0]
+
+    def _decode(self, data, i):
+        tag = ord(data[i:i + 1])
+        i += 1
+        if tag == REF:
+            return (self._received[_u16.unpack_from(data, i)[0]], i + 2)
+        if tag == MAP:
+            n = _u32.unpack_from(data, i)[0]
+            i += 4
+            m = {}
+            for _ in range(n):
+                (k, i) = self._decode(data, i)
+                (m[k], i) = self._decode(data, i)
+            return (m, i)
+        if tag == LIST:
+            n = _u32.unpack_from(data, i)[0]
+            i += 4
+            l = []
+            for _ in range(n):
+                (v, i) = self._decode(data, i)
+                l.append(v)
+            return (l, i)
+        if tag == DEFINE:
+            n = _u16.unpack_from(data, i)[0]
+            s = data[i + 2:i + 2 + n].decode('utf-8')
+            self._received.append(s)
+            return (s, i + 2 + n)
+        if tag == STRING:
+            n = _u32.unpack_from(data, i)[0]
+            return (data[i + 4:i + 4 + n].decode('utf-8'), i + 4 + n)
+        if tag == INT32:
+            return (_i32.unpack_from(data, i)[0], i + 4)
+        if tag == INT64:
+            return (_i64.unpack_from(data, i)[0], i + 8)
+        if tag == FLOAT64:
+            return (_f64.unpack_from(data, i)[0], i + 8)
+        if tag == NULL:
+            return (None, i)
+        if tag == TRUE:
+            return (True, i)
+        if tag == FALSE:
+            return (False, i)
+        raise ValueError('Unknown tag %d' % tag)
+
+
+CODECS = {'json': JsonCodec, 'binary': BinaryCodec}
+
+
+def make_codec(name):
+    return CODECS[name]()
@@ -0,0 +1,176 @@
+"""Structurally shared node state.
+
+Node states are stored as frozen (read-only) dicts and lists, so successive
+states can share every part a handler didn't change and nothing needs to be
+copied before a handler runs. Changing a frozen container raises TypeError.
+HandlerReturn copies only the containers on the paths a handler changes or
+looks up: a container a handler gets is thawed into a copy-on-write view of
+it (see thaw), which the handler may change in place, and is frozen again
+once the handler is done (see refreeze).
+"""
+
+
+class FrozenDict(dict):
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Node state is read-only; use ret.set to change it')
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+class FrozenList(list):
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Node state is read-only; use ret.set to change it')
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def __iadd__(self, other):
+        return self + other
+
+    def __imul__(self, n):
+        return self * n
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+FROZEN = (FrozenDict, FrozenList)
+
+
+def freeze(value):
+    """Returns a frozen version of value, reusing any frozen parts of it."""
+    if isinstance(value, FROZEN):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for (k, v) in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    if isinstance(value, tuple):
+        frozen = tuple(freeze(v) for v in value)
+        if all(a is b for (a, b) in zip(frozen, value)):
+            return value
+        return frozen
+    return value
+
+
+def get_in(state, path):
+    v = state
+    for p in path:
+        try:
+            v = v[p]
+        except:
+            return None
+    return v
+
+
+def owned_copy(value, owned):
+    """value if it is a container in owned, and otherwise a copy of it (an
+    empty dict if it isn't a container) added to owned."""
+    if id(value) in owned:
+        return value
+    if isinstance(value, list):
+        value = FrozenList(value)
+    else:
+        value = FrozenDict(value) if isinstance(value, dict) else FrozenDict()
+    owned[id(value)] = value
+    return value
+
+
+def assoc_in(state, path, value, owned):
+    """Returns state with value (already frozen) at path.
+
+    Containers along the path are copied unless they are in owned, a dict
+    from id to container of the copies made earlier by the same handler;
+    those have not been shared yet and are updated in place.
+    """
+    if not path:
+        return value
+    key = path[0]
+    try:
+        child = state[key]
+    except:
+        child = None
+    if len(path) > 1:
+        if not isinstance(child, (dict, list)):
+            child = FrozenDict()
+        child = assoc_in(child, path[1:], value, owned)
+    else:
+        child = value
+    state = owned_copy(state, owned)
+    if isinstance(state, list):
+        list.__setitem__(state, key, child)
+    else:
+        dict.__setitem__(state, key, child)
+    return state
+
+
+class CowDict(dict):
+    """A writable copy of a frozen dict whose children are copied the first
+    time they are looked up, so only the parts of the state a handler
+    actually reaches are copied. Iterating gives the frozen children."""
+
+    def __getitem__(self, key):
+        return _thaw_child(self, key, dict.__getitem__(self, key), dict.__setitem__)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+
+class CowList(list):
+    """The list counterpart of CowDict."""
+
+    def __getitem__(self, index):
+        v = list.__getitem__(self, index)
+        if isinstance(index, slice):
+            return v
+        return _thaw_child(self, index, v, list.__setitem__)
+
+
+def thaw(value):
+    if isinstance(value, dict):
+        return CowDict(value)
+    if isinstance(value, list):
+        return CowList(value)
+    return value
+
+
+def _thaw_child(container, key, v, setitem):
+    if isinstance(v, FROZEN):
+        v = thaw(v)
+        setitem(container, key, v)
+    return v
+
+
+def refreeze(state, views, owned):
+    """Returns (state, updates): state with the containers views were
+    thawed from (see thaw) replaced by the views frozen again, where they
+    differ, and updates those changes as {'path': path, 'value': value}.
+    views lists a (path, frozen, view) for each view, none inside another;
+    the containers at their paths in state must still be the frozen ones."""
+    updates = []
+    for (path, frozen, view) in views:
+        if view != frozen:
+            value = freeze(view)
+            updates.append({'path': list(path), 'value': value})
+            state = assoc_in(state, path, value, owned)
+    return (state, updates)
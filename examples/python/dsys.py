@@ -1,40 +1,13 @@
 import socket
-import json
-import struct
-from copy import deepcopy
+import shim
+from shim import send, recv
 
-class HandlerReturn(object):
+class HandlerReturn(shim.HandlerReturn):
+    """shim.HandlerReturn with this protocol's messages and timeouts."""
 
     def __init__(self, state):
-        self._messages = []
-        self._updates = []
-        self._state = deepcopy(state)
+        shim.HandlerReturn.__init__(self, None, state)
         self._timeouts = {}
-        self._cleared_timeouts = []
-
-    def get(self, path):
-        v = self._state
-        for p in path:
-            try:
-                v = v[p]
-            except:
-                return None
-        return v
-
-    def set(self, path, value):
-        self._updates.append({"path": path, "value": value})
-        if not path:
-            self._state = value
-            return
-        v = self._state
-        last_key = path[-1]
-        for p in path[:-1]:
-            try:
-                v = v[p]
-            except:
-                v[p] = {}
-                v = v[p]
-        v[last_key] = value
 
     def send(self, dst, type, body):
         self._messages.append({'dst': dst, 'type': type, 'body': body})
@@ -46,26 +19,10 @@ class HandlerReturn(object):
         self._cleared_timeouts.append(name)
 
     def finalize(self):
+        self._refreeze()
         return {'state-updates': self._updates, 'messages': self._messages,
                 'timeouts': self._timeouts, 'cleared-timeouts': self._cleared_timeouts}
 
-    def state(self):
-        return self._state
-def send(sock, obj):
-    s = json.dumps(obj)
-    length = struct.pack('!I', len(s))
-    sock.sendall(length+s)
-
-def recv(sock):
-    buf = ''
-    while len(buf) < 4:
-        buf += sock.recv(4-len(buf))
-    length = struct.unpack('!i', buf[:4])[0]
-    buf = ''
-    while len(buf) < length:
-        buf += sock.recv(length-len(buf))
-    return json.loads(buf)
-        
 class Node(object):
 
     def __init__(self, name, raddr='localhost', rport=4343):
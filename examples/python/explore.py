@@ -0,0 +1,290 @@
+"""Explores a system of nodes in-process, without the debugger.
+
+The debugger's model checker (dsmodelchecker.clj) drives the nodes over
+the network, one round trip per transition. Explorer runs the same Node
+subclasses directly instead: it builds them with connect=False and calls
+their handlers itself, following the debugger's rules for messages and
+timeouts. Node states are frozen (see cow.py), so every explored system
+state is kept as is and backtracking needs no replay.
+
+    ex = Explorer()
+    for node in ['S1', 'S2', 'S3']:
+        ex.add_node(RaftServer, node, cfg={'cluster': ['S1', 'S2', 'S3']})
+    res = ex.iterative_deepening({'type': 'node-state', 'node': 'S1',
+                                  'path': ['state'], 'value': 'Leader'}, 12)
+    if res['result'] == 'found':
+        print(res['trace'])
+
+A predicate is either a node-state predicate like the debugger's, matching
+when the value at path in the node's state equals value, or a function of
+a SystemState. Searches return {'result': 'found', 'trace': events,
+'state': state} or {'result': 'not-found'}, with the number of states
+explored under 'explored'; trace is the list of msg and timeout events to
+deliver after starting the nodes.
+
+Different interleavings of the same events often reach the same system
+state. Unless dedup is off, the explorer keeps the fingerprints (see
+fingerprint.py) of the states it has explored, and skips a state it has
+already explored at the same depth or shallower.
+
+Unless por is off, the explorer also prunes interleavings that only
+reorder independent events, using sleep sets: once the events from a
+state have been explored, those independent of the next event (see
+independent) are put to sleep in the state it leads to, and not explored
+from there, since running them first led to the same states. Events for
+different nodes are always independent; events for the same node are
+when the footprints their handlers reported (see shim.HandlerReturn)
+don't overlap.
+
+With symmetry, a list of symmetry groups of interchangeable nodes (see
+symmetry.py), the explorer dedups states by their canonical form instead,
+so of the states that only differ by swapping nodes within a group just
+one is explored. addresses lists the fields of states and message bodies
+that hold node names, which are renamed along with the nodes.
+"""
+
+from collections import namedtuple, deque, OrderedDict
+from cow import FrozenDict, freeze, get_in, thaw
+from fingerprint import fingerprint
+from symmetry import canonical, rename_event
+
+class SystemState(namedtuple('SystemState', ['states', 'messages', 'timeouts'])):
+    """A state of the whole system: each node's state by name, and the
+    messages in flight and the timeouts set, as tuples of events."""
+    __slots__ = ()
+
+
+def apply_state_change(system, event, name, effects, state):
+    """The system state after the node called name handled event, mirroring
+    apply-state-change in dsmodelchecker.clj."""
+    messages = system.messages
+    if event['msgtype'] == 'msg':
+        i = messages.index(event)
+        messages = messages[:i] + messages[i + 1:]
+    cleared = [dict(t, msgtype='timeout') for t in effects['cleared-timeouts']
+               if t['to'] == name]
+    timeouts = tuple(t for t in system.timeouts if t not in cleared)
+    timeouts += tuple(freeze(dict(t, msgtype='timeout')) for t in effects['set-timeouts']
+                      if t['to'] == name)
+    messages += tuple(freeze(dict(m, msgtype='msg')) for m in effects['send-messages']
+                      if m['from'] == name)
+    states = dict(system.states)
+    states[name] = state
+    return SystemState(FrozenDict(states), messages, timeouts)
+
+
+def action_priority(event, node):
+    """Mirrors action-priority in dsmodelchecker.clj: events for or from the
+    node in the predicate go first, and messages before timeouts."""
+    message = event['msgtype'] == 'msg'
+    if message and event['to'] == node:
+        return 0
+    if message and event.get('from') == node:
+        return 1
+    if event['to'] == node:
+        return 2
+    if message:
+        return 3
+    return 4
+
+
+def sort_actions(pred, events):
+    """Mirrors sort-actions in dsmodelchecker.clj. Its comparator treats
+    events of equal priority as out of order, so they end up reversed."""
+    node = pred.get('node') if isinstance(pred, dict) else None
+    return sorted(reversed(events), key=lambda e: action_priority(e, node))
+
+
+def system_fingerprint(system):
+    """A hashable key identifying system, regardless of the order the
+    events in flight were sent in."""
+    return (tuple(sorted((name, fingerprint(state))
+                         for (name, state) in system.states.items())),
+            tuple(sorted(fingerprint(m) for m in system.messages)),
+            tuple(sorted(fingerprint(t) for t in system.timeouts)))
+
+
+def _overlap(paths, others):
+    """Is one of paths a prefix of one of others, or the other way round?"""
+    for p in paths:
+        for q in others:
+            n = min(len(p), len(q))
+            if p[:n] == q[:n]:
+                return True
+    return False
+
+
+def _clears(step, event, other):
+    """Did the handler that did step clear event or a timeout set by the
+    handler that did other?"""
+    cleared = [(t['type'], t['body']) for t in step['cleared-timeouts']]
+    if event['msgtype'] == 'timeout' and (event['type'], event['body']) in cleared:
+        return True
+    return any((t['type'], t['body']) in cleared for t in other['set-timeouts'])
+
+
+def independent(a, step_a, b, step_b):
+    """Do events a and b commute, given what their handlers did (step_a
+    and step_b, their effects and footprints) when each was delivered in
+    the same system state?"""
+    if a['to'] != b['to']:
+        return True
+    (fa, fb) = (step_a['footprint'], step_b['footprint'])
+    if fa is None or fb is None:
+        return False
+    if _overlap(fa['writes'], fb['reads'] + fb['writes']) or _overlap(fb['writes'], fa['reads']):
+        return False
+    return not (_clears(step_a, b, step_b) or _clears(step_b, a, step_a))
+
+
+class _Expansion(object):
+    """The events asleep in an explored state, with what their handlers did
+    there, and the events explored from it so far, likewise."""
+    __slots__ = ('sleep', 'done')
+
+    def __init__(self, sleep):
+        self.sleep = sleep
+        self.done = []
+
+
+def state_matches(pred, system):
+    if callable(pred):
+        return pred(system)
+    if pred['type'] == 'node-state':
+        node_state = system.states.get(pred['node'])
+        return get_in(node_state, pred['path']) == pred['value']
+    raise ValueError('Unknown predicate type %s' % pred['type'])
+
+
+class Explorer(object):
+    """Explores the states of a set of nodes, added as for Shim.
+
+    prefix is a list of msg and timeout events to deliver after starting
+    the nodes; exploration starts from the state they lead to.
+    """
+
+    def __init__(self, prefix=(), dedup=True, por=True, symmetry=(), addresses=()):
+        self.prefix = list(prefix)
+        self.dedup = dedup
+        self.por = por
+        self.symmetry = [list(group) for group in symmetry]
+        self.addresses = frozenset(addresses)
+        self.nodes = []
+        self._nodes = None
+
+    def add_node(self, cls, *args, **kwargs):
+        self.nodes.append((cls, args, kwargs))
+        self._nodes = None
+
+    def _built_nodes(self):
+        if self._nodes is None:
+            self._nodes = OrderedDict()
+            for (cls, args, kwargs) in self.nodes:
+                node = cls(*args, connect=False, **kwargs)
+                self._nodes[node._name] = node
+        return self._nodes
+
+    def initial_state(self):
+        system = SystemState(FrozenDict(), (), ())
+        for name in self._built_nodes():
+            system = self.run_action(system, {'msgtype': 'start', 'to': name})
+        for event in self.prefix:
+            system = self.run_action(system, freeze(event))
+        return system
+
+    def actions(self, system, pred):
+        return sort_actions(pred, system.messages + system.timeouts)
+
+    def run_action(self, system, event):
+        """Deliver event (a start, msg or timeout) in system; returns the
+        new system state."""
+        return self._step(system, event)[0]
+
+    def _step(self, system, event):
+        """Deliver event in system; returns the new system state and what
+        the handler did, its effects with its footprint."""
+        name = event['to']
+        node = self._built_nodes()[name]
+        node._state = system.states.get(name, {})
+        delivered = event
+        if 'body' in event:
+            # Handlers are free to change the body they are given
+            delivered = dict(event, body=thaw(event['body']))
+        ret = node._run_handler(delivered)
+        effects = ret.effects()
+        return (apply_state_change(system, event, name, effects, node._state),
+                dict(effects, footprint=ret.footprint()))
+
+    def dfs(self, pred, max_depth):
+        """Depth-first search of the events up to max_depth deep."""
+        return self._search(pred, max_depth, max_depth, depth_first=True)
+
+    def bfs(self, pred, max_depth):
+        """Breadth-first search, which finds a shortest trace."""
+        return self._search(pred, max_depth, max_depth, depth_first=False)
+
+    def iterative_deepening(self, pred, max_depth, delta_depth=3):
+        """The model checker's search (mc/dfs): depth-first down to a depth
+        bound that grows by delta_depth whenever everything within it has
+        been explored, picking up where the last bound stopped."""
+        return self._search(pred, max_depth, delta_depth, depth_first=True)
+
+    def _search(self, pred, max_depth, delta_depth, depth_first):
+        # Each work item is a trace, the state before its last event and
+        # that state's _Expansion
+        initial = self.initial_state()
+        depth = delta_depth
+        worklist = deque(self._successors(pred, initial, (), []))
+        next_worklist = []
+        explored = 0
+        visited = {}
+        while True:
+            if not worklist:
+                if not next_worklist or depth + delta_depth > max_depth:
+                    return {'result': 'not-found', 'explored': explored}
+                depth += delta_depth
+                worklist = deque(next_worklist)
+                next_worklist = []
+                continue
+            (trace, before, expansion) = worklist.popleft()
+            event = trace[-1]
+            (system, step) = self._step(before, event)
+            explored += 1
+            if state_matches(pred, system):
+                return {'result': 'found', 'trace': list(trace), 'state': system,
+                        'explored': explored}
+            sleep = []
+            if self.por:
+                sleep = [(e, s) for (e, s) in expansion.sleep + expansion.done
+                         if independent(e, s, event, step)]
+                expansion.done.append((event, step))
+            if self.dedup:
+                # Skip the state only if it was explored with no more of
+                # its events asleep
+                (key, asleep) = self._dedup_key(system, [e for (e, _) in sleep])
+                seen = visited.get(key)
+                if seen is not None and seen[0] <= len(trace) and seen[1] <= asleep:
+                    continue
+                visited[key] = (len(trace), asleep)
+            children = self._successors(pred, system, trace, sleep)
+            if len(trace) >= depth:
+                next_worklist.extend(children)
+            elif depth_first:
+                worklist.extendleft(reversed(children))
+            else:
+                worklist.extend(children)
+
+    def _dedup_key(self, system, asleep):
+        """The key to dedup system under and the fingerprints of the
+        events asleep in it, renamed the same way as the key."""
+        if not self.symmetry:
+            return (system_fingerprint(system), frozenset(fingerprint(e) for e in asleep))
+        (key, renaming) = canonical(system, self.symmetry, system_fingerprint, self.addresses)
+        return (key, frozenset(fingerprint(rename_event(e, renaming, self.addresses))
+                               for e in asleep))
+
+    def _successors(self, pred, system, trace, sleep):
+        expansion = _Expansion(sleep)
+        asleep = [e for (e, _) in sleep]
+        return [(trace + (event,), system, expansion)
+                for event in self.actions(system, pred) if event not in asleep]
@@ -0,0 +1,65 @@
+"""Canonical fingerprints of node states.
+
+A fingerprint is a 64-bit hash of a value as the debugger sees it, that is
+of its JSON form, so equal states get equal fingerprints whichever process
+or Python version computes them and whatever order their dicts were built
+in. It is sent as 16 hex digits.
+
+Frozen containers (see cow.py) never change, so each one keeps its
+fingerprint once it has been computed. A handler's new state shares every
+container it didn't change with the old state, so fingerprinting it only
+hashes the containers on the paths the handler set.
+"""
+
+import hashlib
+import json
+import struct
+from cow import FROZEN
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+_u64 = struct.Struct('<Q')
+_u64_pair = struct.Struct('<QQ')
+_MASK = 2**64 - 1
+
+
+def _digest(data):
+    return _u64.unpack_from(hashlib.md5(data).digest())[0]
+
+
+def _key_string(k):
+    # The way JSON turns a dict key into a string
+    if isinstance(k, string_types):
+        return k
+    return json.dumps(k)
+
+
+def _fingerprint(v):
+    if isinstance(v, FROZEN):
+        fp = v.__dict__.get('_fingerprint')
+        if fp is None:
+            fp = v._fingerprint = _container_fingerprint(v)
+        return fp
+    if isinstance(v, (dict, list, tuple)):
+        return _container_fingerprint(v)
+    return _digest(b's' + json.dumps(v).encode('utf-8'))
+
+
+def _container_fingerprint(v):
+    if isinstance(v, dict):
+        # Order-independent: a sum of the entries' hashes
+        total = 0
+        for (k, child) in v.items():
+            k = _key_string(k)
+            key_fp = _digest(b's' + json.dumps(k).encode('utf-8'))
+            total += _digest(_u64_pair.pack(key_fp, _fingerprint(child)))
+        return _digest(b'd' + _u64_pair.pack(total & _MASK, len(v)))
+    return _digest(b'l' + b''.join(_u64.pack(_fingerprint(child)) for child in v))
+
+
+def fingerprint(value):
+    """The fingerprint of value, as 16 hex digits."""
+    return '%016x' % _fingerprint(value)
@@ -0,0 +1,206 @@
+"""Measures where a node's time goes, event by event.
+
+Pass an Instruments to Shim (or Node) as instruments= and every event the
+nodes handle is timed, phase by phase:
+
+  recv       blocked waiting for the frame
+  decode     decoding the frame
+  restore    restoring the system state named by the event's state id
+  copy       copying the node's state in and out of the HandlerReturn
+  handler    running the handler, also kept by event as e.g.
+             handler:msg:AppendEntries, handler:timeout:Election, handler:start
+  finalize   building the response, fingerprinting and recording the state
+  encode     encoding the response
+  send       writing the response to the socket
+
+together with bytes-received and bytes-sent, framing included. Times are
+in microseconds. Each measurement goes into a Histogram; dump prints a
+summary of them all, and dump_on_signal has it printed whenever the
+process gets SIGUSR1, so a slow run can be looked at while it runs. With
+stream=path each event's measurements are also written to path as a line
+of JSON.
+
+With profile=True every handler call is run under cProfile, with one
+profile per kind of event (the handler:... names above); write_profiles
+saves them for pstats. Profiled handlers take turns, even on different
+threads.
+
+Shim(processes=N) isn't measured, since its handlers run in other
+processes.
+"""
+
+from __future__ import print_function
+import cProfile
+import json
+import math
+import os
+import signal
+import sys
+import threading
+import time
+
+clock = getattr(time, 'perf_counter', time.time)
+
+SUBBUCKETS = 8
+
+
+def event_name(msg):
+    """The name events like msg are measured under."""
+    if msg['msgtype'] in ('msg', 'timeout'):
+        return '%s:%s' % (msg['msgtype'], msg['type'])
+    return msg['msgtype']
+
+
+def timed(timings, name, fn, *args):
+    """Call fn with args, adding the time it takes to timings under name;
+    timings is None when not measuring."""
+    if timings is None:
+        return fn(*args)
+    start = clock()
+    try:
+        return fn(*args)
+    finally:
+        add(timings, name, clock() - start)
+
+
+def add(timings, name, seconds):
+    timings[name] = timings.get(name, 0) + seconds
+
+
+class Histogram(object):
+    """Counts of samples in logarithmic buckets, SUBBUCKETS of them for
+    each power of two, so percentiles are estimated to within 1/16 of
+    their value or so at the cost of a few arithmetic operations per
+    sample."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        (mantissa, exponent) = math.frexp(value)
+        if value > 0:
+            bucket = exponent * SUBBUCKETS + int((mantissa - 0.5) * 2 * SUBBUCKETS)
+        else:
+            bucket = None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, p):
+        """An upper bound for the p'th percentile of the samples."""
+        needed = self.count * p / 100.0
+        seen = self.buckets.get(None, 0)
+        if seen >= needed:
+            return 0
+        for bucket in sorted(b for b in self.buckets if b is not None):
+            seen += self.buckets[bucket]
+            if seen >= needed:
+                (exponent, sub) = divmod(bucket, SUBBUCKETS)
+                upper = math.ldexp(0.5 + (sub + 1) / (2.0 * SUBBUCKETS), exponent)
+                return min(upper, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / float(self.count) if self.count else 0,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99), 'max': self.max}
+
+
+class Instruments(object):
+    """Histograms of the measurements of every event, by name.
+
+    Measurements are collected in a dict per event on the thread handling
+    it (begin and current), and go into the histograms all at once when
+    the event is done (end).
+    """
+
+    def __init__(self, stream=None, profile=False):
+        self.histograms = {}
+        self.profiles = {}
+        self.profile = profile
+        # Reentrant, for dumps from a signal handler
+        self._lock = threading.RLock()
+        self._profile_lock = threading.Lock()
+        self._local = threading.local()
+        self._stream = open(stream, 'a') if stream is not None else None
+
+    def begin(self):
+        """Start measuring a new event on this thread; returns the dict to
+        add its measurements to."""
+        timings = self._local.timings = {}
+        return timings
+
+    def current(self):
+        """The measurements of the event being handled on this thread, or
+        None if it isn't being measured."""
+        return getattr(self._local, 'timings', None)
+
+    def end(self, timings, name):
+        """Add the measurements of the event called name to the histograms."""
+        self._local.timings = None
+        sample = {}
+        for (key, value) in timings.items():
+            if not key.startswith('bytes-'):
+                value *= 1e6
+            sample[key] = value
+        with self._lock:
+            for (key, value) in sample.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.add(value)
+            if self._stream is not None:
+                sample['event'] = name
+                self._stream.write(json.dumps(sample, sort_keys=True) + '\n')
+
+    def call_handler(self, name, fn, *args):
+        """Call the handler fn with args, for an event called name, under
+        its profile if profiling; returns the time it took."""
+        if not self.profile:
+            start = clock()
+            fn(*args)
+            return clock() - start
+        with self._profile_lock:
+            profile = self.profiles.get(name)
+            if profile is None:
+                profile = self.profiles[name] = cProfile.Profile()
+            start = clock()
+            profile.runcall(fn, *args)
+            return clock() - start
+
+    def summary(self):
+        """The summary of each histogram, by name."""
+        with self._lock:
+            return dict((key, histogram.summary())
+                        for (key, histogram) in self.histograms.items())
+
+    def dump(self, out=None):
+        """Print a table of the histograms' summaries to out (stderr by
+        default)."""
+        out = sys.stderr if out is None else out
+        print('%-40s %9s %10s %10s %10s %10s %10s'
+              % ('', 'count', 'mean', 'p50', 'p90', 'p99', 'max'), file=out)
+        for (key, s) in sorted(self.summary().items()):
+            print('%-40s %9d %10.1f %10.1f %10.1f %10.1f %10.1f'
+                  % (key, s['count'], s['mean'], s['p50'], s['p90'], s['p99'], s['max']),
+                  file=out)
+        if self._stream is not None:
+            with self._lock:
+                self._stream.flush()
+
+    def dump_on_signal(self, signum=signal.SIGUSR1, out=None):
+        """Dump whenever the process gets signum. Only call this from the
+        main thread."""
+        signal.signal(signum, lambda *_: self.dump(out))
+
+    def write_profiles(self, directory):
+        """Save each handler profile to directory as <name>.prof."""
+        with self._profile_lock:
+            for (name, profile) in self.profiles.items():
+                profile.dump_stats(os.path.join(directory, name.replace(':', '-') + '.prof'))
@@ -0,0 +1,92 @@
+"""Memoizes node handlers.
+
+A handler's response and the node's new state are functions of the node's
+state and the event it handles, as long as the handler is deterministic,
+as the example handlers are. The debugger delivers the same events in the
+same states over and over, restarting the system and replaying traces as
+its model checker backtracks. Pass a HandlerCache to Shim (or Node) as
+memo= and each node looks an event up in it before running its handler:
+on a hit the cached response is sent and the cached state becomes the
+node's state without the handler running.
+
+Entries are keyed by the node's name and the fingerprints (see
+fingerprint.py) of its state and of the event, so two states or events are
+taken to be the same if their fingerprints are. Nodes whose handlers look
+at anything besides their state, the event and their configuration, such
+as the time or a random number generator, mustn't be memoized.
+
+The cache keeps its entries within max_bytes, as measured by the JSON
+encoding of the cached responses, evicting the least recently used. The
+cached states aren't counted, since they share nearly all of their
+structure with the states the nodes and the StateStore hold anyway.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from fingerprint import fingerprint
+
+# Roughly what an entry costs besides its response
+ENTRY_OVERHEAD = 200
+
+
+class HandlerCache(object):
+    """Handler responses and the states they lead to, least recently used
+    first. Shared by all of a Shim's nodes, on whatever threads they run."""
+
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, name, state, msg):
+        """The key of the event msg delivered to the node called name in
+        state."""
+        event = [msg['msgtype'], msg.get('from'), msg.get('type'), msg.get('body')]
+        return (name, fingerprint(state), fingerprint(event))
+
+    def get(self, key):
+        """The cached (response, state) for key, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[:2]
+
+    def put(self, key, resp, state):
+        """Cache resp, the response for key, and state, the state it led to."""
+        size = len(json.dumps(resp, default=repr)) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (resp, state, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                (_, (_, _, evicted)) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def __getstate__(self):
+        # Each of Shim(processes=N)'s workers gets a cache of its own
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
@@ -1,129 +1,93 @@
-import socket
-import json
-import struct
-from copy import deepcopy
-
-class HandlerReturn(object):
-
-    def __init__(self, name, state):
-        self._name = name
-        self._messages = []
-        self._updates = []
-        self._state = deepcopy(state)
-        self._timeouts = []
-        self._cleared_timeouts = []
-
-    def get(self, path):
-        v = self._state
-        for p in path:
-            try:
-                v = v[p]
-            except:
-                return None
-        return v
-
-    def set(self, path, value):
-        self._updates.append({"path": path, "value": value})
-        if not path:
-            self._state = value
-            return
-        v = self._state
-        last_key = path[-1]
-        for p in path[:-1]:
-            try:
-                v = v[p]
-            except:
-                v[p] = {}
-                v = v[p]
-        v[last_key] = value
-
-    def send(self, dst, type, body):
-        self._messages.append({'from': self._name, 'to': dst, 'type': type, 'body': body})
-            
-    def set_timeout(self, type, body, seconds=5):
-        self._timeouts.append({'to': self._name, 'type': type, 'body': body})
-
-    def clear_timeout(self, type, body):
-        self._cleared_timeouts.append({'to': self._name, 'type': type, 'body': body})
-
-    def finalize(self):
-        return {'state-updates': self._updates, 'send-messages': self._messages,
-                'set-timeouts': self._timeouts, 'cleared-timeouts': self._cleared_timeouts}
-
-    def state(self):
-        return self._state
-    
-def send(sock, obj):
-    s = json.dumps(obj)
-    print s
-    length = struct.pack('!I', len(s))
-    sock.sendall(length+s)
-
-def recv(sock):
-    buf = ''
-    while len(buf) < 4:
-        buf += sock.recv(4-len(buf))
-    length = struct.unpack('!i', buf[:4])[0]
-    buf = ''
-    while len(buf) < length:
-        buf += sock.recv(length-len(buf))
-    return json.loads(buf)
-        
-class Node(object):
-
-    def __init__(self, name, raddr='localhost', rport=4343):
-        self._name = name
-        self._state = {}
-        self._register(raddr, rport)
-        self._event_loop()
-        
-    
-    def start_handler(self, name, ret):
-        pass
+"""Lamport's mutual exclusion algorithm.
+
+The nodes are named 1 to N, N being nodes in their cfg (3 by default).
+Node 1 starts out holding the lock.
+
+Each node keeps the requests it knows of in a heap, queue, of [clock, node,
+epoch] entries. A release isn't removed from the heap but makes the
+entries of its node stale: released counts each node's releases, and an
+entry is only live while its epoch is its node's count. Stale entries are
+skipped once they come to the top; pending counts each node's live
+entries, and live all of them. Likewise clocks is a heap of [clock, node]
+entries for the latest clock heard from each peer (max), live while it
+still is the latest, so whether every peer has sent something later than
+a request is a look at its top. Either heap is rebuilt from its live
+entries once more than half of it is stale.
+
+    python mutex.py --nodes 5
+"""
+
+import argparse
+from shim import Node, Shim
+
+
+def _live_top(ret, path, live):
+    """The smallest live entry of the heap at path, popping the stale ones
+    above it; None if there is none."""
+    heap = ret.get(path)
+    while heap and not live(heap[0]):
+        heap = _heap_pop(ret, path, heap)
+    return heap[0] if heap else None
+
+
+def _heap_push(ret, path, entry):
+    heap = list(ret.get(path))
+    heap.append(entry)
+    i = len(heap) - 1
+    while i > 0 and heap[(i - 1) // 2] > entry:
+        heap[i] = heap[(i - 1) // 2]
+        i = (i - 1) // 2
+    heap[i] = entry
+    ret.append(path, heap[-1])
+    j = len(heap) - 1
+    while j > i:
+        j = (j - 1) // 2
+        ret.set(path + [j], heap[j])
+
+
+def _heap_pop(ret, path, heap):
+    """Remove the smallest entry of heap, the heap at path; returns the
+    new heap."""
+    heap = list(heap)
+    last = heap.pop()
+    ret.truncate_extend(path, len(heap), [])
+    if not heap:
+        return heap
+    i = 0
+    while True:
+        child = 2 * i + 1
+        if child >= len(heap):
+            break
+        if child + 1 < len(heap) and heap[child + 1] < heap[child]:
+            child += 1
+        if heap[child] >= last:
+            break
+        heap[i] = heap[child]
+        ret.set(path + [i], heap[i])
+        i = child
+    heap[i] = last
+    ret.set(path + [i], last)
+    return heap
 
-    def message_handler(self, to, sender, type, body, ret):
-        pass
-
-    def timeout_handler(self, name, timeout, ret):
-        pass
-
-    def _register(self, raddr, rport):
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock.connect((raddr, rport))
-        send(self._sock, {'msgtype': 'register', 'name': self._name})
-        resp = recv(self._sock)
-        if not resp.get('ok'):
-            raise Exception('Oh no')
-        print "Registered"
-
-    def _respond(self, ret):
-        self._state = ret.state()
-        send(self._sock, ret.finalize())
-
-    def _event_loop(self):
-        while True:
-            msg = recv(self._sock)
-            ret = HandlerReturn(self._name, self._state)
-            if msg['msgtype'] == 'msg':
-                self.message_handler(self._name, msg['from'], msg['type'], msg['body'], ret)
-            elif msg['msgtype'] == 'timeout':
-                self.timeout_handler(self._name, msg['type'], msg['body'], ret)
-            elif msg['msgtype'] == 'start':
-                self._state = {}
-                self.start_handler(self._name, ret)
-            elif msg['msgtype'] == 'quit':
-                break
-            self._state = ret.state()
-            send(self._sock, ret.finalize())
 
 class MutexServer(Node):
-    
+
+    read_only_state = True
+
+    def nodes(self):
+        return range(1, self.config().get('nodes', 3) + 1)
+
     def start_handler(self, name, ret):
         ret.set([''], {})
-        ret.set(['queue'], [(0, 1)])
-        for i in range(1, 4):
+        ret.set(['queue'], [[0, 1, 0]])
+        ret.set(['released'], {})
+        ret.set(['pending'], {1: 1})
+        ret.set(['live'], 1)
+        ret.set(['clocks'], [])
+        for i in self.nodes():
             if i != name:
                 ret.set(['max', i], 1)
+                _heap_push(ret, ['clocks'], [1, i])
         ret.set(['clock'], 1)
         if name == 1:
             ret.set(['lock'], True)
@@ -132,62 +96,82 @@ class MutexServer(Node):
             ret.set(['lock'], False)
             ret.set_timeout('request', {}, 5)
 
-    def try_get_lock(self, name, ret):
+    def _live_request(self, ret):
+        released = ret.get(['released'])
+        return lambda e: e[2] == released.get(e[1], 0)
+
+    def _live_clock(self, ret):
+        latest = ret.get(['max'])
+        return lambda e: latest.get(e[1]) == e[0]
+
+    def request(self, node, clock, ret):
+        """Queue a request by node at clock."""
+        _heap_push(ret, ['queue'], [clock, node, ret.get(['released']).get(node, 0)])
+        ret.set(['pending', node], ret.get(['pending']).get(node, 0) + 1)
+        live = ret.set(['live'], ret.get(['live']) + 1)
         queue = ret.get(['queue'])
-        try:
-            min_request = min(queue)
-        except ValueError:
+        if len(queue) > 2 * live:
+            is_live = self._live_request(ret)
+            ret.set(['queue'], sorted(e for e in queue if is_live(e)))
+
+    def release(self, node, ret):
+        """Drop the requests queued by node."""
+        ret.set(['released', node], ret.get(['released']).get(node, 0) + 1)
+        ret.set(['live'], ret.get(['live']) - ret.get(['pending']).get(node, 0))
+        ret.set(['pending', node], 0)
+
+    def heard(self, node, clock, ret):
+        """Note that node has sent a message at clock."""
+        ret.set(['max', node], clock)
+        _heap_push(ret, ['clocks'], [clock, node])
+        if len(ret.get(['clocks'])) > 2 * (len(self.nodes()) - 1):
+            ret.set(['clocks'], sorted([c, i] for (i, c) in ret.get(['max']).items()))
+
+    def try_get_lock(self, name, ret):
+        min_request = _live_top(ret, ['queue'], self._live_request(ret))
+        if min_request is None or min_request[1] != name:
             return
-        if min_request[1] != name:
+        # Every peer must have sent something since: later than the
+        # request, or at the same time if it loses ties to us
+        min_clock = _live_top(ret, ['clocks'], self._live_clock(ret))
+        if min_clock is not None and min_clock[:2] < min_request[:2]:
             return
-        for i in range(1, 4):
-            if name == i:
-                continue
-            if i < name and ret.get(['max', i]) <= min_request[0]:
-                return
-            if i > name and ret.get(['max', i]) < min_request[0]:
-                return
         # We have the lock
         ret.set(['lock'], True)
         ret.clear_timeout('request', {})
         ret.set_timeout('release', {}, 5)
-            
+
     def message_handler(self, to, sender, type, body, ret):
-        ret.set(['max', sender], body['clock'])
+        self.heard(sender, body['clock'], ret)
         ret.set(['clock'], body['clock'] + 1)
         if type == 'req':
-            ret.set(['queue'], ret.get(['queue']) + [(body['clock'], sender)])
+            self.request(sender, body['clock'], ret)
             ret.send(sender, 'ack', {'clock': ret.get(['clock'])})
         if type == 'rel':
-            queue = ret.get(['queue'])
-            ret.set(['queue'], [r for r in queue if r[1] != sender])
+            self.release(sender, ret)
         self.try_get_lock(to, ret)
 
     def timeout_handler(self, name, type, body, ret):
         ret.set(['clock'], ret.get(['clock']) +  1)
         if type == 'request':
-            ret.set(['queue'], ret.get(['queue']) + [(ret.get(['clock']), name)])
-            for i in range(1, 4):
+            self.request(name, ret.get(['clock']), ret)
+            for i in self.nodes():
                 if i != name:
                     ret.send(i, 'req', {'clock': ret.get(['clock'])})
         if type == 'release':
-            queue = ret.get(['queue'])
             ret.set(['lock'], False)
-            ret.set(['queue'], [r for r in queue if r[1] != name])
-            for i in range(1, 4):
+            self.release(name, ret)
+            for i in self.nodes():
                 if i != name:
                     ret.send(i, 'rel', {'clock': ret.get(['clock'])})
             ret.clear_timeout('release', {})
             ret.set_timeout('request', {}, 5)
 
 if __name__ == '__main__':
-    import threading
-    one = threading.Thread(target=MutexServer, args=[1])
-    two = threading.Thread(target=MutexServer, args=[2])
-    three = threading.Thread(target=MutexServer, args=[3])
-    one.start()
-    two.start()
-    three.start()
-    one.join()
-    two.join()
-    three.join()
+    parser = argparse.ArgumentParser(description="Run Lamport's mutex in the debugger.")
+    parser.add_argument('--nodes', type=int, default=3)
+    options = parser.parse_args()
+    sh = Shim()
+    for i in range(1, options.nodes + 1):
+        sh.add_node(MutexServer, i, cfg={'nodes': options.nodes})
+    sh.run()
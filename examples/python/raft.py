@@ -8,10 +8,37 @@ described in Ongaro's thesis.
 import threading
 from shim import Node, Shim
 
+# The most log entries sent in one AppendEntries, unless the server's cfg
+# sets max_entries
+MAX_ENTRIES = 64
+
+# How many committed entries pile up in the log before they are compacted
+# into a snapshot, unless the server's cfg sets snapshot_entries
+SNAPSHOT_ENTRIES = 1000
+
+# How often a leader sends heartbeats, well within the election timeout
+# (set_timeout's default of 5 seconds), when timeouts take time
+HEARTBEAT_SECONDS = 1
+
+# The fields of states and message bodies that hold node names, to rename
+# when servers are declared interchangeable (see symmetry.py)
+ADDRESSES = ['cluster', 'match_index', 'next_index', 'node', 'sender', 'voted_for', 'votes']
+
 class RaftClient(Node):
+    """Sends the commands in its cfg's cmds to the cluster, one at a time.
+
+    With workload=N in its cfg it also keeps generating commands, sending
+    the next as soon as the last has been applied, until N of them have
+    been, which makes for runs as long as needed.
+    """
+
+    read_only_state = True
+
     def start_handler(self, name, ret):
-        for cmd in self.config()['cmds']:
+        for cmd in self.config().get('cmds', []):
             ret.set_timeout('Command', cmd)
+        if self.config().get('workload'):
+            ret.set_timeout('Command', {'type': 'Command', 'body': {'command': 0}})
         ret.set_timeout('Retransmit', {})
         ret.set('n', 0)
         ret.set('inflight', None)
@@ -25,6 +52,8 @@ class RaftClient(Node):
             ret.set('inflight', None)
             if body['cluster'] != ret.get('cluster'):
                 ret.set('cluster', body['cluster'])
+            if n+1 < self.config().get('workload', 0):
+                self.send_command({'type': 'Command', 'body': {'command': n+1}}, ret)
 
     def send_to_cluster(self, type, body, ret):
         for node in ret.get('cluster'):
@@ -38,14 +67,37 @@ class RaftClient(Node):
         elif type == 'Command':
             inflight = ret.get('inflight')
             if not inflight:
-                body['body']['n'] = ret.get('n')
-                self.send_to_cluster(body['type'], body['body'], ret)
-                ret.set('inflight', body)
+                self.send_command(body, ret)
+
+    def send_command(self, cmd, ret):
+        cmd['body']['n'] = ret.get('n')
+        self.send_to_cluster(cmd['type'], cmd['body'], ret)
+        ret.set('inflight', cmd)
 
 class RaftServer(Node):
+    """A Raft server.
+
+    Besides the log, the state keeps config_index, the indices of the
+    reconfig entries in the log in order, so the current configuration and
+    whether one is being committed are known without scanning the log.
+    append_entry and replace_entries keep it up to date; the log mustn't
+    be changed any other way.
+
+    Once snapshot_entries (cfg, SNAPSHOT_ENTRIES by default) committed
+    entries have piled up in the log, they are compacted away into the
+    snapshot: the index and term of the last of them, and the configuration
+    as of it. Indices are always those of the whole log, so the entry at
+    index i is log[i - (snapshot index + 1)]. A follower missing entries the
+    leader has compacted away is sent its snapshot in an InstallSnapshot.
+    """
+
+    read_only_state = True
+
     def start_handler(self, name, ret):
         ret.set('state', 'Follower')
         ret.set('log', [])
+        ret.set('config_index', [])
+        ret.set('snapshot', {'index': -1, 'term': -1, 'cluster': None})
         ret.set('commit_index', -1)
         ret.set('term', -1)
         ret.set('match_index', {})
@@ -58,45 +110,145 @@ class RaftServer(Node):
     def send(self, to, type, body, ret):
         body['term'] = ret.get('term')
         ret.send(to, type, body)
-        
+
     def broadcast(self, name, type, body, ret):
         for s in self.cluster(ret):
             if s != name:
                 self.send(s, type, body, ret)
 
+    def log_start(self, ret):
+        """The index of the first entry in the log."""
+        return ret.get(['snapshot', 'index']) + 1
+
+    def entry(self, index, ret):
+        return ret.get('log')[index - self.log_start(ret)]
+
+    def term_at(self, index, ret):
+        """The term of the entry at index, or None if it has been compacted
+        away."""
+        snapshot = ret.get('snapshot')
+        if index == snapshot['index']:
+            return snapshot['term']
+        if index < snapshot['index']:
+            return None
+        return self.entry(index, ret)['term']
+
     def max_index(self, ret):
         log = ret.get('log')
-        return len(log) - 1
+        return self.log_start(ret) + len(log) - 1
 
     def max_term(self, ret):
         log = ret.get('log')
         if log:
             return log[-1]['term']
-        return -1
+        return ret.get(['snapshot', 'term'])
 
     def cluster(self, ret):
-        log = ret.get('log')
-        for entry in reversed(log):
-            if entry['type'] == 'reconfig':
-                return entry['cluster']
+        config_index = ret.get('config_index')
+        if config_index:
+            return self.entry(config_index[-1], ret)['cluster']
+        cluster = ret.get(['snapshot', 'cluster'])
+        if cluster is not None:
+            return cluster
         return self.config()['cluster']
-    
+
+    def append_entry(self, entry, ret):
+        """Add entry to the end of the log."""
+        if entry['type'] == 'reconfig':
+            ret.append('config_index', self.max_index(ret) + 1)
+        ret.append('log', entry)
+
+    def replace_entries(self, start, entries, ret):
+        """Put entries into the log from index start on. Entries already
+        there with the same term are kept, along with any after them; from
+        the first one that differs on, the log is replaced by the rest of
+        entries. Returns the new log."""
+        log = ret.get('log')
+        log_start = self.log_start(ret)
+        if start < log_start:
+            # Those are committed, so we have them in the snapshot
+            (start, entries) = (log_start, entries[log_start - start:])
+        skip = 0
+        while (skip < len(entries) and start + skip - log_start < len(log) and
+               log[start + skip - log_start]['term'] == entries[skip]['term']):
+            skip += 1
+        if skip == len(entries):
+            return log
+        (start, entries) = (start + skip, entries[skip:])
+        config_index = ret.get('config_index')
+        kept = len(config_index)
+        while kept and config_index[kept - 1] >= start:
+            kept -= 1
+        added = [start + i for (i, entry) in enumerate(entries) if entry['type'] == 'reconfig']
+        if kept < len(config_index) or added:
+            ret.truncate_extend('config_index', kept, added)
+        return ret.truncate_extend('log', start - log_start, entries)
+
+    def max_entries(self):
+        return self.config().get('max_entries', MAX_ENTRIES)
+
+    def snapshot_entries(self):
+        return self.config().get('snapshot_entries', SNAPSHOT_ENTRIES)
+
+    def commit(self, commit_index, ret):
+        """Apply the entries up to commit_index and mark them committed,
+        compacting the log if enough committed entries have piled up."""
+        old_commit_index = ret.get('commit_index')
+        if commit_index <= old_commit_index:
+            return
+        for i in range(old_commit_index+1, commit_index+1):
+            self.apply_entry(self.entry(i, ret), ret)
+        ret.set('commit_index', commit_index)
+        if commit_index - self.log_start(ret) + 1 >= self.snapshot_entries():
+            self.compact(commit_index, ret)
+
+    def compact(self, index, ret):
+        """Replace the entries up to index, which must be committed, by a
+        snapshot."""
+        log_start = self.log_start(ret)
+        config_index = ret.get('config_index')
+        kept = 0
+        while kept < len(config_index) and config_index[kept] <= index:
+            kept += 1
+        cluster = ret.get(['snapshot', 'cluster'])
+        if kept:
+            cluster = self.entry(config_index[kept - 1], ret)['cluster']
+            ret.set('config_index', config_index[kept:])
+        ret.set('snapshot', {'index': index, 'term': self.term_at(index, ret),
+                             'cluster': cluster})
+        ret.set('log', ret.get('log')[index - log_start + 1:])
+
+    def quorum_index(self, ret):
+        """The highest index that a majority of the cluster has in its log,
+        by match_index."""
+        cluster = self.cluster(ret)
+        if not cluster:
+            return -1
+        match_index = ret.get('match_index')
+        matched = sorted((match_index.get(node, -1) for node in cluster), reverse=True)
+        return matched[len(cluster) // 2]
+
     def replicate_log(self, name, ret, nodes=None):
         if not nodes:
             nodes = [node for node in self.cluster(ret) if node != name]
+        max_entries = self.max_entries()
+        log_start = self.log_start(ret)
         for node in nodes:
-            next_index = ret.get('next_index').get(node, self.max_index(ret))
+            next_index = ret.get('next_index').get(node, max(self.max_index(ret), log_start))
+            if next_index < log_start:
+                self.send(node, 'InstallSnapshot', {'snapshot': ret.get('snapshot')}, ret)
+                continue
             log = ret.get('log')
-            entries = log[next_index:]
+            entries = log[next_index - log_start:next_index - log_start + max_entries]
             prev_index = next_index-1
-            prev_term = log[prev_index]['term'] if prev_index >= 0 else -1
+            prev_term = self.term_at(prev_index, ret)
             self.send(node, 'AppendEntries',
                       {'entries': entries,
                        'prev_index': prev_index,
                        'prev_term': prev_term,
                        'commit_index': ret.get('commit_index')}, ret)
-            
-            
+
+
 
     def timeout_handler(self, name, type, body, ret):
         term = ret.get('term')
@@ -119,10 +271,8 @@ class RaftServer(Node):
             if term != self.max_term(ret):
                 # We're leader and haven't yet committed an entry in our term
                 # Let's commit a dummy entry
-                log = ret.get('log')
                 entry = {'term': term, 'type': 'dummy'}
-                log.append(entry)
-                ret.set('log', log)
+                self.append_entry(entry, ret)
             self.replicate_log(name, ret)
 
     def apply_entry(self, entry, ret):
@@ -135,15 +285,26 @@ class RaftServer(Node):
 
 
     def currently_reconfiguring(self, ret):
-        commit_index = ret.get('commit_index')
-        log = ret.get('log')
-        max = -1
-        for (i, entry) in enumerate(log):
-            if entry['type'] == 'reconfig':
-                max = i
-        if max > commit_index:
-            return True
-        
+        config_index = ret.get('config_index')
+        return bool(config_index) and config_index[-1] > ret.get('commit_index')
+
+    def step_down(self, term, ret):
+        """Follow a leader or candidate with a higher term."""
+        ret.set('voted_for', None)
+        ret.set('state', 'Follower')
+        ret.clear_timeout('Heartbeat', {})
+        ret.clear_timeout('Election', {})
+        ret.set_timeout('Election', {})
+        return ret.set('term', term)
+
+    def heard_from_leader(self, ret):
+        """Start the election timeout over, if it runs in time. In the
+        debugger a timeout fires when it is delivered, and starting it over
+        would change nothing."""
+        if self.timed():
+            ret.clear_timeout('Election', {})
+            ret.set_timeout('Election', {})
+
     def message_handler(self, to, sender, type, body, ret):
         term = ret.get('term')
         state = ret.get('state')
@@ -151,12 +312,7 @@ class RaftServer(Node):
             max_term = self.max_term(ret)
             max_index = self.max_index(ret)
             if body['term'] > term:
-                ret.set('voted_for', None)
-                ret.set('state', 'Follower')
-                ret.clear_timeout('Heartbeat', {})
-                ret.clear_timeout('Election', {})
-                ret.set_timeout('Election', {})
-                term = ret.set('term', body['term'])
+                term = self.step_down(body['term'], ret)
             if (term <= body['term'] and
                 (max_term < body['max_term'] or
                  (max_term == body['max_term'] and max_index <= body['max_index'])) and
@@ -165,60 +321,77 @@ class RaftServer(Node):
                 self.send(sender, 'Vote', {}, ret)
         elif type == 'Vote':
             if state == 'Candidate' and body['term'] == term:
+                if sender not in ret.get('votes'):
+                    ret.append('votes', sender)
                 votes = ret.get('votes')
-                if sender not in votes:
-                    votes.append(sender)
-                    ret.set('votes', votes)
                 cluster = self.cluster(ret)
                 if len(votes) > len(cluster) / 2:
                     ret.set('state', 'Leader')
                     ret.clear_timeout('Election', {})
-                    ret.set_timeout('Heartbeat', {})
+                    ret.set_timeout('Heartbeat', {}, HEARTBEAT_SECONDS)
                     ret.set('match_index', {to: self.max_index(ret)})
                     ret.set('next_index', {})
         elif type == 'AppendEntries':
             if body['term'] < term:
                 return
             if body['term'] > term:
-                ret.set('voted_for', None)
-                ret.set('state', 'Follower')
-                ret.clear_timeout('Heartbeat', {})
-                ret.clear_timeout('Election', {})
-                ret.set_timeout('Election', {})
-                term = ret.set('term', body['term'])
-            log = ret.get('log')
+                term = self.step_down(body['term'], ret)
+            elif state == 'Follower':
+                self.heard_from_leader(ret)
+            # Entries compacted away are committed, so they match
             if (body['prev_index'] <= self.max_index(ret) and
-                (body['prev_index'] == -1 or
-                 body['prev_term'] == log[body['prev_index']]['term'])):
-                log = log[:body['prev_index']+1]
-                log = log + body['entries']
-                ret.set('log', log)
-                commit_index = ret.get('commit_index')
-                if body['commit_index'] > commit_index:
-                    for i in range(commit_index+1, body['commit_index']+1):
-                        self.apply_entry(log[i], ret)
-                    ret.set('commit_index', body['commit_index'])
+                self.term_at(body['prev_index'], ret) in (None, body['prev_term'])):
+                self.replace_entries(body['prev_index']+1, body['entries'], ret)
+                # What is known to match the leader's log, which may not be
+                # all it has committed
+                last_new_index = body['prev_index'] + len(body['entries'])
+                self.commit(min(body['commit_index'], last_new_index), ret)
                 self.send(sender, 'AppendEntriesReply',
                           {'ok': True,
-                           'max_index': self.max_index(ret)},
+                           'max_index': last_new_index},
                           ret)
                 return
             else:
                 self.send(sender, 'AppendEntriesReply',
                           {'ok': False,
-                           'next_index': body['prev_index']}, ret)
+                           'next_index': min(body['prev_index'], self.max_index(ret) + 1)},
+                          ret)
+        elif type == 'InstallSnapshot':
+            if body['term'] < term:
+                return
+            if body['term'] > term:
+                term = self.step_down(body['term'], ret)
+            elif state == 'Follower':
+                self.heard_from_leader(ret)
+            snapshot = body['snapshot']
+            if snapshot['index'] > ret.get('commit_index'):
+                if (snapshot['index'] <= self.max_index(ret) and
+                    self.term_at(snapshot['index'], ret) == snapshot['term']):
+                    # Our log has it, so keep the entries after it
+                    self.commit(snapshot['index'], ret)
+                    if self.log_start(ret) <= snapshot['index']:
+                        self.compact(snapshot['index'], ret)
+                else:
+                    ret.set('snapshot', snapshot)
+                    ret.set('log', [])
+                    ret.set('config_index', [])
+                    ret.set('commit_index', snapshot['index'])
+            self.send(sender, 'AppendEntriesReply',
+                      {'ok': True,
+                       'max_index': snapshot['index']},
+                      ret)
         elif type == 'AppendEntriesReply':
             if body['term'] != term:
                 return
             if body['ok']:
                 ret.set(['match_index', sender], body['max_index'])
-                match_index = ret.get('match_index')
-                match_index[to] = self.max_index(ret)
-                log = ret.get('log')
-                for i in range(ret.get('commit_index')+1, body['max_index']+1):
-                    if sum(match_index.get(node, -1) >= i for node in self.cluster(ret)) > len(self.cluster(ret)) / 2:
-                        self.apply_entry(log[i], ret)
-                        ret.set('commit_index', i)
+                ret.set(['match_index', to], self.max_index(ret))
+                # A batch may not have reached the end of the log
+                ret.set(['next_index', sender], body['max_index'] + 1)
+                self.commit(min(self.quorum_index(ret), body['max_index']), ret)
+                if self.max_index(ret) - body['max_index'] >= self.max_entries():
+                    # A whole batch behind, so don't wait for the heartbeat
+                    self.replicate_log(to, ret, nodes=[sender])
             else:
                 ret.set(['next_index', sender], body['next_index'])
                 self.replicate_log(to, ret, nodes=[sender])
@@ -231,10 +404,9 @@ class RaftServer(Node):
             cluster = self.cluster(ret)
             if body['node'] in cluster:
                 return
-            cluster.append(body['node'])
-            log = ret.get('log')
-            log.append({'term': term, 'type': 'reconfig', 'cluster': cluster, 'sender': sender, 'n': body['n']})
-            ret.set('log', log)
+            cluster = cluster + [body['node']]
+            entry = {'term': term, 'type': 'reconfig', 'cluster': cluster, 'sender': sender, 'n': body['n']}
+            self.append_entry(entry, ret)
             self.replicate_log(to, ret)
 
         elif type == 'RemoveNode':
@@ -246,20 +418,18 @@ class RaftServer(Node):
             if body['node'] not in cluster:
                 return
             cluster = [node for node in cluster if node != body['node']]
-            log = ret.get('log')
-            log.append({'term': term, 'type': 'reconfig', 'cluster': cluster, 'sender': sender, 'n': body['n']})
-            ret.set('log', log)
+            entry = {'term': term, 'type': 'reconfig', 'cluster': cluster, 'sender': sender, 'n': body['n']}
+            self.append_entry(entry, ret)
             self.replicate_log(to, ret)
 
         elif type == 'Command':
             if state != 'Leader':
                 return
-            log = ret.get('log')
-            log.append({'term': term, 'type': 'command', 'command': body['command'], 'sender': sender, 'n': body['n']})
-            ret.set('log', log)
+            entry = {'term': term, 'type': 'command', 'command': body['command'], 'sender': sender, 'n': body['n']}
+            self.append_entry(entry, ret)
             self.replicate_log(to, ret)
-            
-                          
+
+
 if __name__ == '__main__':
     sh = Shim()
     cfg1 = ['S1', 'S2', 'S3', 'S4']
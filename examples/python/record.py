@@ -0,0 +1,123 @@
+"""Session logs: the frames exchanged with the debugger, recorded to disk.
+
+A Shim (or AsyncShim) made with record=path appends every frame its nodes
+receive and every response they send to the log at path, and Shim.replay
+feeds a recorded session back into the handlers without the debugger,
+checking that each response is the same, byte for byte, as the one that
+was recorded. A replay runs as fast as the handlers do, so a recorded
+session doubles as a regression and performance test.
+
+A log is a sequence of records, each a header followed by a payload:
+
+  uint8 kind, uint16 connection, uint32 payload length (big-endian)
+
+where kind is REGISTER, for a connection that has just registered (the
+payload is the JSON object {"names": [...], "codec": name}, with "bodies":
+{"threshold": n, "max-bytes": m} if it uses content-addressed bodies, see
+bodies.py), INBOUND, for
+a frame received on the connection, or OUTBOUND, for a frame sent on it.
+Payloads are frames as they were on the wire, in the connection's codec.
+Alongside the log at path, path.idx holds the offset in the log of each
+record as a big-endian uint64, so the records can be counted and read in
+any order. Records are only ever appended to both files, and each record is
+flushed as soon as it is written, so a log survives its shim being killed.
+"""
+
+import json
+import struct
+import threading
+from collections import namedtuple
+
+REGISTER = 0
+INBOUND = 1
+OUTBOUND = 2
+
+_header = struct.Struct('!BHI')
+_offset = struct.Struct('!Q')
+
+
+class Record(namedtuple('Record', ['kind', 'connection', 'payload'])):
+    """One record of a session log."""
+    __slots__ = ()
+
+
+class Recorder(object):
+    """Writes a new session log at path, replacing any log there.
+
+    It is shared by all the connections of a shim, which may record from
+    several threads. lock is held while writing a record; connections
+    serving events from several threads also hold it while handling an
+    event, so the log has events in the order they were handled.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self._log = open(path, 'wb')
+        self._index = open(path + '.idx', 'wb')
+        self._connections = 0
+
+    def register(self, names, codec, bodies=None):
+        """Record a new connection for the nodes names, speaking codec, with
+        content-addressed bodies through bodies, a bodies.BodyCache, if
+        given; returns its connection id."""
+        with self.lock:
+            connection = self._connections
+            self._connections += 1
+            registered = {'names': names, 'codec': codec}
+            if bodies is not None:
+                registered['bodies'] = {'threshold': bodies.threshold,
+                                        'max-bytes': bodies.max_bytes}
+            payload = json.dumps(registered).encode('utf-8')
+            self.write(REGISTER, connection, payload)
+            return connection
+
+    def write(self, kind, connection, payload):
+        with self.lock:
+            # The index entry goes last, so it never points at a record
+            # that wasn't written in full
+            offset = self._log.tell()
+            self._log.write(_header.pack(kind, connection, len(payload)))
+            self._log.write(payload)
+            self._log.flush()
+            self._index.write(_offset.pack(offset))
+            self._index.flush()
+
+    def close(self):
+        with self.lock:
+            self._log.close()
+            self._index.close()
+
+
+class SessionLog(object):
+    """A recorded session log, for reading.
+
+    Iterating gives its Records in order; log[i] is the i'th record, read
+    with the help of the index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.idx', 'rb') as f:
+            index = f.read()
+        self._offsets = [_offset.unpack_from(index, i)[0]
+                         for i in range(0, len(index) - _offset.size + 1, _offset.size)]
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        with open(self.path, 'rb') as f:
+            f.seek(self._offsets[i])
+            return self._read(f)
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            for _ in range(len(self)):
+                yield self._read(f)
+
+    def _read(self, f):
+        (kind, connection, length) = _header.unpack(f.read(_header.size))
+        payload = f.read(length)
+        if len(payload) < length:
+            raise EOFError('Truncated record in %s' % self.path)
+        return Record(kind, connection, payload)
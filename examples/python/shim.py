@@ -1,95 +1,508 @@
+from __future__ import print_function
 import threading
+import multiprocessing
 import socket
 import json
 import struct
+from collections import OrderedDict, deque
 from copy import deepcopy
+from bodies import BodyCache, BodyCodec
+from codec import make_codec
+from cow import FROZEN, freeze, get_in, assoc_in, owned_copy, refreeze, thaw
+from fingerprint import fingerprint
+from record import Recorder, SessionLog, REGISTER, INBOUND, OUTBOUND
+from instrument import add, clock, event_name, timed
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
 
 class HandlerReturn(object):
+    """Collects a handler's effects.
+
+    The node's state is shared, not copied: set copies only the containers
+    along the path it changes. A container get returns is a copy-on-write
+    view of it, which the handler may change in place as well; changes to
+    it are sent as updates once the handler is done. Changing a container
+    through ret (with set or the operations below) ends the views of it got
+    before, so get it again to go on changing it in place. With read_only,
+    get returns the shared, read-only values themselves instead (see
+    Node.read_only_state).
+
+    Besides set, which replaces the value at a path, append, truncate_extend,
+    merge and delete change part of a list or dict; they are sent to the
+    debugger as operations (see apply-state-update), so their size depends
+    on the change rather than on the list or dict.
 
-    def __init__(self, name, state):
+    The paths the handler looks up and changes are its footprint, which is
+    sent with its response; a handler's effects depend on nothing in the
+    node's state outside the paths it read, so explorers can tell when two
+    events commute (see explore.py).
+    """
+
+    def __init__(self, name, state, read_only=False):
         self._name = name
         self._messages = []
         self._updates = []
-        self._state = deepcopy(state)
+        self._state = state
+        self._read_only = read_only
+        self._owned = {}
+        self._views = OrderedDict()
+        # The first keys of the views' paths
+        self._views_under = set()
         self._timeouts = []
+        self._timeout_seconds = []
         self._cleared_timeouts = []
+        self._reads = OrderedDict()
+        self._writes = OrderedDict()
 
     def path_of(self, p):
-        if isinstance(p, basestring):
+        if isinstance(p, string_types):
             return [p]
         return p
 
     def get(self, path):
         path = self.path_of(path)
-        v = self._state
-        for p in path:
-            try:
-                v = v[p]
-            except:
-                return None
-        return v
-
+        key = tuple(path)
+        self._reads[key] = True
+        if self._read_only:
+            return get_in(self._state, path)
+        if self._views and (key[:1] in self._views_under or () in self._views_under):
+            for i in range(len(key), -1, -1):
+                # Under a container handed out already, so the same as in it
+                view = self._views.get(key[:i])
+                if view is not None:
+                    return get_in(view[1], path[i:])
+        value = get_in(self._state, path)
+        if not isinstance(value, FROZEN):
+            return value
+        view = thaw(value)
+        for (inner, (_, inner_view)) in list(self._views.items()) if self._views else ():
+            if len(inner) > len(key) and inner[:len(key)] == key:
+                # Handed out before this container; it is part of it now
+                get_in(view, inner[len(path):-1])[inner[-1]] = inner_view
+                del self._views[inner]
+        self._views[key] = (value, view)
+        self._views_under.add(key[:1])
+        return view
     
     def set(self, path, value):
         path = self.path_of(path)
+        self._flush(path)
+        self._writes[tuple(path)] = True
+        value = freeze(value)
         self._updates.append({"path": path, "value": value})
-        if not path:
-            self._state = value
-            return value
-        v = self._state
-        last_key = path[-1]
-        for p in path[:-1]:
-            try:
-                v = v[p]
-            except:
-                v[p] = {}
-                v = v[p]
-        v[last_key] = value
+        self._state = assoc_in(self._state, path, value, self._owned)
+        return value
+
+    def append(self, path, value):
+        """Append value to the list at path."""
+        path = self.path_of(path)
+        self._flush(path)
+        value = freeze(value)
+        lst = self._owned_list(path)
+        list.append(lst, value)
+        self._update(path, {'op': 'append', 'values': [value]}, lst)
         return value
 
+    def truncate_extend(self, path, length, values):
+        """Cut the list at path down to its first length elements, then add
+        values to the end of it."""
+        path = self.path_of(path)
+        self._flush(path)
+        values = [freeze(v) for v in values]
+        lst = self._owned_list(path)
+        list.__delitem__(lst, slice(length, None))
+        list.extend(lst, values)
+        self._update(path, {'op': 'truncate-extend', 'index': length, 'values': values}, lst)
+        return lst
+
+    def merge(self, path, value):
+        """Add the entries of the dict value to the dict at path."""
+        path = self.path_of(path)
+        self._flush(path)
+        value = freeze(value)
+        dct = owned_copy(get_in(self._state, path), self._owned)
+        dict.update(dct, value)
+        self._update(path, {'op': 'merge', 'value': value}, dct)
+        return dct
+
+    def delete(self, path):
+        """Remove the key at path from its dict."""
+        path = self.path_of(path)
+        self._flush(path)
+        # Even deleting a missing key doesn't commute with adding it
+        self._writes[tuple(path)] = True
+        parent = get_in(self._state, path[:-1])
+        if not isinstance(parent, dict) or path[-1] not in parent:
+            return
+        parent = owned_copy(parent, self._owned)
+        dict.__delitem__(parent, path[-1])
+        self._update(path, {'op': 'delete'}, None, parent)
+
+    def _owned_list(self, path):
+        lst = get_in(self._state, path)
+        if not isinstance(lst, list):
+            lst = []
+        return owned_copy(lst, self._owned)
+
+    def _update(self, path, update, value, parent=None):
+        """Record a structural update at path, whose new value (or new
+        parent, for a delete) has already been built."""
+        update['path'] = path
+        self._updates.append(update)
+        self._writes[tuple(path)] = True
+        if parent is None:
+            self._state = assoc_in(self._state, path, value, self._owned)
+        else:
+            self._state = assoc_in(self._state, path[:-1], parent, self._owned)
+
     def send(self, dst, type, body):
         self._messages.append({'from': self._name, 'to': dst, 'type': type, 'body': body})
             
     def set_timeout(self, type, body, seconds=5):
         self._timeouts.append({'to': self._name, 'type': type, 'body': body})
+        self._timeout_seconds.append(seconds)
 
     def clear_timeout(self, type, body):
         self._cleared_timeouts.append({'to': self._name, 'type': type, 'body': body})
 
+    def timeout_seconds(self):
+        """How long each of the timeouts set was set for, in order. The
+        debugger ignores it; simulate.py doesn't."""
+        return self._timeout_seconds
+
+    def _flush(self, path):
+        """Freeze the containers handed out that overlap path before it
+        changes through ret, so their changes come first."""
+        n = len(path)
+        if any(list(p[:n]) == list(path[:len(p)]) for p in self._views):
+            self._refreeze()
+
+    def _refreeze(self):
+        """Freeze the containers get handed out, and record the changes the
+        handler made to them."""
+        if not self._views:
+            return
+        views = [(path, frozen, view) for (path, (frozen, view)) in self._views.items()]
+        self._views = OrderedDict()
+        self._views_under = set()
+        (self._state, updates) = refreeze(self._state, views, self._owned)
+        for update in updates:
+            self._updates.append(update)
+            self._writes[tuple(update['path'])] = True
+
+    def footprint(self):
+        """The paths read and written so far."""
+        self._refreeze()
+        return {'reads': [list(p) for p in self._reads],
+                'writes': [list(p) for p in self._writes]}
+
+    def effects(self):
+        """The messages sent and the timeouts set and cleared."""
+        return {'send-messages': self._messages, 'set-timeouts': self._timeouts,
+                'cleared-timeouts': self._cleared_timeouts}
+
     def finalize(self):
-        return {'state-updates': self._updates, 'send-messages': self._messages,
-                'set-timeouts': self._timeouts, 'cleared-timeouts': self._cleared_timeouts}
+        self._refreeze()
+        resp = self.effects()
+        resp['state-updates'] = self._updates
+        return resp
 
     def state(self):
+        self._refreeze()
         return self._state
     
+def send_frame(sock, payload):
+    header = struct.pack('!I', len(payload))
+    if not hasattr(sock, 'sendmsg'):
+        # No vectored writes before Python 3.3; copying the header in front
+        # still keeps it to one write.
+        sock.sendall(header + payload)
+        return
+    sent = sock.sendmsg([header, payload])
+    if sent < len(header):
+        sock.sendall(header[sent:])
+        sock.sendall(payload)
+    elif sent < len(header) + len(payload):
+        sock.sendall(memoryview(payload)[sent - len(header):])
+
 def send(sock, obj):
     s = json.dumps(obj)
     #print s
-    length = struct.pack('!I', len(s))
-    sock.sendall(length+s)
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    send_frame(sock, s)
+
+def recv_exactly(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while n:
+        got = sock.recv_into(view[len(buf) - n:], n)
+        if not got:
+            raise EOFError('Connection closed')
+        n -= got
+    return buf
 
 def recv(sock):
-    buf = ''
-    while len(buf) < 4:
-        buf += sock.recv(4-len(buf))
-    length = struct.unpack('!i', buf[:4])[0]
-    buf = ''
-    while len(buf) < length:
-        buf += sock.recv(length-len(buf))
-    return json.loads(buf)
+    length = struct.unpack('!I', bytes(recv_exactly(sock, 4)))[0]
+    return json.loads(bytes(recv_exactly(sock, length)).decode('utf-8'))
+
+class FrameReader(object):
+    """Reads frames from a socket through one reusable buffer.
+
+    Each read asks the socket for as much as fits in the buffer, so frames
+    that arrive together are parsed out of a single recv_into and the
+    payload of a frame is copied once, when it is handed out.
+    """
+    def __init__(self, sock, size=65536):
+        self._sock = sock
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def _fill(self, needed):
+        """Read until the buffer holds at least needed unread bytes."""
+        while self._end - self._start < needed:
+            if self._start + needed > len(self._buf):
+                unread = self._buf[self._start:self._end]
+                if needed > len(self._buf):
+                    self._buf = bytearray(max(needed, 2 * len(self._buf)))
+                self._buf[:len(unread)] = unread
+                self._start = 0
+                self._end = len(unread)
+            got = self._sock.recv_into(memoryview(self._buf)[self._end:])
+            if not got:
+                raise EOFError('Connection closed')
+            self._end += got
+
+    def read(self):
+        """The payload of the next frame."""
+        self._fill(4)
+        length = struct.unpack_from('!I', self._buf, self._start)[0]
+        self._fill(4 + length)
+        begin = self._start + 4
+        self._start = begin + length
+        if self._start == self._end:
+            self._start = self._end = 0
+        return bytes(self._buf[begin:begin + length])
+
+class Connection(object):
+    """A registered connection to the debugger, speaking the codec agreed on
+    when registering (see codec.py). Frames are recorded with recorder, if
+    given, as those of the connection numbered connection (see record.py)."""
+    def __init__(self, sock, codec, recorder=None, connection=None):
+        self.sock = sock
+        self.codec = codec
+        self.recorder = recorder
+        self.connection = connection
+        self._reader = FrameReader(sock)
+        self._lock = recorder.lock if recorder is not None else threading.Lock()
+
+    def _record(self, kind, payload):
+        if self.recorder is not None:
+            self.recorder.write(kind, self.connection, payload)
+
+    def send(self, obj):
+        payload = self.codec.encode(obj)
+        self._record(OUTBOUND, payload)
+        send_frame(self.sock, payload)
+
+    def recv(self):
+        payload = self._reader.read()
+        self._record(INBOUND, payload)
+        return self.codec.decode(payload)
+
+    def serve(self, handle, instruments=None):
+        """Send back handle's response to each event received, until it
+        returns None, measuring each event with instruments if given (see
+        instrument.py).
+
+        Connections recording to the same log take turns handling events,
+        so that the log has them in the order they were handled.
+        """
+        if instruments is not None:
+            return self._serve_measured(handle, instruments)
+        while True:
+            payload = self._reader.read()
+            with self._lock:
+                self._record(INBOUND, payload)
+                resp = handle(self.codec.decode(payload))
+                if resp is None:
+                    break
+                payload = self.codec.encode(resp)
+                self._record(OUTBOUND, payload)
+            send_frame(self.sock, payload)
+
+    def _serve_measured(self, handle, instruments):
+        while True:
+            timings = instruments.begin()
+            start = clock()
+            payload = self._reader.read()
+            received = clock()
+            with self._lock:
+                self._record(INBOUND, payload)
+                decode_start = clock()
+                msg = self.codec.decode(payload)
+                decoded = clock()
+                resp = handle(msg)
+                if resp is None:
+                    break
+                handled = clock()
+                out = self.codec.encode(resp)
+                encoded = clock()
+                self._record(OUTBOUND, out)
+            send_start = clock()
+            send_frame(self.sock, out)
+            sent = clock()
+            timings['recv'] = received - start
+            timings['decode'] = decoded - decode_start
+            timings['encode'] = encoded - handled
+            timings['send'] = sent - send_start
+            timings['bytes-received'] = len(payload) + 4
+            timings['bytes-sent'] = len(out) + 4
+            instruments.end(timings, event_name(msg))
+
+def register_message(msg, codec='json', bodies=None):
+    """The register message for msg, asking for codec, and for
+    content-addressed bodies if bodies, a bodies.BodyCache, is given. It
+    also tells the debugger that batch messages are understood."""
+    if codec != 'json':
+        msg = dict(msg, codecs=[codec, 'json'])
+    if bodies is not None:
+        msg = dict(msg, bodies=True)
+    return dict(msg, msgtype='register', batch=True)
+
+def registered_codec(resp, bodies=None):
+    """The codec to use after the debugger's reply resp to registering."""
+    if not resp.get('ok'):
+        raise Exception('Oh no')
+    print("Registered")
+    codec = make_codec(resp.get('codec', 'json'))
+    if bodies is not None and resp.get('bodies'):
+        codec = BodyCodec(codec, bodies)
+    return codec
+
+def register(raddr, rport, msg, codec='json', recorder=None, bodies=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.connect((raddr, rport))
+    send(sock, register_message(msg, codec, bodies))
+    codec = registered_codec(recv(sock), bodies)
+    if recorder is None:
+        return Connection(sock, codec)
+    connection = recorder.register(msg.get('names', [msg.get('name')]), codec.name,
+                                   codec.cache if isinstance(codec, BodyCodec) else None)
+    return Connection(sock, codec, recorder, connection)
+
+class StateStore(object):
+    """Bounded store of whole-system snapshots, keyed by state id.
+
+    Every handled event records the new state of its node under a fresh
+    state id, which is sent back to the debugger with the response. Events
+    (and explicit restore requests) that carry an older state id first put
+    every node back into the snapshot recorded under it, so the debugger can
+    jump to any recent state without restarting and replaying the system.
+    Node states are never mutated once recorded, so snapshots share them.
+    A snapshot is just the state an event changed, on top of the snapshot
+    it was recorded in, except that every so many (as many as there are
+    nodes) hold every node's state; recording takes the same time however
+    many nodes there are, and restoring looks back through at most that
+    many snapshots. The least recently used snapshots are evicted once
+    there are more than size of them.
+    """
+    def __init__(self, size=10000):
+        self._size = size
+        self._nodes = {}
+        # (previous snapshot, node name, state, snapshots since a whole
+        # one), or (None, None, states by node name, 0) for a whole one
+        self._current = (None, None, {}, 0)
+        self._snapshots = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.current = None
+
+    def add(self, node):
+        self._nodes[node._name] = node
+
+    def record(self, name, state):
+        with self._lock:
+            depth = self._current[3] + 1
+            if depth >= len(self._nodes):
+                states = self._states(self._current)
+                states[name] = state
+                snapshot = (None, None, states, 0)
+            else:
+                snapshot = (self._current, name, state, depth)
+            state_id = self._next_id
+            self._next_id += 1
+            self._current = snapshot
+            self._snapshots[state_id] = snapshot
+            if len(self._snapshots) > self._size:
+                self._snapshots.popitem(last=False)
+            self.current = state_id
+            return state_id
+
+    def _states(self, snapshot):
+        """The state of every node in snapshot, by name."""
+        states = {}
+        while snapshot[0] is not None:
+            (snapshot, name, state, _) = snapshot
+            states.setdefault(name, state)
+        for (name, state) in snapshot[2].items():
+            states.setdefault(name, state)
+        return states
+
+    def restore(self, state_id):
+        with self._lock:
+            if state_id == self.current:
+                return True
+            snapshot = self._snapshots.pop(state_id, None)
+            if snapshot is None:
+                return False
+            self._snapshots[state_id] = snapshot
+            states = self._states(snapshot)
+            for (name, node) in self._nodes.items():
+                node._state = states.get(name, {})
+            self._current = snapshot
+            self.current = state_id
+            return True
         
 class Node(object):
 
-    def __init__(self, name, raddr='localhost', rport=4343, cfg={}):
+    # Set on node classes whose handlers never change what ret.get returns
+    # in place, so get hands out the read-only state itself rather than
+    # copies of the containers in it, which saves copying them
+    read_only_state = False
+
+    def __init__(self, name, raddr='localhost', rport=4343, cfg={}, connect=True,
+                 store=None, codec='json', session={}, recorder=None, instruments=None,
+                 memo=None, bodies=None, timed=False):
         self._name = name
         self._state = {}
         self._cfg = cfg
-        self._register(raddr, rport)
-        self._event_loop()
+        self._store = store
+        self._codec = codec
+        self._session = session
+        self._recorder = recorder
+        self._instruments = instruments
+        self._memo = memo
+        self._bodies = bodies
+        self._timed = timed
+        if store is not None:
+            store.add(self)
+        if connect:
+            self._register(raddr, rport)
+            self._event_loop()
 
     def config(self):
         return deepcopy(self._cfg)
+
+    def timed(self):
+        """Whether timeouts fire after the seconds they are set for, as in
+        simulate.py, rather than when the debugger delivers them."""
+        return self._timed
         
     
     def start_handler(self, name, ret):
@@ -102,48 +515,420 @@ class Node(object):
         pass
 
     def _register(self, raddr, rport):
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self._sock.connect((raddr, rport))
-        send(self._sock, {'msgtype': 'register', 'name': self._name})
-        resp = recv(self._sock)
-        if not resp.get('ok'):
-            raise Exception('Oh no')
-        print "Registered"
+        self._conn = register(raddr, rport, dict(self._session, name=self._name), self._codec,
+                              self._recorder, self._bodies)
 
     def _respond(self, ret):
         self._state = ret.state()
-        send(self._sock, ret.finalize())
+        self._conn.send(ret.finalize())
+
+    def _handler_return(self):
+        return HandlerReturn(self._name, self._state, self.read_only_state)
+
+    def _returned_state(self, ret):
+        return ret.state()
+
+    def _handle(self, msg):
+        """Run the handler for one event; returns the response, or None on quit.
+
+        A batch message carries a list of events under "events"; they are
+        handled in order and the response has theirs under "responses".
+        """
+        if msg['msgtype'] == 'quit':
+            print("Got quit")
+            return None
+        if msg['msgtype'] == 'batch':
+            return {'responses': [self._handle(event) for event in msg['events']]}
+        if msg['msgtype'] == 'restore':
+            return {'ok': self._store is not None and self._store.restore(msg['state-id'])}
+        timings = None if self._instruments is None else self._instruments.current()
+        state_id = msg.get('state-id')
+        if self._store is not None and state_id is not None:
+            if not timed(timings, 'restore', self._store.restore, state_id):
+                return {'ok': False, 'error': 'Unknown state id %s' % state_id}
+        if msg['msgtype'] == 'msg':
+            print("Got message")
+        elif msg['msgtype'] == 'timeout':
+            print("Got timeout")
+        elif msg['msgtype'] == 'start':
+            print("Got start")
+        if self._memo is not None:
+            return self._handle_memoized(msg, timings)
+        return timed(timings, 'finalize', self._finalize, self._run_handler(msg))
+
+    def _handle_memoized(self, msg, timings):
+        """Handle msg, a start, msg or timeout event, through the memo
+        cache (see memo.py)."""
+        state = {} if msg['msgtype'] == 'start' else self._state
+        key = self._memo.key(self._name, state, msg)
+        hit = self._memo.get(key)
+        if hit is None:
+            resp = timed(timings, 'finalize', self._finalize, self._run_handler(msg))
+            cached = dict(resp)
+            cached.pop('state-id', None)
+            self._memo.put(key, cached, self._state)
+            return resp
+        (resp, self._state) = hit
+        resp = dict(resp)
+        if self._store is not None:
+            resp['state-id'] = self._store.record(self._name, self._state)
+        return resp
+
+    def _finalize(self, ret):
+        """The response to the event handled with ret."""
+        resp = ret.finalize()
+        footprint = ret.footprint()
+        if footprint is not None:
+            resp['footprint'] = footprint
+        resp['fingerprint'] = fingerprint(self._state)
+        if self._store is not None:
+            resp['state-id'] = self._store.record(self._name, self._state)
+        return resp
+
+    def _run_handler(self, msg):
+        """Run the handler for a start, msg or timeout event against the
+        node's current state and move it to the new state; returns the
+        HandlerReturn."""
+        if msg['msgtype'] == 'start':
+            self._state = {}
+        timings = None if self._instruments is None else self._instruments.current()
+        if timings is None:
+            ret = self._handler_return()
+            self._call_handler(msg, ret)
+            self._state = self._returned_state(ret)
+            return ret
+        start = clock()
+        ret = self._handler_return()
+        copied = clock() - start
+        name = event_name(msg)
+        handler = self._instruments.call_handler(name, self._call_handler, msg, ret)
+        start = clock()
+        self._state = self._returned_state(ret)
+        add(timings, 'copy', copied + clock() - start)
+        add(timings, 'handler', handler)
+        add(timings, 'handler:' + name, handler)
+        return ret
+
+    def _call_handler(self, msg, ret):
+        if msg['msgtype'] == 'msg':
+            self.message_handler(self._name, msg['from'], msg['type'], msg['body'], ret)
+        elif msg['msgtype'] == 'timeout':
+            self.timeout_handler(self._name, msg['type'], msg['body'], ret)
+        elif msg['msgtype'] == 'start':
+            self.start_handler(self._name, ret)
 
     def _event_loop(self):
-        while True:
-            msg = recv(self._sock)
-            ret = HandlerReturn(self._name, self._state)
-            if msg['msgtype'] == 'msg':
-                print "Got message"
-                self.message_handler(self._name, msg['from'], msg['type'], msg['body'], ret)
-            elif msg['msgtype'] == 'timeout':
-                print "Got timeout"
-                self.timeout_handler(self._name, msg['type'], msg['body'], ret)
-            elif msg['msgtype'] == 'start':
-                print "Got start"
-                self._state = {}
-                self.start_handler(self._name, ret)
-            elif msg['msgtype'] == 'quit':
-                print "Got quit"
-                break
-            self._state = ret.state()
-            send(self._sock, ret.finalize())
+        self._conn.serve(self._handle, self._instruments)
 
 class Shim(object):
-    def __init__(self):
-        self.threads = []
+    """Runs a set of nodes against the debugger.
+
+    By default every node gets its own thread and its own connection. With
+    multiplex=True all nodes are registered over a single connection and
+    driven from one event loop on the calling thread, dispatching each event
+    on its "to" field; use this for systems with many nodes.
+
+    The nodes share a StateStore holding the last store_size system states,
+    so the debugger can restore any of them by state id.
+
+    codec='binary' asks the debugger for the compact binary wire codec
+    instead of JSON; connections fall back to JSON if it is refused.
+
+    With processes=N the nodes are spread over N worker processes, so
+    handlers for different nodes run in parallel. The calling process keeps
+    the single connection (as with multiplex=True) and routes each event to
+    the worker running its node, without waiting for the replies to earlier
+    events; replies are sent back in the order the events arrived.
+
+    The nodes register in the debugger session named session (the
+    debugger's default session if None). With replicas=K, K more copies of
+    the whole system are run, each in its own process and registered in its
+    own session as a replica of session; the debugger's model checker then
+    splits its search across all the copies.
+
+    With record=path, the frames exchanged with the debugger are recorded
+    to a session log at path (see record.py), and replicas record to
+    path.1, path.2 and so on. replay(path) runs a recorded session again,
+    offline, against the same nodes.
+
+    With instruments, an instrument.Instruments, the time each event
+    spends in each phase of handling it is measured.
+
+    With memo, a memo.HandlerCache, the nodes look up each event in it
+    before running their handlers, and reuse the response and new state of
+    an earlier handler run in the same state on the same event.
+
+    With bodies, a bodies.BodyCache, large message bodies are sent to the
+    debugger once and referred to by fingerprint after that.
+
+    symmetry is a list of symmetry groups, lists of the names of nodes that
+    are interchangeable (see symmetry.py), and addresses the fields of
+    states and message bodies that hold node names. They are sent to the
+    debugger when the nodes register, and its model checker then treats
+    states that only differ by swapping nodes within a group as the same.
+    """
+    def __init__(self, multiplex=False, raddr='localhost', rport=4343,
+                 store_size=10000, codec='json', session=None, replicas=0,
+                 processes=0, record=None, instruments=None, symmetry=(), memo=None,
+                 bodies=None, addresses=()):
+        self.multiplex = multiplex
+        self.processes = processes
+        self.store_size = store_size
+        self.raddr = raddr
+        self.rport = rport
+        self.codec = codec
+        self.store = StateStore(store_size)
+        self.nodes = []
+        self.session = session
+        self.replicas = replicas
+        self.record = record
+        self.instruments = instruments
+        self.memo = memo
+        self.bodies = bodies
+        self._recorder = None
+        self._session_fields = {} if session is None else {'id': session}
+        if symmetry:
+            self._session_fields['symmetry'] = [list(group) for group in symmetry]
+            self._session_fields['addresses'] = list(addresses)
 
     def add_node(self, cls, *args, **kwargs):
-        self.threads.append(threading.Thread(target=cls, args=args, kwargs=kwargs))
+        self.nodes.append((cls, args, kwargs))
 
     def run(self):
-        for thr in self.threads:
+        procs = [multiprocessing.Process(target=self._run_replica, args=(i,))
+                 for i in range(1, self.replicas + 1)]
+        for proc in procs:
+            proc.start()
+        self._run()
+        for proc in procs:
+            proc.join()
+
+    def _run_replica(self, i):
+        self._session_fields = dict(self._session_fields,
+                                    **{'id': '%s/%d' % (self.session or 'replica', i),
+                                       'replica-of': self.session})
+        if self.record is not None:
+            self.record = '%s.%d' % (self.record, i)
+        self._run()
+
+    def _run(self):
+        if self.record is not None:
+            self._recorder = Recorder(self.record)
+        try:
+            if self.processes:
+                _ProcessPool(self).run()
+            elif self.multiplex:
+                self._run_multiplexed()
+            else:
+                self._run_threaded()
+        finally:
+            if self._recorder is not None:
+                self._recorder.close()
+
+    def _run_threaded(self):
+        threads = []
+        for (cls, args, kwargs) in self.nodes:
+            kwargs = dict({'raddr': self.raddr, 'rport': self.rport, 'store': self.store,
+                           'codec': self.codec, 'session': self._session_fields,
+                           'recorder': self._recorder, 'instruments': self.instruments,
+                           'memo': self.memo, 'bodies': self.bodies},
+                          **kwargs)
+            threads.append(threading.Thread(target=cls, args=args, kwargs=kwargs))
+        for thr in threads:
             thr.start()
-        for thr in self.threads:
+        for thr in threads:
             thr.join()
+
+    def _run_multiplexed(self):
+        nodes = {}
+        names = []
+        for (cls, args, kwargs) in self.nodes:
+            node = cls(*args, connect=False, store=self.store,
+                       instruments=self.instruments, memo=self.memo, **kwargs)
+            nodes[node._name] = node
+            names.append(node._name)
+        conn = register(self.raddr, self.rport, dict(self._session_fields, names=names),
+                        self.codec, self._recorder, self.bodies)
+        conn.serve(lambda msg: _dispatch(nodes, msg), self.instruments)
+
+    def replay(self, path):
+        """Replay the session recorded at path against the nodes, without
+        the debugger, checking that every response is the same as the
+        recorded one.
+
+        Returns {'result': 'ok', 'events': n}, n being the number of events
+        replayed, or, at the first response that differs, {'result':
+        'mismatch', 'events': n, 'record': i, 'recorded': payload,
+        'replayed': payload}, with i the index of the recorded response in
+        the log and the two responses as they are on the wire.
+        """
+        store = StateStore(self.store_size)
+        nodes = {}
+        for (cls, args, kwargs) in self.nodes:
+            node = cls(*args, connect=False, store=store, **kwargs)
+            nodes[node._name] = node
+        connections = {}
+        bodies = None
+        events = 0
+        for (i, record) in enumerate(SessionLog(path)):
+            if record.kind == REGISTER:
+                registered = json.loads(record.payload.decode('utf-8'))
+                names = registered['names']
+                if len(names) == 1:
+                    handle = nodes[names[0]]._handle
+                else:
+                    handle = lambda msg: _dispatch(nodes, msg)
+                (decoder, encoder) = (make_codec(registered['codec']),
+                                      make_codec(registered['codec']))
+                if registered.get('bodies') is not None:
+                    if bodies is None:
+                        bodies = BodyCache(registered['bodies']['threshold'],
+                                           registered['bodies']['max-bytes'])
+                    decoder = encoder = BodyCodec(decoder, bodies, encoder)
+                connections[record.connection] = (handle, decoder, encoder, deque())
+                continue
+            (handle, decoder, encoder, responses) = connections[record.connection]
+            if record.kind == INBOUND:
+                resp = handle(decoder.decode(record.payload))
+                if resp is not None:
+                    responses.append(encoder.encode(resp))
+                    events += 1
+            elif record.kind == OUTBOUND:
+                replayed = responses.popleft() if responses else None
+                if replayed != record.payload:
+                    return {'result': 'mismatch', 'events': events, 'record': i,
+                            'recorded': record.payload, 'replayed': replayed}
+        return {'result': 'ok', 'events': events}
+
+def _dispatch(nodes, msg):
+    """Handle msg, an event for one of nodes (by name) received over a
+    connection shared by all of them; returns the response, or None on
+    quit."""
+    if msg['msgtype'] == 'quit':
+        print("Got quit")
+        return None
+    if msg['msgtype'] == 'batch':
+        return {'responses': [nodes[event['to']]._handle(event) for event in msg['events']]}
+    if msg['msgtype'] == 'restore':
+        # The nodes share one StateStore, so any of them can restore it
+        return next(iter(nodes.values()))._handle(msg)
+    return nodes[msg['to']]._handle(msg)
+
+def _pool_worker(pipe, nodes, store_size):
+    """Runs events for nodes, a share of a pooled Shim's nodes, as the
+    front process sends them."""
+    store = StateStore(store_size)
+    for node in nodes.values():
+        node._store = store
+        store.add(node)
+    while True:
+        (state_id, msg) = pipe.recv()
+        if msg is None:
+            break
+        # Record the new state under the id the front process chose
+        store._next_id = state_id
+        pipe.send(nodes[msg['to']]._handle(msg))
+
+class _ProcessPool(object):
+    """The front process of Shim(processes=N).
+
+    Each worker keeps its own StateStore, with snapshots of just its own
+    nodes. The front process gives every event's new state a global id, and
+    remembers the system state under that id as the id of each worker's
+    snapshot; an event carrying a state id is sent on with the id of its
+    worker's snapshot in that system state, and the other workers are put
+    back when they next get an event.
+    """
+
+    def __init__(self, shim):
+        self.shim = shim
+        self.systems = OrderedDict()
+        self.next_id = 0
+        self.replies = deque()
+        self.replies_ready = threading.Condition()
+
+    def run(self):
+        shim = self.shim
+        nodes = [cls(*args, connect=False, memo=shim.memo, **kwargs)
+                 for (cls, args, kwargs) in shim.nodes]
+        n = min(shim.processes, len(nodes))
+        self.owner = dict((node._name, i % n) for (i, node) in enumerate(nodes))
+        self.current = (None,) * n
+        self.pipes = []
+        procs = []
+        for w in range(n):
+            (here, there) = multiprocessing.Pipe()
+            share = dict((node._name, node) for node in nodes if self.owner[node._name] == w)
+            procs.append(multiprocessing.Process(target=_pool_worker,
+                                                 args=(there, share, shim.store_size)))
+            self.pipes.append(here)
+        for proc in procs:
+            proc.start()
+        conn = register(shim.raddr, shim.rport,
+                        dict(shim._session_fields, names=[node._name for node in nodes]),
+                        shim.codec, shim._recorder, shim.bodies)
+        writer = threading.Thread(target=self._send_replies, args=(conn,))
+        writer.start()
+        while True:
+            msg = conn.recv()
+            if msg['msgtype'] == 'quit':
+                print("Got quit")
+                break
+            if msg['msgtype'] == 'batch':
+                self._reply([self._dispatch(event) for event in msg['events']])
+            else:
+                self._reply(self._dispatch(msg))
+        self._reply(None)
+        writer.join()
+        for pipe in self.pipes:
+            pipe.send((None, None))
+        for proc in procs:
+            proc.join()
+
+    def _dispatch(self, msg):
+        """Send msg on to its worker; returns its reply, or the pipe to read
+        the reply from."""
+        state_id = msg.get('state-id')
+        system = self.current
+        if state_id is not None:
+            system = self.systems.pop(state_id, None)
+            if system is None:
+                return {'ok': False, 'error': 'Unknown state id %s' % state_id}
+            self.systems[state_id] = system
+        if msg['msgtype'] == 'restore':
+            self.current = system
+            return {'ok': True}
+        w = self.owner[msg['to']]
+        msg = dict(msg)
+        msg.pop('state-id', None)
+        if system[w] is not None:
+            msg['state-id'] = system[w]
+        new_id = self.next_id
+        self.next_id += 1
+        self.current = system[:w] + (new_id,) + system[w + 1:]
+        self.systems[new_id] = self.current
+        if len(self.systems) > self.shim.store_size:
+            self.systems.popitem(last=False)
+        self.pipes[w].send((new_id, msg))
+        return self.pipes[w]
+
+    def _reply(self, reply):
+        """Queue a reply: a response, a worker's pipe to read it from, or a
+        list of those for a batch."""
+        with self.replies_ready:
+            self.replies.append(reply)
+            self.replies_ready.notify()
+
+    def _send_replies(self, conn):
+        while True:
+            with self.replies_ready:
+                while not self.replies:
+                    self.replies_ready.wait()
+                reply = self.replies.popleft()
+            if reply is None:
+                break
+            if isinstance(reply, list):
+                reply = {'responses': [r if isinstance(r, dict) else r.recv() for r in reply]}
+            elif not isinstance(reply, dict):
+                reply = reply.recv()
+            conn.send(reply)
@@ -0,0 +1,303 @@
+"""Runs a system of nodes in simulated time, without the debugger.
+
+The debugger delivers one event at a time, in whatever order the person
+(or model checker) driving it picks. Simulation runs the same Node
+subclasses on their own as a real deployment would, only in virtual time
+and as fast as the handlers go, to load-test the protocols debugged in
+Oddity:
+
+    sim = Simulation(Network(latency=0.01, jitter=0.005, loss=0.01), seed=1)
+    sim.add_node(RaftClient, 'client', cfg={'cluster': cluster, 'workload': 10**9})
+    for node in cluster:
+        sim.add_node(RaftServer, node, cfg={'cluster': cluster})
+    sim.observe(RaftCommits())
+    print(sim.run(duration=600))
+
+Events wait on one heap, ordered by the virtual time they are due.
+
+Messages are delivered through the Network, which delays each one by its
+latency plus up to jitter seconds. It drops a share of them (loss), and
+holds back another share (reorder) for up to reorder_delay seconds more, so
+they overtake each other.
+
+Timeouts are handled as the debugger does: a timeout, once set, stays set
+until its node clears it. Here that means it fires every seconds (as passed
+to set_timeout), give or take timer_jitter of that, until it is cleared.
+Setting a timeout that is already set leaves it running as it was, since
+in the debugger that doesn't put it off either; clearing it and setting it
+again, in one handler or not, starts it over.
+
+Observers see every event handled, with the node's state before and after.
+They count the operations of the protocol and time them: RaftCommits from
+a client sending a command to its being applied, MutexLocks from a node
+requesting the lock to its getting it. run reports them, along with the
+messages sent per operation.
+
+    python simulate.py raft --nodes 5 --duration 600 --loss 0.01
+"""
+
+from __future__ import print_function
+import argparse
+import heapq
+import json
+import random
+import time
+from collections import OrderedDict
+from cow import freeze, thaw
+from fingerprint import fingerprint
+from instrument import Histogram
+
+
+class Network(object):
+    """How long messages take to arrive, in seconds, and whether they do."""
+
+    def __init__(self, latency=0.01, jitter=0.005, loss=0.0, reorder=0.0,
+                 reorder_delay=0.1):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+
+    def delay(self, rng, message):
+        """How long message takes to arrive, or None if it is lost."""
+        if self.loss and rng.random() < self.loss:
+            return None
+        delay = self.latency + rng.uniform(0, self.jitter)
+        if self.reorder and rng.random() < self.reorder:
+            delay += rng.uniform(0, self.reorder_delay)
+        return delay
+
+
+class Observer(object):
+    """Watches the events a Simulation handles."""
+
+    def handled(self, now, event, before, after):
+        """The node event was for has handled it at virtual time now, going
+        from state before to state after."""
+        pass
+
+    def operations(self):
+        """How many operations have completed."""
+        return 0
+
+    def report(self):
+        return {}
+
+
+class LatencyObserver(Observer):
+    """Times operations, each from the event that starts it to the one
+    that completes it, per node."""
+
+    def __init__(self, name):
+        self.name = name
+        self.histogram = Histogram()
+        self._started = {}
+
+    def start(self, node, now):
+        self._started.setdefault(node, now)
+
+    def complete(self, node, now):
+        started = self._started.pop(node, None)
+        if started is not None:
+            self.histogram.add((now - started) * 1000)
+
+    def operations(self):
+        return self.histogram.count
+
+    def report(self):
+        return {self.name: dict(self.histogram.summary(), unit='ms')}
+
+
+class RaftCommits(LatencyObserver):
+    """Commit latency of Raft clients' commands (see raft.RaftClient)."""
+
+    def __init__(self):
+        LatencyObserver.__init__(self, 'commit-latency')
+
+    def handled(self, now, event, before, after):
+        if 'inflight' not in after:
+            return
+        if after['n'] > before.get('n', 0):
+            self.complete(event['to'], now)
+            # The client sends its next command as soon as one is applied
+            if after['inflight'] is not None:
+                self.start(event['to'], now)
+        elif after['inflight'] is not None and before.get('inflight') is None:
+            self.start(event['to'], now)
+
+
+class MutexLocks(LatencyObserver):
+    """How long mutex.MutexServers wait for the lock."""
+
+    def __init__(self):
+        LatencyObserver.__init__(self, 'lock-wait')
+
+    def handled(self, now, event, before, after):
+        if 'lock' not in after:
+            return
+        if event['msgtype'] == 'timeout' and event['type'] == 'request':
+            self.start(event['to'], now)
+        if after['lock'] and not before.get('lock'):
+            self.complete(event['to'], now)
+
+
+class Simulation(object):
+    """Runs a set of nodes, added as for Shim, in virtual time."""
+
+    def __init__(self, network=None, seed=0, timer_jitter=0.5):
+        self.network = network if network is not None else Network()
+        self.rng = random.Random(seed)
+        self.timer_jitter = timer_jitter
+        self.nodes = []
+        self.observers = []
+        self.now = 0.0
+        self._nodes = OrderedDict()
+        self._queue = []
+        self._seq = 0
+        # The generation of each timeout set, by (to, type, body); queued
+        # firings of earlier generations are stale
+        self._timers = {}
+        self.stats = {'events': 0, 'sent': 0, 'delivered': 0, 'lost': 0, 'timeouts': 0}
+
+    def add_node(self, cls, *args, **kwargs):
+        self.nodes.append((cls, args, kwargs))
+
+    def observe(self, observer):
+        self.observers.append(observer)
+
+    def _schedule(self, due, event, timer=None):
+        self._seq += 1
+        heapq.heappush(self._queue, (due, self._seq, event, timer))
+
+    def _timer_key(self, timeout):
+        return (timeout['to'], timeout['type'], fingerprint(timeout['body']))
+
+    def _set_timer(self, timeout, seconds):
+        key = self._timer_key(timeout)
+        if self._timers.get(key, (0, None))[1] is not None:
+            return
+        generation = self._timers.get(key, (0,))[0] + 1
+        self._timers[key] = (generation, seconds)
+        self._schedule(self.now + self._timer_delay(seconds),
+                       freeze(dict(timeout, msgtype='timeout')), (key, generation))
+
+    def _timer_delay(self, seconds):
+        return seconds * self.rng.uniform(1 - self.timer_jitter, 1 + self.timer_jitter)
+
+    def _clear_timer(self, timeout):
+        key = self._timer_key(timeout)
+        if key in self._timers:
+            self._timers[key] = (self._timers[key][0] + 1, None)
+
+    def _handle(self, event):
+        name = event['to']
+        node = self._nodes[name]
+        before = node._state
+        delivered = event
+        if 'body' in event:
+            # Handlers are free to change the body they are given
+            delivered = dict(event, body=thaw(event['body']))
+        ret = node._run_handler(delivered)
+        self.stats['events'] += 1
+        effects = ret.effects()
+        for timeout in effects['cleared-timeouts']:
+            self._clear_timer(timeout)
+        for (timeout, seconds) in zip(effects['set-timeouts'], ret.timeout_seconds()):
+            self._set_timer(timeout, seconds)
+        for message in effects['send-messages']:
+            self.stats['sent'] += 1
+            delay = self.network.delay(self.rng, message)
+            if delay is None:
+                self.stats['lost'] += 1
+            else:
+                self._schedule(self.now + delay, freeze(dict(message, msgtype='msg')))
+        for observer in self.observers:
+            observer.handled(self.now, event, before, node._state)
+
+    def start(self):
+        for (cls, args, kwargs) in self.nodes:
+            node = cls(*args, connect=False, timed=True, **kwargs)
+            self._nodes[node._name] = node
+        for name in self._nodes:
+            self._handle({'msgtype': 'start', 'to': name})
+
+    def step(self, until=None):
+        """Handle the next event due, by until if given, moving the clock on
+        to it; returns False if there is none."""
+        while self._queue and (until is None or self._queue[0][0] <= until):
+            (due, _, event, timer) = heapq.heappop(self._queue)
+            if timer is not None:
+                (key, generation) = timer
+                (current, seconds) = self._timers[key]
+                if current != generation:
+                    continue
+                self.now = due
+                self.stats['timeouts'] += 1
+                # Set until cleared, so it fires again
+                self._schedule(self.now + self._timer_delay(seconds), event, timer)
+            else:
+                self.now = due
+                if event['to'] not in self._nodes:
+                    continue
+                self.stats['delivered'] += 1
+            self._handle(event)
+            return True
+        return False
+
+    def run(self, duration=None, max_events=None):
+        """Start the nodes and run them until duration seconds of virtual
+        time or max_events events have gone by; returns a report."""
+        wall = time.time()
+        self.start()
+        while max_events is None or self.stats['events'] < max_events:
+            if not self.step(duration):
+                break
+        return self.report(time.time() - wall)
+
+    def report(self, wall_seconds):
+        report = dict(self.stats, **{'virtual-seconds': self.now,
+                                     'wall-seconds': wall_seconds,
+                                     'events-per-second': self.stats['events'] / max(wall_seconds, 1e-9)})
+        operations = 0
+        for observer in self.observers:
+            report.update(observer.report())
+            operations += observer.operations()
+        report['operations'] = operations
+        if operations:
+            report['messages-per-operation'] = self.stats['sent'] / float(operations)
+        return report
+
+
+OBSERVERS = {'raft': RaftCommits, 'mutex': MutexLocks}
+
+
+def main(argv=None):
+    # The systems are the benchmark's
+    from bench import SYSTEMS
+    parser = argparse.ArgumentParser(description='Run an example system in simulated time.')
+    parser.add_argument('system', choices=sorted(SYSTEMS))
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--duration', type=float, default=600,
+                        help='virtual seconds to run for')
+    parser.add_argument('--max-events', type=int)
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--jitter', type=float, default=0.005)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--reorder', type=float, default=0.0)
+    parser.add_argument('--reorder-delay', type=float, default=0.1)
+    parser.add_argument('--timer-jitter', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(argv)
+    sim = Simulation(Network(options.latency, options.jitter, options.loss,
+                             options.reorder, options.reorder_delay),
+                     seed=options.seed, timer_jitter=options.timer_jitter)
+    for (cls, args, kwargs) in SYSTEMS[options.system](options.nodes):
+        sim.add_node(cls, *args, **kwargs)
+    if options.system in OBSERVERS:
+        sim.observe(OBSERVERS[options.system]())
+    print(json.dumps(sim.run(options.duration, options.max_events), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
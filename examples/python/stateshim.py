@@ -1,17 +1,93 @@
-import threading
-import socket
 import json
-import struct
-from copy import deepcopy
+import shim
+from cow import freeze, thaw
+from shim import Shim, string_types
+
+def json_key(k):
+    """The string JSON turns the dict key k into."""
+    if isinstance(k, string_types):
+        return k
+    return json.dumps(k)
+
+def encoded_size_over(value, budget):
+    """Whether value's JSON encoding is longer than budget, looking at no
+    more of value than it takes to find out."""
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, dict):
+            budget -= 2
+            for (k, child) in v.items():
+                budget -= len(json.dumps(json_key(k))) + 4
+                stack.append(child)
+                if budget < 0:
+                    return True
+        elif isinstance(v, (list, tuple)):
+            budget -= 2 + 2 * len(v)
+            if budget < 0:
+                return True
+            stack.extend(v)
+        else:
+            budget -= len(json.dumps(v))
+        if budget < 0:
+            return True
+    return False
+
+def diff_state(before, after, path=()):
+    """State updates turning before into after, or None if after should be
+    sent whole.
+
+    Containers shared by before and after are skipped without looking
+    inside them, so this costs about as much as the parts of the state a
+    handler touched. Lost keys are deleted, and lists that grew or shrank
+    are appended to or truncated (see HandlerReturn in shim.py). A
+    container is sent whole when that is shorter than its updates.
+    """
+    if before is after:
+        return []
+    if isinstance(before, dict) and isinstance(after, dict):
+        updates = [{'path': list(path + (json_key(k),)), 'op': 'delete'}
+                   for k in before if k not in after]
+        for (k, v) in after.items():
+            child_path = path + (json_key(k),)
+            if k in before:
+                child_updates = diff_state(before[k], v, child_path)
+            else:
+                child_updates = None
+            if child_updates is None:
+                child_updates = [{'path': list(child_path), 'value': v}]
+            updates.extend(child_updates)
+    elif isinstance(before, list) and isinstance(after, list):
+        updates = []
+        for (i, v) in enumerate(after[:len(before)]):
+            child_path = path + (i,)
+            child_updates = diff_state(before[i], v, child_path)
+            if child_updates is None:
+                child_updates = [{'path': list(child_path), 'value': v}]
+            updates.extend(child_updates)
+        if len(after) > len(before):
+            updates.append({'path': list(path), 'op': 'append',
+                            'values': after[len(before):]})
+        elif len(after) < len(before):
+            updates.append({'path': list(path), 'op': 'truncate-extend',
+                            'index': len(after), 'values': []})
+    else:
+        return [] if before == after else None
+    if updates and not encoded_size_over(after, len(json.dumps(updates))):
+        return None
+    return updates
 
 class HandlerReturn(object):
+    """Collects a handler's effects. ret.state is the node's state; it is
+    copied on write, so only the parts a handler looks up get copied."""
 
     def __init__(self, name, state):
         self._name = name
         self._messages = []
-        self._updates = []
-        self.state = deepcopy(state)
+        self._before = state
+        self.state = thaw(state)
         self._timeouts = []
+        self._timeout_seconds = []
         self._cleared_timeouts = []
 
     def send(self, dst, type, body):
@@ -19,94 +95,38 @@ class HandlerReturn(object):
             
     def set_timeout(self, type, body, seconds=5):
         self._timeouts.append({'to': self._name, 'type': type, 'body': body})
+        self._timeout_seconds.append(seconds)
 
     def clear_timeout(self, type, body):
         self._cleared_timeouts.append({'to': self._name, 'type': type, 'body': body})
 
-    def finalize(self):
-        message = {'send-messages': self._messages,
-                   'set-timeouts': self._timeouts, 
-                   'cleared-timeouts': self._cleared_timeouts,
-                   'states': {self._name: self.state}}
-        return message
-    
-def send(sock, obj):
-    s = json.dumps(obj)
-    #print s
-    length = struct.pack('!I', len(s))
-    sock.sendall(length+s)
+    def timeout_seconds(self):
+        """How long each of the timeouts set was set for, in order. The
+        debugger ignores it; simulate.py doesn't."""
+        return self._timeout_seconds
 
-def recv(sock):
-    buf = ''
-    while len(buf) < 4:
-        buf += sock.recv(4-len(buf))
-    length = struct.unpack('!i', buf[:4])[0]
-    buf = ''
-    while len(buf) < length:
-        buf += sock.recv(length-len(buf))
-    return json.loads(buf)
-        
-class Node(object):
+    def footprint(self):
+        # Lookups in ret.state aren't tracked
+        return None
 
-    def __init__(self, name, raddr='localhost', rport=4343, cfg={}):
-        self._name = name
-        self._state = {}
-        self._cfg = cfg
-        self._register(raddr, rport)
-        self._event_loop()
+    def effects(self):
+        return {'send-messages': self._messages,
+                'set-timeouts': self._timeouts,
+                'cleared-timeouts': self._cleared_timeouts}
 
-    def config(self):
-        return deepcopy(self._cfg)
-        
+    def finalize(self):
+        message = self.effects()
+        updates = diff_state(self._before, self.state)
+        if updates is None or not isinstance(self.state, dict):
+            message['states'] = {self._name: self.state}
+        else:
+            message['state-updates'] = updates
+        return message
     
-    def start_handler(self, name, ret):
-        pass
-
-    def message_handler(self, to, sender, type, body, ret):
-        pass
-
-    def timeout_handler(self, name, type, body, ret):
-        pass
-
-    def _register(self, raddr, rport):
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self._sock.connect((raddr, rport))
-        send(self._sock, {'msgtype': 'register', 'name': self._name})
-        resp = recv(self._sock)
-        if not resp.get('ok'):
-            raise Exception('Oh no')
-        print "Registered"
-
-    def _event_loop(self):
-        while True:
-            msg = recv(self._sock)
-            ret = HandlerReturn(self._name, self._state)
-            if msg['msgtype'] == 'msg':
-                print "Got message"
-                self.message_handler(self._name, msg['from'], msg['type'], msg['body'], ret)
-            elif msg['msgtype'] == 'timeout':
-                print "Got timeout"
-                self.timeout_handler(self._name, msg['type'], msg['body'], ret)
-            elif msg['msgtype'] == 'start':
-                print "Got start"
-                ret.state = {}
-                self.start_handler(self._name, ret)
-            elif msg['msgtype'] == 'quit':
-                print "Got quit"
-                break
-            self._state = ret.state
-            send(self._sock, ret.finalize())
-
-class Shim(object):
-    def __init__(self):
-        self.threads = []
+class Node(shim.Node):
 
-    def add_node(self, cls, *args, **kwargs):
-        self.threads.append(threading.Thread(target=cls, args=args, kwargs=kwargs))
+    def _handler_return(self):
+        return HandlerReturn(self._name, self._state)
 
-    def run(self):
-        for thr in self.threads:
-            thr.start()
-        for thr in self.threads:
-            thr.join()
+    def _returned_state(self, ret):
+        return freeze(ret.state)
@@ -0,0 +1,219 @@
+"""Random testing of a system of nodes, many schedules at once.
+
+The debugger's model checker searches every schedule up to a depth bound,
+which keeps it from bugs that take more events than that to reach. Swarm
+instead runs a great many random schedules, each a walk of up to max_depth
+events, as deep as need be: from each state it delivers one of the messages
+in flight or timeouts set, picked at random, and checks the predicate in
+the state that leads to. A schedule is determined by its seed, so a walk
+that finds the predicate can be run again from the seed alone.
+
+Unless swarm is off, each walk also leaves out a random half of the kinds
+of events (by msgtype and type) while it can, delivering them only when
+nothing else is left to deliver. Different walks so exercise different
+parts of the protocol, say elections without heartbeats, which finds bugs
+that uniformly random schedules seldom do (swarm testing).
+
+    sw = Swarm(max_depth=500)
+    for node in ['S1', 'S2', 'S3']:
+        sw.add_node(RaftServer, node, cfg={'cluster': ['S1', 'S2', 'S3']})
+    res = sw.run(two_leaders, 100000, processes=8)
+    if res['result'] == 'found':
+        print(res['seed'], res['trace'])
+
+Predicates are as for Explorer, and so are results, with the seed of the
+walk as well. The trace is the events delivered after starting the nodes:
+Explorer(prefix=trace).initial_state() rebuilds the state it leads to, and
+debugger_trace converts it to the form the debugger's run-until returns.
+run spreads the walks over a pool of processes, so functions given as
+predicates must be picklable, defined at the top level of a module. Its
+results also say how many schedules were run, how many events delivered and
+how fast.
+
+    python swarm.py raft --nodes 3 --schedules 10000 --depth 500
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import random
+import time
+from cow import thaw
+from explore import Explorer, state_matches
+
+
+def debugger_trace(trace):
+    """trace as the debugger's run-until returns traces, for its client to
+    replay."""
+    return [{'deliver-message' if event['msgtype'] == 'msg' else 'deliver-timeout':
+             dict((k, v) for (k, v) in event.items() if k != 'msgtype')}
+            for event in trace]
+
+
+def never(system):
+    """A predicate no state matches, for measuring throughput."""
+    return False
+
+
+class Swarm(Explorer):
+    """Runs random schedules of a set of nodes, added as for Shim.
+
+    prefix is a list of msg and timeout events to deliver after starting
+    the nodes; every walk starts from the state they lead to.
+    """
+
+    def __init__(self, prefix=(), max_depth=200, swarm=True):
+        Explorer.__init__(self, prefix, dedup=False, por=False)
+        self.max_depth = max_depth
+        self.swarm = swarm
+        self._initial = None
+
+    def __getstate__(self):
+        # The nodes are rebuilt in each worker process
+        state = dict(self.__dict__)
+        state['_nodes'] = None
+        state['_initial'] = None
+        return state
+
+    def add_node(self, cls, *args, **kwargs):
+        Explorer.add_node(self, cls, *args, **kwargs)
+        self._initial = None
+
+    def walk(self, pred, seed):
+        """Run the schedule seed; returns a result, with the number of
+        events it delivered under 'events'."""
+        rng = random.Random(seed)
+        if self._initial is None:
+            self._initial = self.initial_state()
+        system = self._initial
+        omitted = {}
+        trace = []
+        if state_matches(pred, system):
+            return {'result': 'found', 'seed': seed, 'trace': trace, 'state': system,
+                    'events': 0}
+        while len(trace) < self.max_depth:
+            # The events DSState.actions would offer; their order doesn't
+            # matter to a uniform choice, so they aren't sorted
+            events = system.messages + system.timeouts
+            if not events:
+                break
+            event = self._choose(rng, omitted, events)
+            (system, _) = self._step(system, event)
+            trace.append(event)
+            if state_matches(pred, system):
+                return {'result': 'found', 'seed': seed, 'trace': thaw(trace),
+                        'state': system, 'events': len(trace)}
+        return {'result': 'not-found', 'events': len(trace)}
+
+    def _choose(self, rng, omitted, events):
+        """One of events at random, of the kinds not omitted if there are
+        any; omitted has whether each kind is, deciding new kinds as they
+        come up."""
+        if not self.swarm:
+            return events[rng.randrange(len(events))]
+        # Usually most events are of kinds not omitted, so a few draws find
+        # one without looking at every event
+        for _ in range(8):
+            event = events[rng.randrange(len(events))]
+            if not self._omitted(rng, omitted, event):
+                return event
+        included = [e for e in events if not self._omitted(rng, omitted, e)]
+        events = included or events
+        return events[rng.randrange(len(events))]
+
+    def _omitted(self, rng, omitted, event):
+        kind = (event['msgtype'], event['type'])
+        if kind not in omitted:
+            omitted[kind] = rng.random() < 0.5
+        return omitted[kind]
+
+    def run(self, pred, schedules, seed=0, processes=None, chunk=64):
+        """Run the schedules seed to seed + schedules - 1, spread over
+        processes worker processes (as many as there are cores by default,
+        none with 0), until one finds pred. The result found is that of the
+        lowest seed that finds it, wherever the walks ran."""
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        chunks = [(seed + i, min(chunk, schedules - i)) for i in range(0, schedules, chunk)]
+        started = time.time()
+        res = {'result': 'not-found'}
+        (walks, events) = (0, 0)
+        pool = None
+        if processes:
+            pool = multiprocessing.Pool(processes, _init_worker, (self, pred))
+            results = pool.imap(_walk_chunk, chunks)
+        else:
+            _init_worker(self, pred)
+            results = (_walk_chunk(c) for c in chunks)
+        try:
+            for (n, delivered, found) in results:
+                walks += n
+                events += delivered
+                if found is not None:
+                    res = found
+                    del res['events']
+                    break
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        seconds = time.time() - started
+        res.update({'schedules': walks, 'events': events, 'seconds': seconds,
+                    'schedules-per-second': walks / max(seconds, 1e-9),
+                    'schedules-per-second-per-core': walks / max(seconds, 1e-9) / max(processes, 1)})
+        return res
+
+
+# The Swarm and predicate of a worker process
+_worker = None
+
+
+def _init_worker(swarm, pred):
+    global _worker
+    _worker = (swarm, pred)
+
+
+def _walk_chunk(chunk):
+    """Walk the schedules of chunk, (first seed, count), in order; returns
+    how many were walked, the events they delivered and the result of the
+    first to find the predicate, or None."""
+    (swarm, pred) = _worker
+    (first, count) = chunk
+    events = 0
+    for seed in range(first, first + count):
+        res = swarm.walk(pred, seed)
+        events += res['events']
+        if res['result'] == 'found':
+            return (seed - first + 1, events, res)
+    return (count, events, None)
+
+
+def main(argv=None):
+    # The systems are the benchmark's
+    from bench import SYSTEMS
+    parser = argparse.ArgumentParser(description='Run random schedules of an example system.')
+    parser.add_argument('system', choices=sorted(SYSTEMS))
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--schedules', type=int, default=1000)
+    parser.add_argument('--depth', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--no-swarm', action='store_true',
+                        help='choose among all events in every walk')
+    parser.add_argument('--pred', type=json.loads,
+                        help='a node-state predicate, as JSON; by default none, '
+                        'to measure throughput')
+    options = parser.parse_args(argv)
+    sw = Swarm(max_depth=options.depth, swarm=not options.no_swarm)
+    for (cls, args, kwargs) in SYSTEMS[options.system](options.nodes):
+        sw.add_node(cls, *args, **kwargs)
+    res = sw.run(options.pred or never, options.schedules, options.seed, options.processes)
+    if res['result'] == 'found':
+        res['trace'] = debugger_trace(res['trace'])
+        del res['state']
+    print(json.dumps(res, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""Symmetry reduction: system states equal up to renaming nodes.
+
+A symmetry group is a list of the names of nodes that are interchangeable:
+they run the same code with the same configuration, and their handlers
+only ever use each other's names to address and identify one another. In
+a cluster of three RaftServers with nothing else, S1, S2 and S3 are; a
+system state in which S2 is leader is then as good as the one in which S3
+is, renamed. Exploring just one state of each such class of states cuts
+the states of an N-node group by up to N!.
+
+Renaming a system state renames the nodes themselves, the from and to of
+its messages and timeouts, and the node names held in address fields:
+the fields, wherever they turn up in states and message bodies, that are
+declared to hold node names, such as RaftServer's voted_for, votes,
+cluster, match_index and next_index. A string address is renamed, as are
+the strings in a list of them and the keys of a dict keyed by them; nothing
+else is, so a command or key that happens to equal a node's name is left
+alone. Every field a node name can reach must be declared, or renaming
+gives states that the system can't be in. MutexServer's nodes aren't
+interchangeable (node 1 starts with the lock and ties go to the lowest
+name), and nor are servers whose state or configuration orders the
+cluster's names, since renaming the names reorders it.
+
+The canonical form of a system state orders the nodes of each group by
+signature, their own state and the events to and from them with the names
+of group members abstracted away, and renames them to the group's names in
+order. Nodes whose signatures tie are tried in every order, and of those
+renamings the one that comes first when compared as JSON (see
+system_order) wins. Either way the result is the same for every state that
+is a renaming of it. canonical-fingerprint in dsmodelchecker.clj does the
+same for the debugger's model checker, and picks the same renaming as long
+as the JSON both sides write is the same: for strings, integers, booleans
+and null it is, but floats are written differently (1e-05 here, 1.0E-5
+there). A state they disagree on is still canonical on each side alone.
+"""
+
+import itertools
+import json
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+
+def renamings(groups):
+    """Every renaming of the nodes in groups that only swaps nodes within
+    a group, as a dict from old name to new name; the identity first."""
+    groups = [list(group) for group in groups]
+    for perms in itertools.product(*[itertools.permutations(group) for group in groups]):
+        renaming = {}
+        for (group, perm) in zip(groups, perms):
+            renaming.update(zip(group, perm))
+        yield renaming
+
+
+def _rename_address(value, renaming, addresses):
+    if isinstance(value, string_types):
+        return renaming.get(value, value)
+    if isinstance(value, dict):
+        return dict((renaming.get(k, k) if isinstance(k, string_types) else k,
+                     rename(v, renaming, addresses))
+                    for (k, v) in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_rename_address(v, renaming, addresses) for v in value]
+    return value
+
+
+def rename(value, renaming, addresses):
+    """value with the node names in its address fields renamed by
+    renaming."""
+    if isinstance(value, dict):
+        return dict((k, _rename_address(v, renaming, addresses) if k in addresses
+                     else rename(v, renaming, addresses))
+                    for (k, v) in value.items())
+    if isinstance(value, (list, tuple)):
+        return [rename(v, renaming, addresses) for v in value]
+    return value
+
+
+def rename_event(event, renaming, addresses):
+    """The message or timeout event with its from, to and body renamed."""
+    event = dict(event)
+    for k in ('from', 'to'):
+        if k in event:
+            event[k] = renaming.get(event[k], event[k])
+    if 'body' in event:
+        event['body'] = rename(event['body'], renaming, addresses)
+    return event
+
+
+def rename_system(system, renaming, addresses):
+    """The system state system with its nodes renamed by renaming."""
+    return system._replace(
+        states=dict((renaming.get(name, name), rename(state, renaming, addresses))
+                    for (name, state) in system.states.items()),
+        messages=tuple(rename_event(m, renaming, addresses) for m in system.messages),
+        timeouts=tuple(rename_event(t, renaming, addresses) for t in system.timeouts))
+
+
+def _json_keys(value):
+    """value with its dict keys as strings, as they are in JSON."""
+    if isinstance(value, dict):
+        return dict((k if isinstance(k, string_types) else json.dumps(k), _json_keys(v))
+                    for (k, v) in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_json_keys(v) for v in value]
+    return value
+
+
+def _sorted_json(value):
+    return json.dumps(_json_keys(value), sort_keys=True, separators=(',', ':'))
+
+
+def _events_json(events):
+    return ','.join(sorted(_sorted_json(dict((k, e[k]) for k in ('from', 'to', 'type', 'body')
+                                             if k in e))
+                           for e in events))
+
+
+def system_order(system):
+    """A string to compare system states by: the node states, then the
+    messages and timeouts in flight, sorted, all as JSON with sorted keys.
+    Mirrors system-order in dsmodelchecker.clj."""
+    return '[%s,[%s],[%s]]' % (_sorted_json(system.states), _events_json(system.messages),
+                               _events_json(system.timeouts))
+
+
+def _abstract_address(value, abstraction, addresses):
+    if isinstance(value, dict):
+        # Abstracted names can collide, so keep every entry, in order
+        return sorted(([abstraction.get(k, k) if isinstance(k, string_types) else k,
+                        _abstract(v, abstraction, addresses)]
+                       for (k, v) in value.items()), key=_sorted_json)
+    if isinstance(value, (list, tuple)):
+        return [_abstract_address(v, abstraction, addresses) for v in value]
+    return _rename_address(value, abstraction, addresses)
+
+
+def _abstract(value, abstraction, addresses):
+    """value renamed by abstraction, with dicts keyed by addresses as sorted
+    lists of their entries."""
+    if isinstance(value, dict):
+        return dict((k, _abstract_address(v, abstraction, addresses) if k in addresses
+                     else _abstract(v, abstraction, addresses))
+                    for (k, v) in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_abstract(v, abstraction, addresses) for v in value]
+    return value
+
+
+def _abstract_event(event, abstraction, addresses):
+    event = dict(event)
+    for k in ('from', 'to'):
+        if k in event:
+            event[k] = abstraction.get(event[k], event[k])
+    if 'body' in event:
+        event['body'] = _abstract(event['body'], abstraction, addresses)
+    return event
+
+
+def signature(system, node, groups, addresses):
+    """What node is in system regardless of the names of the nodes in
+    groups: its state and the events to and from it, with its own name as
+    "@self" and those of the other nodes in group i as "@i", as JSON. Nodes
+    that a renaming swaps have the same signature in the renamed state as
+    in the original. Mirrors signature in dsmodelchecker.clj."""
+    abstraction = {}
+    for (i, group) in enumerate(groups):
+        abstraction.update((name, '@%d' % i) for name in group)
+    abstraction[node] = '@self'
+    events = lambda es: _events_json(_abstract_event(e, abstraction, addresses) for e in es)
+    return '[%s,[%s],[%s],[%s]]' % (
+        _sorted_json(_abstract(system.states.get(node), abstraction, addresses)),
+        events(m for m in system.messages if m.get('to') == node),
+        events(m for m in system.messages if m.get('from') == node),
+        events(t for t in system.timeouts if t.get('to') == node))
+
+
+def _candidates(system, groups, addresses):
+    """The renamings that sort each group by signature, ties every way."""
+    renaming = {}
+    ties = []
+    for group in groups:
+        signatures = dict((node, signature(system, node, groups, addresses)) for node in group)
+        ordered = sorted(group, key=lambda node: signatures[node])
+        renaming.update(zip(ordered, sorted(group)))
+        names = sorted(group)
+        for (_, tied) in itertools.groupby(range(len(ordered)),
+                                           key=lambda i: signatures[ordered[i]]):
+            tied = [names[i] for i in tied]
+            if len(tied) > 1:
+                ties.append(tied)
+    for swaps in renamings(ties):
+        yield dict((old, swaps.get(new, new)) for (old, new) in renaming.items())
+
+
+def canonical(system, groups, key, addresses=()):
+    """The canonical key of system: key(r) of its canonical renaming r by
+    the nodes in groups, together with the renaming that gives it. Only
+    the renamings of nodes that tie by signature are serialized to find it."""
+    addresses = frozenset(addresses)
+    best = None
+    candidates = list(_candidates(system, groups, addresses))
+    for renaming in candidates:
+        if all(old == new for (old, new) in renaming.items()):
+            # The unrenamed system keeps the fingerprints cached in its frozen states
+            renamed = system
+        else:
+            renamed = rename_system(system, renaming, addresses)
+        order = system_order(renamed) if len(candidates) > 1 else None
+        # Renamings that order the same give the same state, so the first wins
+        if best is None or order < best[0]:
+            best = (order, renamed, renaming)
+    (_, renamed, renaming) = best
+    return (key(renamed), renaming)
@@ -0,0 +1,73 @@
+"""Tests of the Raft example, run through the explorer (explore.py).
+
+    python -m unittest test_raft
+"""
+
+import unittest
+import raft
+from explore import Explorer
+
+CLUSTER = ['S1', 'S2', 'S3']
+
+
+class RaftReplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.explorer = Explorer()
+        self.explorer.add_node(raft.RaftClient, 'client',
+                               cfg={'cluster': CLUSTER, 'workload': 6})
+        for node in CLUSTER:
+            # Small batches, so catching up takes several
+            self.explorer.add_node(raft.RaftServer, node,
+                                   cfg={'cluster': CLUSTER, 'max_entries': 2})
+        self.system = self.explorer.initial_state()
+
+    def deliver(self, event):
+        self.system = self.explorer.run_action(self.system, event)
+
+    def timeout(self, to, type):
+        self.deliver(next(t for t in self.system.timeouts
+                          if t['to'] == to and t['type'] == type))
+
+    def settle(self, cut_off=()):
+        """Deliver messages, oldest first, until there are none left,
+        dropping those to or from the nodes in cut_off."""
+        for _ in range(10000):
+            messages = tuple(m for m in self.system.messages
+                             if m['to'] not in cut_off and m['from'] not in cut_off)
+            self.system = self.system._replace(messages=messages)
+            if not messages:
+                return
+            self.deliver(messages[0])
+        self.fail('Messages kept coming')
+
+    def commit_indices(self):
+        return dict((node, self.system.states[node]['commit_index']) for node in CLUSTER)
+
+    def test_election_and_replication(self):
+        self.timeout('S1', 'Election')
+        self.settle(cut_off=['S3'])
+        self.assertEqual('Leader', self.system.states['S1']['state'])
+        # The client's commands are committed by S1 and S2 alone
+        self.timeout('client', 'Command')
+        for _ in range(20):
+            self.settle(cut_off=['S3'])
+            self.timeout('S1', 'Heartbeat')
+        self.settle(cut_off=['S3'])
+        self.assertEqual(6, self.system.states['client']['n'])
+        leader_commit = self.system.states['S1']['commit_index']
+        self.assertEqual(leader_commit, self.system.states['S2']['commit_index'])
+        self.assertEqual(-1, self.system.states['S3']['commit_index'])
+        # S3 catches up a batch at a time, without waiting for heartbeats
+        # between batches
+        self.timeout('S1', 'Heartbeat')
+        self.settle()
+        self.timeout('S1', 'Heartbeat')
+        self.settle()
+        self.assertEqual(dict((node, leader_commit) for node in CLUSTER),
+                         self.commit_indices())
+        self.assertEqual(self.system.states['S1']['log'], self.system.states['S3']['log'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""Tests of the shim against a stand-in for the debugger.
+
+    python -m unittest test_shim
+"""
+
+import socket
+import threading
+import unittest
+import mcheckertest
+from cow import freeze
+from shim import HandlerReturn, Shim, recv, send
+
+
+class HandlerReturnTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = freeze({'log': [1], 'm': {'n': 0, 'inner': []}, 'keep': {'a': [1]}})
+
+    def test_change_in_place(self):
+        ret = HandlerReturn('A', self.state)
+        ret.get('log').append(2)
+        ret.get(['m'])['n'] += 1
+        ret.get('keep')
+        state = ret.state()
+        self.assertEqual(state, {'log': [1, 2], 'm': {'n': 1, 'inner': []}, 'keep': {'a': [1]}})
+        self.assertIs(state['keep'], self.state['keep'])
+        self.assertEqual(self.state['log'], [1])
+        self.assertEqual(ret.finalize()['state-updates'],
+                         [{'path': ['log'], 'value': [1, 2]},
+                          {'path': ['m'], 'value': {'n': 1, 'inner': []}}])
+        self.assertEqual(ret.footprint()['writes'], [['log'], ['m']])
+        self.assertRaises(TypeError, state['log'].append, 3)
+
+    def test_change_through_ret_ends_views(self):
+        ret = HandlerReturn('A', self.state)
+        log = ret.get('log')
+        log.append(2)
+        ret.append('log', 3)
+        log.append(4)
+        self.assertEqual(ret.state()['log'], [1, 2, 3])
+        self.assertEqual(ret.finalize()['state-updates'],
+                         [{'path': ['log'], 'value': [1, 2]},
+                          {'path': ['log'], 'op': 'append', 'values': [3]}])
+
+    def test_views_alias(self):
+        ret = HandlerReturn('A', self.state)
+        inner = ret.get(['m', 'inner'])
+        m = ret.get('m')
+        self.assertIs(m['inner'], inner)
+        self.assertIs(ret.get(['m', 'inner']), inner)
+        inner.append(1)
+        self.assertEqual(ret.state()['m'], {'n': 0, 'inner': [1]})
+
+    def test_read_only(self):
+        ret = HandlerReturn('A', self.state, read_only=True)
+        self.assertIs(ret.get('log'), self.state['log'])
+        self.assertRaises(TypeError, ret.get('log').append, 2)
+
+
+class MultiplexedShimTest(unittest.TestCase):
+
+    def setUp(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        self.shim = Shim(multiplex=True, rport=listener.getsockname()[1])
+        for n in range(mcheckertest.N_NODES):
+            self.shim.add_node(mcheckertest.Node, 'Node' + str(n))
+        self.thread = threading.Thread(target=self.shim.run)
+        self.thread.daemon = True
+        self.thread.start()
+        (self.sock, _) = listener.accept()
+        listener.close()
+        recv(self.sock)
+        send(self.sock, {'ok': True})
+
+    def tearDown(self):
+        send(self.sock, {'msgtype': 'quit'})
+        self.thread.join(10)
+        self.sock.close()
+
+    def deliver(self, event):
+        send(self.sock, event)
+        return recv(self.sock)
+
+    def test_restore(self):
+        self.deliver({'msgtype': 'start', 'to': 'Node1'})
+        started = self.deliver({'msgtype': 'start', 'to': 'Node0'})
+        ping = dict(started['send-messages'][0], msgtype='msg')
+        first = self.deliver(ping)
+        self.assertEqual({'ok': True},
+                         self.deliver({'msgtype': 'restore', 'state-id': started['state-id']}))
+        again = self.deliver(ping)
+        self.assertEqual(first['state-updates'], again['state-updates'])
+        self.assertEqual(first['fingerprint'], again['fingerprint'])
+        self.assertNotEqual(first['state-id'], again['state-id'])
+        self.assertEqual({'ok': False},
+                         self.deliver({'msgtype': 'restore', 'state-id': -1}))
+
+
+if __name__ == '__main__':
+    unittest.main()
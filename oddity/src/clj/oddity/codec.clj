@@ -0,0 +1,231 @@
+(ns oddity.codec
+  "Wire codecs for shim connections. Connections start out speaking JSON;
+  the register handshake can switch them to the compact binary codec,
+  which is described in examples/python/codec.py, and have them send large
+  message bodies by reference."
+  (:require [clojure.data.json :as json])
+  (:import (java.io ByteArrayOutputStream DataOutputStream)
+           (java.nio ByteBuffer)
+           (java.nio.charset StandardCharsets)))
+
+(def ^:const NULL 0)
+(def ^:const FALSE 1)
+(def ^:const TRUE 2)
+(def ^:const INT32 3)
+(def ^:const INT64 4)
+(def ^:const FLOAT64 5)
+(def ^:const STRING 6)
+(def ^:const DEFINE 7)
+(def ^:const REF 8)
+(def ^:const LIST 9)
+(def ^:const MAP 10)
+
+(def MAX-INTERNED-LENGTH 64)
+(def MAX-TABLE-SIZE 65536)
+
+(defn- utf8-bytes ^bytes [^String s]
+  (.getBytes s StandardCharsets/UTF_8))
+
+(defn- read-utf8 [^ByteBuffer buf n]
+  (let [bs (byte-array n)]
+    (.get buf bs)
+    (String. bs StandardCharsets/UTF_8)))
+
+(defn- buffer-bytes ^bytes [^ByteBuffer buf]
+  (let [bs (byte-array (.remaining buf))]
+    (.get buf bs)
+    bs))
+
+(def json-codec
+  {:name "json"
+   :encode (fn [v] (utf8-bytes (json/write-str v)))
+   :decode (fn [^ByteBuffer buf] (json/read-str (String. (buffer-bytes buf) StandardCharsets/UTF_8)))})
+
+(defn- key-string [k]
+  (cond
+    (string? k) k
+    (keyword? k) (name k)
+    :else (json/write-str k)))
+
+(defn- write-string [^DataOutputStream out sent ^String s]
+  (if-let [i (get @sent s)]
+    (do (.writeByte out (int REF))
+        (.writeShort out (int i)))
+    (let [bs (utf8-bytes s)]
+      (if (and (<= (alength bs) MAX-INTERNED-LENGTH)
+               (< (count @sent) MAX-TABLE-SIZE))
+        (do (swap! sent assoc s (count @sent))
+            (.writeByte out (int DEFINE))
+            (.writeShort out (int (alength bs))))
+        (do (.writeByte out (int STRING))
+            (.writeInt out (int (alength bs)))))
+      (.write out bs 0 (alength bs)))))
+
+(defn- write-value [^DataOutputStream out sent v]
+  (cond
+    (nil? v) (.writeByte out (int NULL))
+    (true? v) (.writeByte out (int TRUE))
+    (false? v) (.writeByte out (int FALSE))
+    (string? v) (write-string out sent v)
+    (keyword? v) (write-string out sent (name v))
+    (map? v) (do (.writeByte out (int MAP))
+                 (.writeInt out (int (count v)))
+                 (doseq [[k child] v]
+                   (write-string out sent (key-string k))
+                   (write-value out sent child)))
+    (or (sequential? v) (set? v)) (do (.writeByte out (int LIST))
+                                      (.writeInt out (int (count v)))
+                                      (doseq [child v]
+                                        (write-value out sent child)))
+    (integer? v) (if (<= Integer/MIN_VALUE v Integer/MAX_VALUE)
+                   (do (.writeByte out (int INT32))
+                       (.writeInt out (int v)))
+                   (do (.writeByte out (int INT64))
+                       (.writeLong out (long v))))
+    (number? v) (do (.writeByte out (int FLOAT64))
+                    (.writeDouble out (double v)))
+    :else (write-string out sent (str v))))
+
+(defn- read-value [^ByteBuffer buf received]
+  (let [tag (.get buf)]
+    (case (int tag)
+      0 nil
+      1 false
+      2 true
+      3 (long (.getInt buf))
+      4 (.getLong buf)
+      5 (.getDouble buf)
+      6 (read-utf8 buf (.getInt buf))
+      7 (let [s (read-utf8 buf (bit-and (.getShort buf) 0xffff))]
+          (swap! received conj s)
+          s)
+      8 (nth @received (bit-and (.getShort buf) 0xffff))
+      9 (let [n (.getInt buf)]
+          (loop [i 0 acc (transient [])]
+            (if (< i n)
+              (recur (inc i) (conj! acc (read-value buf received)))
+              (persistent! acc))))
+      10 (let [n (.getInt buf)]
+           (loop [i 0 acc (transient {})]
+             (if (< i n)
+               (let [k (read-value buf received)
+                     v (read-value buf received)]
+                 (recur (inc i) (assoc! acc k v)))
+               (persistent! acc))))
+      (throw (IllegalArgumentException. (str "Unknown tag " tag))))))
+
+(defn binary-codec
+  "A binary codec for one connection; it keeps the tables of strings
+  interned in each direction."
+  []
+  (let [sent (atom {})
+        received (atom [])]
+    {:name "binary"
+     :encode (fn [v]
+               (let [bytes (ByteArrayOutputStream.)]
+                 (write-value (DataOutputStream. bytes) sent v)
+                 (.toByteArray bytes)))
+     :decode (fn [^ByteBuffer buf] (read-value buf received))}))
+
+(def codecs {"json" (constantly json-codec)
+             "binary" binary-codec})
+
+(defn choose-codec
+  "The first of the codecs a shim asked for that we support."
+  [names]
+  (first (filter #(contains? codecs %) names)))
+
+;; Content-addressed message bodies, described in examples/python/bodies.py.
+;; A session's connections share one body cache: the bodies its shims have
+;; defined, by fingerprint, and the fingerprint of each body. A body stays
+;; until the shim releases it, however often its messages are delivered, so
+;; the states the debugger goes back to can deliver them again by reference.
+
+(defn body-cache []
+  (atom {:bodies {} :fingerprints {}}))
+
+(defn- resolve-message [cache m]
+  (if-let [fp (get m "body-ref")]
+    (let [body (get-in @cache [:bodies fp] ::unknown)]
+      (when (= body ::unknown)
+        (throw (IllegalStateException. (str "Unknown body " fp))))
+      (-> m (dissoc "body-ref") (assoc "body" body)))
+    m))
+
+(defn- resolve-response [cache resp]
+  (if (seq (get resp "send-messages"))
+    (update resp "send-messages" #(mapv (partial resolve-message cache) %))
+    resp))
+
+(defn resolve-bodies
+  "A frame from a shim with the bodies it refers to filled in, after
+  dropping the bodies it releases from cache and adding the ones it
+  defines."
+  [cache frame]
+  (if-not (map? frame)
+    frame
+    (locking cache
+      (doseq [fp (get frame "released")]
+        (swap! cache #(-> %
+                          (update :fingerprints dissoc (get-in % [:bodies fp]))
+                          (update :bodies dissoc fp))))
+      (doseq [[fp body] (get frame "bodies")]
+        (swap! cache #(-> %
+                          (assoc-in [:bodies fp] body)
+                          (assoc-in [:fingerprints body] fp))))
+      (cond-> (resolve-response cache (dissoc frame "bodies" "released"))
+        (contains? frame "responses")
+        (update "responses" #(mapv (partial resolve-response cache) %))))))
+
+(defn- refer-event [cache event]
+  (let [body (get event "body")
+        fp (when (= "msg" (get event "msgtype"))
+             (get-in @cache [:fingerprints body]))]
+    (if (nil? fp)
+      event
+      (-> event (dissoc "body") (assoc "body-ref" fp)))))
+
+(defn refer-bodies
+  "A frame for a shim with the bodies in cache replaced by references to
+  them."
+  [cache frame]
+  (if-not (map? frame)
+    frame
+    (cond-> (refer-event cache frame)
+      (contains? frame :events)
+      (update :events #(mapv (partial refer-event cache) %)))))
+
+(defn connection-codec
+  "Codec state for a new connection: one codec for decoding and one for
+  encoding, both JSON to begin with."
+  []
+  (atom {:decode json-codec :encode json-codec}))
+
+(defn enable-bodies!
+  "Have a connection refer to message bodies through cache, the body cache
+  of its session."
+  [conn-codec cache]
+  (swap! conn-codec assoc :bodies cache))
+
+(defn encode [conn-codec msg]
+  (let [cache (:bodies @conn-codec)
+        bytes ((:encode (:encode @conn-codec)) (if cache (refer-bodies cache msg) msg))]
+    ;; A message can switch the encoder, but only for the messages after it
+    (when-let [next-codec (::switch-to (meta msg))]
+      (swap! conn-codec assoc :encode next-codec))
+    (ByteBuffer/wrap bytes)))
+
+(defn decode [conn-codec ^ByteBuffer buf]
+  (let [msg ((:decode (:decode @conn-codec)) buf)]
+    (if-let [cache (:bodies @conn-codec)]
+      (resolve-bodies cache msg)
+      msg)))
+
+(defn switch-codec
+  "Switch a connection to the named codec: incoming frames are decoded
+  with it from now on, and outgoing frames once reply has been sent.
+  Returns reply, marked to make the switch."
+  [conn-codec codec-name reply]
+  (let [codec ((get codecs codec-name))]
+    (swap! conn-codec assoc :decode codec)
+    (vary-meta reply assoc ::switch-to codec)))
@@ -14,6 +14,7 @@
             [oddity.modelchecker :as mc]
             [oddity.dsmodelchecker :as dsmc]
             [oddity.coerce :as coerce]
+            [oddity.codec :as codec]
             [clojure.walk :refer [stringify-keys]]
             [taoensso.tufte :refer [p]])
   (:import (java.util.concurrent TimeoutException TimeUnit FutureTask)))
@@ -22,26 +23,26 @@
 
 (def protocol
   (gloss/compile-frame
-    (gloss/finite-frame :uint32
-      (gloss/string :utf-8))
-    json/write-str
-    json/read-str))
+    (gloss/finite-block :uint32)))
 
 (defn wrap-duplex-stream
-  [protocol s]
+  [protocol conn-codec s]
   (let [out (s/stream)]
     (s/connect
-      (s/map #(io/encode protocol %) out)
+      (s/map #(io/encode protocol (codec/encode conn-codec %)) out)
       s)
     (s/splice
       out
-      (io/decode-stream s protocol))))
+      (s/map #(codec/decode conn-codec (io/contiguous %))
+             (io/decode-stream s protocol)))))
 
 (defn start-tcp-server
   [handler port & args]
   (tcp/start-server
    (fn [s info]
-     (apply handler (wrap-duplex-stream protocol s) info args))
+     (let [conn-codec (codec/connection-codec)]
+       (apply handler (wrap-duplex-stream protocol conn-codec s)
+              (assoc info :codec conn-codec) args)))
     {:port port}))
 
 (defn register [s info st]
@@ -55,7 +56,24 @@
             (when-let [names (get m "names")]
               (doseq [name names]
                 (swap! st assoc-in [:sessions id :sockets name] s)))
-            (s/put! s {:ok true}))))))
+            (when-let [groups (get m "symmetry")]
+              (swap! st assoc-in [:sessions id :symmetry] groups))
+            (when-let [addresses (get m "addresses")]
+              (swap! st assoc-in [:sessions id :addresses] addresses))
+            (when (get m "batch")
+              (doseq [name (or (get m "names") [(get m "name")])]
+                (swap! st assoc-in [:sessions id :batch name] true)))
+            (when (contains? m "replica-of")
+              (let [original (or (get m "replica-of") DEFAULT_ID)]
+                (swap! st assoc-in [:sessions id :replica-of] original)
+                (swap! st update-in [:sessions original :replicas] (fnil conj #{}) id)))
+            (when (get m "bodies")
+              (let [sessions (swap! st update-in [:sessions id :bodies] #(or % (codec/body-cache)))]
+                (codec/enable-bodies! (:codec info) (get-in sessions [:sessions id :bodies]))))
+            (let [reply (if (get m "bodies") {:ok true :bodies true} {:ok true})]
+              (if-let [c (codec/choose-codec (get m "codecs"))]
+                (s/put! s (codec/switch-codec (:codec info) c (assoc reply :codec c)))
+                (s/put! s reply))))))))
 
 (defn quit-all-sessions [st]
   (doseq [[id session] (get @st :sessions)
@@ -94,62 +112,192 @@
   {:responses returns})
 
 (defn send-start [dbg id]
-  (combine-returns (doall
-                    (map ; TODO: use pmap and disallow multiple nodes w/ same socket
-                     (fn [[server socket]]
-                       (do 
-                         (s/put! socket {:msgtype "start" :to server})
-                         [server @(s/take! socket)]))
-                     (get-in (st dbg) [:sessions id :sockets])))))
+  ;; When all the nodes are behind one socket (a multiplexed or pooled
+  ;; shim), send every start before waiting for any reply, so a pooled shim
+  ;; starts its nodes in parallel. The socket replies in the order it was
+  ;; sent to, and the state id of the last reply has every start in it.
+  ;; Nodes on sockets of their own record their states into one store from
+  ;; threads of their own, so they are started one at a time: otherwise the
+  ;; last reply's state id could be from before another node started.
+  (let [sockets (get-in (st dbg) [:sessions id :sockets])]
+    (combine-returns
+     (if (<= (count (distinct (vals sockets))) 1)
+       (do (doseq [[server socket] sockets]
+             (s/put! socket {:msgtype "start" :to server}))
+           (doall (map (fn [[server socket]]
+                         [server @(s/take! socket)])
+                       sockets)))
+       (doall (map (fn [[server socket]]
+                     (s/put! socket {:msgtype "start" :to server})
+                     [server @(s/take! socket)])
+                   sockets))))))
+
+(defn send-batch
+  "Send msgs in order to the nodes of session id. The messages for each
+  socket go in a single batch message if its shim understands them, and the
+  sockets are sent to one after another. Returns the responses in the
+  order of msgs, and the state id in the last response received."
+  [dbg id msgs]
+  (let [session (get-in (st dbg) [:sessions id])
+        by-socket (group-by #(get-in session [:sockets (get (second %) "to")])
+                            (map-indexed vector msgs))
+        responses (reduce
+                   (fn [responses [socket indexed]]
+                     (let [msgs (map second indexed)
+                           results (if (get-in session [:batch (get (first msgs) "to")])
+                                     (do (s/put! socket {:msgtype "batch" :events msgs})
+                                         (get @(s/take! socket) "responses"))
+                                     (doall (for [msg msgs]
+                                              (do (s/put! socket msg)
+                                                  @(s/take! socket)))))]
+                       (into responses (map vector (map first indexed) results))))
+                   []
+                   by-socket)]
+    {:responses (mapv second (sort-by first responses))
+     :state-id (get (second (peek responses)) "state-id")}))
 
 (defn send-reset [dbg id log]
   (send-start dbg id)
-  (doseq [msg (rest log)]
-    (if (contains? msg "to")
-      (let [socket (get-in (st dbg) [:sessions id :sockets (get msg "to")])]
-        (s/put! socket msg)
-        @(s/take! socket))))
+  (send-batch dbg id (filter #(contains? % "to") (rest log)))
   {:ok true})
 
+(defn send-restore [dbg id state-id]
+  (every? (fn [socket]
+            (s/put! socket {:msgtype "restore" :state-id state-id})
+            (get @(s/take! socket) "ok"))
+          (distinct (vals (get-in (st dbg) [:sessions id :sockets])))))
+
 (defn quit [dbg] (quit-all-sessions (:state dbg)))
 
-(defn model-checker-state-for [dbg id prefix]
-  (dsmc/make-dsstate 
-   (reify dsmc/ISystemControl
-     (send-message! [this message]
-       (send-message dbg (assoc (stringify-keys message) "id" id)))
-     (restart-system! [this] (send-start dbg id)))
-   prefix))
+(defn model-checker-state-for
+  "A model checker state for session id. Once stopped is true, talking to
+  the system throws instead, so a search stops between one reply and the
+  next request and leaves nothing unread on the session's sockets."
+  ([dbg id prefix] (model-checker-state-for dbg id prefix (atom false)))
+  ([dbg id prefix stopped]
+   (let [check-stopped (fn [] (when @stopped
+                                (throw (ex-info "Model checker stopped" {:id id}))))]
+     (dsmc/make-dsstate
+      (reify dsmc/ISystemControl
+        (send-message! [this message]
+          (check-stopped)
+          (send-message dbg (assoc (stringify-keys message) "id" id)))
+        (restart-system! [this]
+          (check-stopped)
+          (send-start dbg id))
+        (restore-system! [this state-id]
+          (check-stopped)
+          (send-restore dbg id state-id))
+        dsmc/IBatchControl
+        (send-batch! [this messages]
+          (check-stopped)
+          (send-batch dbg id (map stringify-keys messages)))
+        dsmc/ISymmetricSystem
+        (symmetry-groups [this] (get-in (st dbg) [:sessions id :symmetry]))
+        (address-fields [this] (get-in (st dbg) [:sessions id :addresses])))
+      prefix))))
 
-(defn run-model-checker [dbg id prefix pred opts]
-  (let [st (model-checker-state-for dbg id prefix)
-        max-depth (get opts :max-depth 24)
+(defn- trace-messages [trace]
+  (map #(or (:deliver-timeout %) (:deliver-message %)) trace))
+
+(defn- start-task [f]
+  (let [task (FutureTask. f)]
+    (.start (Thread. task))
+    task))
+
+(defn- await-task
+  "Waits up to timeout for a task that has been told to stop to finish the
+  step it is on, and interrupts it if it hasn't by then."
+  [^FutureTask task timeout]
+  (try
+    (.get task timeout TimeUnit/MILLISECONDS)
+    (catch TimeoutException e
+      (.cancel task true))
+    (catch Exception e
+      nil)))
+
+(defn run-parallel-model-checker
+  "Splits the search across the sessions ids, which run copies of the
+  same system: the states a few actions in are divided between them, and
+  each session searches on from its share."
+  [dbg ids prefix pred opts]
+  (let [max-depth (get opts :max-depth 24)
         delta-depth (get opts :delta-depth 6)
         timeout (get opts :timeout 10000)
-        thunk (bound-fn [] (mc/dfs st pred max-depth delta-depth))
-        task (FutureTask. thunk)
-        thr (Thread. task)]
-    (try
-      (.start thr)
-      (let [res (.get task timeout TimeUnit/MILLISECONDS)]
-        (mc/restart! st)
-        {:ok true :trace (:trace res)})
-      (catch TimeoutException e
-        (.cancel task true)
-        (.stop thr)
-        (mc/restart! st)
-        {:ok false :error "Timeout"})
-      (catch Exception e
-        (.cancel task true)
-        (.stop thr)
-        (mc/restart! st)
-        {:ok false :error (.str e)}))))
+        stopped (atom false)
+        state-for (fn [id trace]
+                    (model-checker-state-for dbg id (into (vec prefix) (trace-messages trace))
+                                             stopped))
+        result (promise)
+        tasks (atom [])
+        search (fn [id traces remaining]
+                 (bound-fn []
+                   (try
+                     (let [res (mc/dfs-frontier #(state-for id %) traces pred max-depth delta-depth)]
+                       (when (or (= (:result res) :found) (zero? (swap! remaining dec)))
+                         (deliver result res)))
+                     (catch Exception e
+                       (deliver result {:error (str e)})))))
+        split (bound-fn []
+                (try
+                  (let [res (mc/split-frontier (state-for (first ids) []) pred (count ids) max-depth)
+                        frontier (:frontier res)
+                        remaining (atom (count ids))]
+                    (if frontier
+                      (doseq [[i id] (map-indexed vector ids)]
+                        (swap! tasks conj
+                               (start-task (search id (take-nth (count ids) (drop i frontier))
+                                                   remaining))))
+                      (deliver result res)))
+                  (catch Exception e
+                    (deliver result {:error (str e)}))))]
+    (let [split-task (start-task split)
+          res (deref result timeout ::timeout)]
+      ;; Replicas stop between steps rather than being killed mid-step, so
+      ;; no session is left with a reply that its next request would read.
+      ;; The split starts the searches, so once it is done they all have
+      (reset! stopped true)
+      (await-task split-task timeout)
+      (doseq [task @tasks]
+        (await-task task timeout))
+      (mc/restart! (model-checker-state-for dbg (first ids) prefix))
+      (cond
+        (= res ::timeout) {:ok false :error "Timeout"}
+        (:error res) {:ok false :error (:error res)}
+        :else {:ok true :trace (:trace res)}))))
+
+(defn run-model-checker [dbg id prefix pred opts]
+  (if-let [replicas (seq (get-in (st dbg) [:sessions id :replicas]))]
+    (run-parallel-model-checker dbg (cons id (sort replicas)) prefix pred opts)
+    (let [st (model-checker-state-for dbg id prefix)
+          max-depth (get opts :max-depth 24)
+          delta-depth (get opts :delta-depth 6)
+          timeout (get opts :timeout 10000)
+          thunk (bound-fn [] (mc/dfs st pred max-depth delta-depth))
+          task (FutureTask. thunk)
+          thr (Thread. task)]
+      (try
+        (.start thr)
+        (let [res (.get task timeout TimeUnit/MILLISECONDS)]
+          (mc/restart! st)
+          {:ok true :trace (:trace res)})
+        (catch TimeoutException e
+          (.cancel task true)
+          (.stop thr)
+          (mc/restart! st)
+          {:ok false :error "Timeout"})
+        (catch Exception e
+          (.cancel task true)
+          (.stop thr)
+          (mc/restart! st)
+          {:ok false :error (.str e)})))))
 
 (defn handle-debug-msg [dbg msg]
   (let [msg (json/read-str msg)
         resp (cond
                (= "servers" (get msg "msgtype"))
-               (into {} (for [[id s] (:sessions (st dbg))]
+               (into {} (for [[id s] (:sessions (st dbg))
+                              :when (not (contains? s :replica-of))]
                           [id {:servers (sort (keys (get s :sockets))) :trace (get s :trace)}]))
                (= "start" (get msg "msgtype")) (send-start dbg (get msg "id"))
                (= "reset" (get msg "msgtype")) (send-reset dbg (get msg "id") (get msg "log"))
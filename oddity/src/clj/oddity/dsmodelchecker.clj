@@ -1,25 +1,51 @@
 (ns oddity.dsmodelchecker
   (:require
-   [oddity.modelchecker :refer [IState dfs restart!]]
-   [oddity.util :refer [remove-one]]
+   [oddity.modelchecker :refer [IState IRestorable IFingerprinted IIndependent ISymmetric
+                                dfs restart!]]
+   [oddity.util :as util :refer [remove-one]]
    [oddity.coerce :as c]
-   [clojure.walk :refer [keywordize-keys]]
+   [clojure.walk :refer [keywordize-keys postwalk]]
+   [clojure.string :as str]
+   [clojure.data.json :as json]
    [taoensso.tufte :as tufte :refer [p]]))
 
 (defprotocol ISystemControl
   (send-message! [this message] "Send a message. Returns the result.")
-  (restart-system! [this] "Restart the system. Returns a list of results."))
+  (restart-system! [this] "Restart the system. Returns a list of results.")
+  (restore-system! [this state-id] "Restore the system to the state reported
+  with state-id. Returns true if the system still had that state."))
 
-(defn apply-state-update [state update]
-  (let [{path :path value :value} update]
-    (assoc-in state path value)))
+(defprotocol IBatchControl
+  (send-batch! [this messages] "Send messages in order, in as few round
+  trips as possible. Returns {:responses results :state-id id}, with the
+  results in the order of messages and id the state id of the system once
+  they have all been handled."))
 
-(defn apply-state-change [{current-states :states :keys [timeouts messages]} body delta]
+(defprotocol ISymmetricSystem
+  (symmetry-groups [this] "Lists of the names of the nodes that are
+  interchangeable, as declared by the shim (see
+  examples/python/symmetry.py).")
+  (address-fields [this] "The fields of states and message bodies that
+  hold node names, as declared by the shim."))
+
+(defn send-messages!
+  "Send messages in order, as a batch if sys supports it."
+  [sys messages]
+  (if (satisfies? IBatchControl sys)
+    (send-batch! sys messages)
+    (let [responses (mapv #(send-message! sys %) messages)]
+      {:responses responses
+       :state-id (:state-id (c/coerce-response (peek responses)))})))
+
+(def apply-state-update util/apply-state-update)
+
+(defn apply-state-change [{current-states :states :keys [timeouts messages fingerprints]} body delta]
   (let [node-id (:to body)
         messages (if (= (:msgtype body) "msg")
                    (vec (remove-one #(= % body) messages))
                    messages)
-        {:keys [cleared-timeouts set-timeouts send-messages state-updates state-id states]} delta
+        {:keys [cleared-timeouts set-timeouts send-messages state-updates state-id states
+                fingerprint]} delta
         cleared-timeouts (filter #(= (:to %) node-id) cleared-timeouts)
         set-timeouts (filter #(= (:to %) node-id) set-timeouts)
         send-messages (filter #(= (:from %) node-id) send-messages)
@@ -30,7 +56,8 @@
                (assoc current-states node-id (get states node-id))
                (assoc current-states node-id
                       (reduce apply-state-update state state-updates)))
-     :state-id state-id}))
+     :state-id state-id
+     :fingerprints (assoc fingerprints node-id fingerprint)}))
 
 (defn new-state [restart-response]
   (let [deltas (:responses restart-response)]
@@ -65,6 +92,41 @@
               (<= (action-priority a1 node) (action-priority a2 node))))
           actions)))
 
+(defn- overlap?
+  "Is one of paths a prefix of one of others, or the other way round?"
+  [paths others]
+  (some (fn [p]
+          (some (fn [q]
+                  (let [n (min (count p) (count q))]
+                    (= (take n p) (take n q))))
+                others))
+        paths))
+
+(defn- clears?
+  "Did the handler that did step clear message, or a timeout set by the
+  handler that did other?"
+  [step message other]
+  (let [cleared (set (map (juxt :type :body) (:cleared-timeouts step)))]
+    (or (and (timeout? message) (contains? cleared [(:type message) (:body message)]))
+        (some #(contains? cleared [(:type %) (:body %)]) (:set-timeouts other)))))
+
+(defn independent-steps?
+  "Do messages or timeouts a and b commute, given what their handlers did
+  (step-a and step-b, their responses) when each was delivered in the same
+  state? Messages and timeouts for different nodes always do; those for
+  the same node do if the footprints of their handlers don't overlap.
+  Mirrors independent in examples/python/explore.py."
+  [a step-a b step-b]
+  (or (not= (:to a) (:to b))
+      (let [fa (:footprint step-a)
+            fb (:footprint step-b)]
+        (boolean
+         (and (some? fa) (some? fb)
+              (not (overlap? (:writes fa) (concat (:reads fb) (:writes fb))))
+              (not (overlap? (:writes fb) (:reads fa)))
+              (not (clears? step-a b step-b))
+              (not (clears? step-b a step-a)))))))
+
 (defn state-matches? [pred state]
   (case (:type pred)
     :node-state
@@ -72,19 +134,203 @@
           node-state (get-in state [:states node-id])]
       (= (get-in node-state (:path pred)) (:value pred)))))
 
-(defrecord DSState [sys prefix state]
+(defn system-fingerprint
+  "Identifies a system state by its nodes' state fingerprints and the
+  messages and timeouts in flight, in any order. nil unless every node
+  reported a fingerprint."
+  [{:keys [states messages timeouts fingerprints]}]
+  (when (and (seq states) (every? #(some? (get fingerprints %)) (keys states)))
+    [fingerprints (frequencies messages) (frequencies timeouts)]))
+
+(defn- permutations [xs]
+  (if (empty? xs)
+    [[]]
+    (for [x xs
+          perm (permutations (remove #{x} xs))]
+      (cons x perm))))
+
+(defn renamings
+  "Every renaming of the nodes in groups that only swaps nodes within a
+  group, as a map from old name to new name; the identity first."
+  [groups]
+  (reduce (fn [renamings group]
+            (for [renaming renamings
+                  perm (permutations group)]
+              (merge renaming (zipmap group perm))))
+          [{}] groups))
+
+;; Renaming follows the same rules as examples/python/symmetry.py: node
+;; names are renamed in from, to, the states map's keys, and address
+;; fields, and nowhere else.
+
+(declare rename)
+
+(defn- rename-address [x renaming addresses]
+  (cond
+    (string? x) (get renaming x x)
+    (map? x) (into {} (for [[k v] x]
+                        [(if (string? k) (get renaming k k) k) (rename v renaming addresses)]))
+    (sequential? x) (mapv #(rename-address % renaming addresses) x)
+    :else x))
+
+(defn rename
+  "x with the node names in its address fields renamed by renaming."
+  [x renaming addresses]
+  (cond
+    (map? x) (into {} (for [[k v] x]
+                        [k (if (contains? addresses k)
+                             (rename-address v renaming addresses)
+                             (rename v renaming addresses))]))
+    (sequential? x) (mapv #(rename % renaming addresses) x)
+    :else x))
+
+(defn rename-event
+  "The message or timeout event with its from, to and body renamed."
+  [event renaming addresses]
+  (cond-> event
+    (contains? event :from) (update :from #(get renaming % %))
+    (contains? event :to) (update :to #(get renaming % %))
+    (contains? event :body) (update :body rename renaming addresses)))
+
+(defn- rename-system [{:keys [states messages timeouts]} renaming addresses]
+  [(into {} (for [[node state] states]
+              [(get renaming node node) (rename state renaming addresses)]))
+   (map #(rename-event % renaming addresses) messages)
+   (map #(rename-event % renaming addresses) timeouts)])
+
+(defn- sorted-json
+  "x as JSON with the keys of its maps in order, as Python's json.dumps
+  writes it with sort_keys and no spaces. The two agree on strings,
+  integers, booleans and null, but not on floats."
+  [x]
+  (json/write-str (postwalk #(if (map? %) (into (sorted-map-by (fn [a b] (compare (name a) (name b)))) %) %)
+                            x)
+                  :escape-slash false))
+
+(defn- events-json [events]
+  (str/join "," (sort (map #(sorted-json (select-keys % [:from :to :type :body])) events))))
+
+(defn- system-order
+  "A string to compare system states by, the same as symmetry.py compares
+  them: the node states, then the messages and timeouts in flight, sorted,
+  all as sorted JSON."
+  [states messages timeouts]
+  (str "[" (sorted-json states) ",[" (events-json messages) "],[" (events-json timeouts) "]]"))
+
+(declare abstract)
+
+(defn- abstract-address [x abstraction addresses]
+  (cond
+    ;; Abstracted names can collide, so keep every entry, in order
+    (map? x) (sort-by sorted-json (for [[k v] x]
+                                    [(if (string? k) (get abstraction k k) k)
+                                     (abstract v abstraction addresses)]))
+    (sequential? x) (mapv #(abstract-address % abstraction addresses) x)
+    :else (rename-address x abstraction addresses)))
+
+(defn- abstract
+  "x renamed by abstraction, with maps keyed by addresses as sorted lists of
+  their entries."
+  [x abstraction addresses]
+  (cond
+    (map? x) (into {} (for [[k v] x]
+                        [k (if (contains? addresses k)
+                             (abstract-address v abstraction addresses)
+                             (abstract v abstraction addresses))]))
+    (sequential? x) (mapv #(abstract % abstraction addresses) x)
+    :else x))
+
+(defn- abstract-event [event abstraction addresses]
+  (cond-> event
+    (contains? event :from) (update :from #(get abstraction % %))
+    (contains? event :to) (update :to #(get abstraction % %))
+    (contains? event :body) (update :body abstract abstraction addresses)))
+
+(defn signature
+  "What node is in a system state regardless of the names of the nodes in
+  groups, as JSON. Mirrors signature in examples/python/symmetry.py."
+  [{:keys [states messages timeouts]} node groups addresses]
+  (let [abstraction (assoc (into {} (for [[i group] (map-indexed vector groups)
+                                          name group]
+                                      [name (str "@" i)]))
+                           node "@self")
+        events (fn [es] (events-json (map #(abstract-event % abstraction addresses) es)))]
+    (str "[" (sorted-json (abstract (get states node) abstraction addresses))
+         ",[" (events (filter #(= node (:to %)) messages))
+         "],[" (events (filter #(= node (:from %)) messages))
+         "],[" (events (filter #(= node (:to %)) timeouts)) "]]")))
+
+(defn- candidates
+  "The renamings that sort each group by signature, ties every way."
+  [state groups addresses]
+  (let [sorted-groups (for [group groups]
+                        (let [signatures (into {} (for [node group]
+                                                    [node (signature state node groups addresses)]))
+                              ordered (sort-by signatures group)
+                              names (sort group)]
+                          {:renaming (zipmap ordered names)
+                           :ties (->> (map vector (map signatures ordered) names)
+                                      (partition-by first)
+                                      (map #(map second %))
+                                      (filter next))}))
+        renaming (apply merge {} (map :renaming sorted-groups))]
+    (for [swaps (renamings (mapcat :ties sorted-groups))]
+      (into {} (for [[old new] renaming] [old (get swaps new new)])))))
+
+(defn canonical-fingerprint
+  "Identifies a system state together with the states that only differ
+  from it by swapping nodes within groups: its canonical renaming, as
+  system-fingerprint would see it but with the node states themselves
+  instead of their fingerprints. Of the renamings that sort each group by
+  signature, the one that comes first by system-order; only the renamings
+  of nodes that tie by signature are serialized to find it. Returns
+  [fingerprint renaming]. Mirrors canonical in examples/python/symmetry.py,
+  which picks the same renaming."
+  [state groups addresses]
+  (let [addresses (set addresses)
+        options (candidates state groups addresses)
+        renamed (for [renaming options]
+                  (let [[states messages timeouts] (rename-system state renaming addresses)]
+                    {:order (when (next options) (system-order states messages timeouts))
+                     :fingerprint [states (frequencies messages) (frequencies timeouts)]
+                     :renaming renaming}))
+        ;; Renamings that order the same give the same state, so the first wins
+        best (reduce #(if (neg? (compare (:order %2) (:order %1))) %2 %1) renamed)]
+    [(:fingerprint best) (:renaming best)]))
+
+(defn- with-canonical-fingerprint
+  "state, with its canonical fingerprint if sys has symmetry groups."
+  [sys state]
+  (if-let [groups (and (satisfies? ISymmetricSystem sys) (seq (symmetry-groups sys)))]
+    (let [[fp renaming] (canonical-fingerprint state groups (address-fields sys))]
+      (assoc state :canonical {:fingerprint fp :renaming renaming}))
+    state))
+
+(defn initial-state [sys prefix]
+  (let [init-state (new-state (c/coerce-responses
+                               (p :restart-system! (restart-system! sys))))
+        prefix (map #(dissoc (c/coerce-message-or-timeout %) :state-id) prefix)]
+    (if (empty? prefix)
+      init-state
+      (let [{:keys [responses state-id]} (p :restart-send-messages!
+                                            (send-messages! sys prefix))]
+        (assoc (reduce (fn [st [m response]]
+                         (apply-state-change st m (c/coerce-response response)))
+                       init-state (map vector prefix responses))
+               :state-id state-id)))))
+
+(defn state-unavailable? [response]
+  (false? (get response "ok" (get response :ok))))
+
+(defrecord DSState [sys prefix init trace state]
   IState
   (restart! [this]
     (p :restart! 
-       (let [init-state (new-state (c/coerce-responses
-                                    (p :restart-system! (restart-system! sys))))
-             prefix-state (reduce
-                           (fn [st m]
-                             (apply-state-change st m (c/coerce-response
-                                                       (p :restart-send-message!
-                                                          (send-message! sys m)))))
-                           init-state (map c/coerce-message-or-timeout prefix))]
-         (->DSState sys prefix prefix-state))))
+       (let [init (if (and (:state-id init)
+                           (p :restore-system! (restore-system! sys (:state-id init))))
+                    init
+                    (initial-state sys prefix))]
+         (->DSState sys prefix init [] init))))
   (actions [this pred]
     (p :actions 
        (let [timeout-actions (map (fn [t] {:deliver-timeout t})
@@ -95,13 +341,42 @@
          actions)))
   (run-action! [this action]
     (p :run-action 
-       (let [action (or (:deliver-timeout action) (:deliver-message action))
-             response (c/coerce-response (send-message! sys (assoc action :state-id (:state-id state))))
-             state (apply-state-change state action response)]
-         (->DSState sys prefix state))))
+       (let [message (or (:deliver-timeout action) (:deliver-message action))
+             response (send-message! sys (assoc message :state-id (:state-id state)))]
+         (if (state-unavailable? response)
+           ;; The system has forgotten this state, so rebuild it by replaying
+           (run-action! (reduce run-action! (restart! this) trace) action)
+           (let [response (c/coerce-response response)]
+             (->DSState sys prefix init (conj trace action)
+                        (assoc (with-canonical-fingerprint
+                                 sys (apply-state-change state message response))
+                               :last-step (select-keys response [:footprint :cleared-timeouts
+                                                                 :set-timeouts]))))))))
   (matches? [this pred]
     (p :matches? 
-       (state-matches? pred state))))
+       (state-matches? pred state)))
+  IRestorable
+  (restorable? [this]
+    (some? (:state-id state)))
+  IFingerprinted
+  (fingerprint [this]
+    (if-let [{fp :fingerprint} (:canonical state)]
+      fp
+      (system-fingerprint state)))
+  IIndependent
+  (last-step [this]
+    (:last-step state))
+  (independent? [this a step-a b step-b]
+    (independent-steps? (or (:deliver-timeout a) (:deliver-message a)) step-a
+                        (or (:deliver-timeout b) (:deliver-message b)) step-b))
+  ISymmetric
+  (canonical-action [this action]
+    (if-let [{:keys [renaming]} (:canonical state)]
+      (let [addresses (set (address-fields sys))]
+        (cond-> action
+          (:deliver-message action) (update :deliver-message rename-event renaming addresses)
+          (:deliver-timeout action) (update :deliver-timeout rename-event renaming addresses)))
+      action)))
 
 (defn make-dsstate [sys prefix]
-  (restart! (->DSState sys prefix nil)))
+  (restart! (->DSState sys prefix nil [] nil)))
@@ -9,54 +9,213 @@
   (run-action! [this action] "Run action")
   (matches? [this pred] "Does this state match a predicate?"))
 
+(defprotocol IRestorable
+  (restorable? [this] "Can actions still be run from this state after other
+  states have been explored? If so, the model checker backtracks to it
+  directly instead of restarting and replaying its trace."))
+
+(defprotocol IFingerprinted
+  (fingerprint [this] "A value that is equal for equal states, or nil if
+  there is none. The model checker doesn't explore on from a state it has
+  already explored at the same depth or shallower."))
+
+(defprotocol IIndependent
+  (last-step [this] "What running the last action did, as much as
+  independent? needs to know, or nil if that isn't known.")
+  (independent? [this a step-a b step-b] "Do actions a and b commute, given
+  that running each of them from the same state did step-a and step-b?"))
+
+(defprotocol ISymmetric
+  (canonical-action [this action] "action renamed the way this state was
+  renamed to get its fingerprint, for states whose fingerprint is the same
+  as that of the states that only differ from them by a renaming."))
+
+(defn- state-fingerprint [state]
+  (when (satisfies? IFingerprinted state)
+    (fingerprint state)))
+
+(defn- seen?
+  "Has a state with fingerprint fp been explored at depth or shallower,
+  with no actions asleep then that aren't asleep now?"
+  [visited fp depth asleep]
+  (when-let [[seen-depth seen-asleep] (and (some? fp) (get visited fp))]
+    (and (<= seen-depth depth)
+         (every? #(contains? asleep %) seen-asleep))))
+
+(defn- sleep-set
+  "The actions asleep in state, which running action from its parent led
+  to: those asleep in the parent or explored from it before action that
+  are independent of action. A map from each action to its step."
+  [state {:keys [sleep done]} action]
+  (let [step (when (satisfies? IIndependent state) (last-step state))]
+    (if (some? step)
+      (into {} (filter (fn [[a a-step]]
+                         (and (some? a-step) (independent? state a a-step action step)))
+                       (concat sleep done)))
+      {})))
+
 (defn prefix? [a b]
   (if (<= (count a) (count b))
     (= a (take (count a) b))
     false))
 
-(defn new-actions [pred state current]
-  (vec (map #(conj current %) (actions state pred))))
+(defn new-actions
+  ([pred state current] (new-actions pred state current {}))
+  ([pred state current asleep]
+   (vec (map #(conj current %) (remove #(contains? asleep %) (actions state pred))))))
+
+(defn- remember-parent
+  "Keep state around (if we can backtrack to it) until its n-children
+  actions have been explored."
+  [parents trace state n-children]
+  (if (and (pos? n-children)
+           (satisfies? IRestorable state)
+           (restorable? state))
+    (assoc parents trace {:state state :pending n-children})
+    parents))
+
+(defn- forget-child [parents trace]
+  (let [parent (pop trace)]
+    (if-let [{:keys [pending]} (get parents parent)]
+      (if (<= pending 1)
+        (dissoc parents parent)
+        (update-in parents [parent :pending] dec))
+      parents)))
 
 (defn dfs
+  "Search for a state matching pred, depth-first down to a depth bound that
+  grows by delta-depth up to max-depth.
+
+  States that are IIndependent get partial-order reduction with sleep
+  sets: once some of the actions from a state have been explored, those
+  independent of the next action are asleep in the state it leads to, and
+  aren't explored from there, since running them first led to the same
+  states."
   ([state pred max-depth] (dfs state pred max-depth 3))
   ([state pred max-depth delta-depth]
-   (loop [state (restart! state)
-          depth delta-depth
-          worklist (new-actions pred state [])
-          next-worklist ()
-          current []
-          n-explored 0]
-     (when (= (mod n-explored 100) 0)
-       (prn n-explored))
-     (cond
-       (and (empty? worklist)
-            (or (empty? next-worklist)
-                (> (+ depth delta-depth) max-depth)))
-       {:result :not-found}
-       
-       (empty? worklist)
-       (do
-         (prn "Incrementing depth")
-         (recur state (+ depth delta-depth) next-worklist () current (inc n-explored)))
-
-       :else
-       (let [next (first worklist)]
-         (if (prefix? current next)
-           (let [state (reduce run-action! state (drop (count current) next))]
-             (if (matches? state pred)
-               {:result :found :trace next :state state}
-               (let [acs (new-actions pred state next)]
-                 (if (< (count next) depth)
-                   (recur state
-                          depth
-                          (concat acs (vec (rest worklist)))
-                          next-worklist
-                          next
-                          (inc n-explored))
-                   (recur state
-                          depth
-                          (vec (rest worklist))
-                          (vec (concat next-worklist acs))
-                          next
-                          (inc n-explored))))))
-           (recur (restart! state) depth worklist next-worklist [] (inc n-explored))))))))
+   (let [state (restart! state)
+         worklist (new-actions pred state [])]
+     (loop [state state
+            depth delta-depth
+            worklist worklist
+            next-worklist ()
+            current []
+            parents (remember-parent {} [] state (count worklist))
+            visited {}
+            ;; For each explored trace, the actions asleep in the state it
+            ;; led to and those explored from it so far, with their steps
+            expansions {[] {:sleep {} :done []}}
+            n-explored 0]
+       (when (= (mod n-explored 100) 0)
+         (prn n-explored))
+       (cond
+         (and (empty? worklist)
+              (or (empty? next-worklist)
+                  (> (+ depth delta-depth) max-depth)))
+         {:result :not-found}
+
+         (empty? worklist)
+         (do
+           (prn "Incrementing depth")
+           (recur state (+ depth delta-depth) next-worklist () current parents visited expansions
+                  (inc n-explored)))
+
+         :else
+         (let [next (first worklist)]
+           (if (prefix? current next)
+             (let [state (reduce run-action! state (drop (count current) next))
+                   parents (forget-child parents next)
+                   por? (satisfies? IIndependent state)
+                   sleep (if por?
+                           (sleep-set state (get expansions (pop next)) (peek next))
+                           {})
+                   expansions (if por?
+                                (update-in expansions [(pop next) :done] (fnil conj [])
+                                           [(peek next) (last-step state)])
+                                expansions)
+                   fp (state-fingerprint state)
+                   asleep (set (keys sleep))
+                   ;; Remembered along with fp, so renamed the way fp was
+                   seen-asleep (if (satisfies? ISymmetric state)
+                                 (set (map #(canonical-action state %) asleep))
+                                 asleep)]
+               (cond
+                 (matches? state pred)
+                 {:result :found :trace next :state state}
+
+                 (seen? visited fp (count next) seen-asleep)
+                 (recur state depth (vec (rest worklist)) next-worklist next parents visited expansions
+                        (inc n-explored))
+
+                 :else
+                 (let [acs (new-actions pred state next asleep)
+                       parents (remember-parent parents next state (count acs))
+                       visited (if (some? fp) (assoc visited fp [(count next) seen-asleep]) visited)
+                       expansions (if (and por? (seq acs))
+                                    (assoc expansions next {:sleep sleep :done []})
+                                    expansions)]
+                   (if (< (count next) depth)
+                     (recur state
+                            depth
+                            (concat acs (vec (rest worklist)))
+                            next-worklist
+                            next
+                            parents
+                            visited
+                            expansions
+                            (inc n-explored))
+                     (recur state
+                            depth
+                            (vec (rest worklist))
+                            (vec (concat next-worklist acs))
+                            next
+                            parents
+                            visited
+                            expansions
+                            (inc n-explored))))))
+             (if-let [{parent :state} (get parents (pop next))]
+               (recur parent depth worklist next-worklist (pop next) parents visited expansions n-explored)
+               (recur (restart! state) depth worklist next-worklist [] parents visited expansions
+                      (inc n-explored))))))))))
+
+(defn- run-from
+  "Run action in the state trace led to."
+  [state trace action]
+  (if (and (satisfies? IRestorable state) (restorable? state))
+    (run-action! state action)
+    (run-action! (reduce run-action! (restart! state) trace) action)))
+
+(defn split-frontier
+  "Explore breadth-first until there are at least n traces to search on
+  from, so the search can be split n ways. Returns {:frontier traces}, or
+  the result if a state on the way matches pred."
+  [state pred n max-depth]
+  (loop [level [[[] (restart! state)]]
+         depth 0]
+    (if (or (>= (count level) n) (>= depth max-depth) (empty? level))
+      {:frontier (mapv first level)}
+      (let [next-level (reduce (fn [acc [trace state action]]
+                                 (let [child (run-from state trace action)
+                                       trace (conj trace action)]
+                                   (if (matches? child pred)
+                                     (reduced {:result :found :trace trace :state child})
+                                     (conj acc [trace child]))))
+                               []
+                               (for [[trace state] level
+                                     action (actions state pred)]
+                                 [trace state action]))]
+        (if (map? next-level)
+          next-level
+          (recur next-level (inc depth)))))))
+
+(defn dfs-frontier
+  "Search from each of traces in turn, where (make-state trace) is a state
+  that restarts at the end of trace, until one of them finds a match. The
+  trace found includes the frontier trace."
+  [make-state traces pred max-depth delta-depth]
+  (or (some (fn [trace]
+              (let [res (dfs (make-state trace) pred (- max-depth (count trace)) delta-depth)]
+                (when (= (:result res) :found)
+                  (update res :trace #(into trace %)))))
+            traces)
+      {:result :not-found}))
@@ -0,0 +1,72 @@
+(ns oddity.codec-test
+  (:require [clojure.test :refer :all]
+            [oddity.codec :as codec]))
+
+(def message
+  {"state-updates" [{"path" ["log"] "value" [{"term" 1 "command" "x"}]}
+                    {"path" ["commit_index"] "value" 4294967296}]
+   "send-messages" [{"from" "1" "to" "2" "type" "AppendEntries"
+                     "body" {"ok" true "missing" nil "ratio" 0.5
+                             "text" (apply str (repeat 100 "y"))}}]
+   "set-timeouts" []})
+
+(deftest binary-round-trip-test
+  (let [out (codec/connection-codec)
+        in (codec/connection-codec)]
+    (swap! out assoc :encode ((get codec/codecs "binary")))
+    (swap! in assoc :decode ((get codec/codecs "binary")))
+    ;; The second copy is sent with the strings interned by the first
+    (dotimes [_ 2]
+      (is (= message (codec/decode in (codec/encode out message)))))))
+
+(deftest switch-codec-test
+  (let [c (codec/connection-codec)
+        reply (codec/switch-codec c "binary" {:ok true :codec "binary"})]
+    (is (= "binary" (:name (:decode @c))))
+    (is (= "json" (:name (:encode @c))))
+    (codec/encode c reply)
+    (is (= "binary" (:name (:encode @c))))))
+
+(deftest choose-codec-test
+  (is (= "binary" (codec/choose-codec ["msgpack" "binary" "json"])))
+  (is (nil? (codec/choose-codec nil))))
+
+(deftest body-cache-test
+  (let [cache (codec/body-cache)
+        body {"entries" [{"term" 1 "command" "x"}]}
+        sent {"from" "1" "to" "2" "type" "AppendEntries" "body-ref" "ab"}
+        ;; Sent twice: defined by the first response, referred to by both
+        frame {"responses" [{"send-messages" [sent]} {"send-messages" [sent]}]
+               "bodies" {"ab" body}}
+        resolved (codec/resolve-bodies cache frame)
+        delivery (assoc (get-in resolved ["responses" 0 "send-messages" 0]) "msgtype" "msg")]
+    (is (= body (get-in resolved ["responses" 1 "send-messages" 0 "body"])))
+    (is (not (contains? resolved "bodies")))
+    (is (= {"msgtype" "msg" "from" "1" "to" "2" "type" "AppendEntries" "body-ref" "ab"}
+           (codec/refer-bodies cache delivery)))
+    (is (= body (get-in (codec/resolve-bodies cache {"send-messages" [sent]})
+                        ["send-messages" 0 "body"])))))
+
+(deftest body-cache-redelivery-test
+  (let [cache (codec/body-cache)
+        body {"entries" [{"term" 1 "command" "x"}]}
+        sent {"from" "1" "to" "2" "type" "AppendEntries" "body-ref" "ab"}
+        delivery (-> sent (dissoc "body-ref") (assoc "body" body "msgtype" "msg"))
+        referred (-> delivery (dissoc "body") (assoc "body-ref" "ab"))]
+    (codec/resolve-bodies cache {"send-messages" [sent] "bodies" {"ab" body}})
+    ;; Sent once, delivered from two states restored one after the other:
+    ;; both deliveries go by reference, and neither drops the body
+    (is (= referred (codec/refer-bodies cache delivery)))
+    (codec/resolve-bodies cache {"ok" true "state-id" 1})
+    (is (= {:msgtype "batch" :events [referred]}
+           (codec/refer-bodies cache {:msgtype "batch" :events [delivery]})))
+    (is (not (contains? (codec/refer-bodies cache delivery) "released")))
+    ;; Until the shim releases it
+    (codec/resolve-bodies cache {"send-messages" [] "released" ["ab"]})
+    (is (= delivery (codec/refer-bodies cache delivery)))
+    (is (thrown? IllegalStateException
+                 (codec/resolve-bodies cache {"send-messages" [sent]})))
+    ;; A response can release a body and define it again
+    (codec/resolve-bodies cache {"send-messages" [sent] "released" ["ab"]
+                                 "bodies" {"ab" body}})
+    (is (= referred (codec/refer-bodies cache delivery)))))
@@ -123,3 +123,178 @@
       (is (= (:result mc-res) :found)))
     (let [mc-res (dfs state (pred "node1" "timeouts" 3) 1 1)]
       (is (= (:result mc-res) :not-found)))))
+
+(defn make-restorable-test-system [versions restarts]
+  (let [record! (fn [st]
+                  (let [id (count @versions)]
+                    (swap! versions assoc id st)
+                    id))
+        start-response (fn [node id]
+                         (assoc (response [{:type "timeout" :body {} :to node}]
+                                          (if (= node "node1")
+                                            [{:to "node2" :type "ping" :body {} :from "node1"}]
+                                            [])
+                                          [{:path ["timeouts"] :value 0}
+                                           {:path ["pings"] :value 0}])
+                                :state-id id))]
+    (reify ISystemControl
+      (send-message! [this message]
+        (if-let [st (get @versions (:state-id message))]
+          (let [node (:to message)
+                field (if (= (:msgtype message) "timeout") :timeouts :pings)
+                st (update-in st [node field] inc)
+                value (get-in st [node field])]
+            (assoc (response []
+                             (if (= field :pings)
+                               [{:msgtype "msg" :to (if (= node "node1") "node2" "node1")
+                                 :from node :type "ping" :body {}}]
+                               [])
+                             [{:path [(name field)] :value value}])
+                   :state-id (record! st)))
+          {:ok false}))
+      (restart-system! [this]
+        (swap! restarts inc)
+        (let [id (record! {"node1" {:timeouts 0 :pings 0} "node2" {:timeouts 0 :pings 0}})]
+          {:responses [["node1" (start-response "node1" id)]
+                       ["node2" (start-response "node2" id)]]}))
+      (restore-system! [this state-id]
+        (contains? @versions state-id)))))
+
+(deftest restorable-dsstate
+  (let [versions (atom {})
+        restarts (atom 0)
+        sys (make-restorable-test-system versions restarts)
+        state (make-dsstate sys [])
+        pred (fn [node field value] {:type :node-state :node node :path [field] :value value})]
+    (is (restorable? state))
+    (let [mc-res (dfs state (pred "node1" "timeouts" 3) 3 3)]
+      (is (= (:result mc-res) :found))
+      (is (= @restarts 1)))
+    (testing "falls back to replaying when the system forgot a state"
+      (let [state (run-action! state (first (actions state (pred "node1" "timeouts" 0))))]
+        (reset! versions {})
+        (let [state (run-action! state {:deliver-timeout {:msgtype "timeout" :to "node1"
+                                                          :type "timeout" :body {}}})]
+          (is (= @restarts 2))
+          (is (matches? state (pred "node2" "pings" 1)))
+          (is (matches? state (pred "node1" "timeouts" 1))))))))
+
+(defn make-batching-test-system [batches]
+  (let [sys (make-test-system)]
+    (reify
+      ISystemControl
+      (send-message! [this message] (send-message! sys message))
+      (restart-system! [this] (restart-system! sys))
+      IBatchControl
+      (send-batch! [this messages]
+        (swap! batches inc)
+        {:responses (mapv #(send-message! sys %) messages)}))))
+
+(deftest batched-prefix-dsstate
+  (let [batches (atom 0)
+        sys (make-batching-test-system batches)
+        state (make-dsstate sys [{:msgtype "msg" :to "node2" :from "node1"
+                                  :type "ping" :body {}}
+                                 {:msgtype "timeout" :to "node1" :type "timeout" :body {}}])
+        pred (fn [node field value] {:type :node-state :node node :path [field] :value value})]
+    (is (= @batches 1))
+    (is (matches? state (pred "node1" "timeouts" 1)))
+    (is (matches? state (pred "node2" "pings" 1)))
+    (is (= (count (actions state (pred "node1" "timeouts" 0))) 3))))
+
+(deftest apply-state-update-test
+  (let [state {"log" [{"term" 1} {"term" 1} {"term" 2}]
+               "match_index" {"S1" 2 "S2" 1}}]
+    (is (= (get (apply-state-update state {:path ["log"] :op "append" :values [{"term" 3}]})
+                "log")
+           [{"term" 1} {"term" 1} {"term" 2} {"term" 3}]))
+    (is (= (get (apply-state-update state {:path ["log"] :op "truncate-extend" :index 1
+                                           :values [{"term" 4}]})
+                "log")
+           [{"term" 1} {"term" 4}]))
+    (is (= (get (apply-state-update state {:path ["match_index"] :op "merge"
+                                           :value {"S2" 2 "S3" 0}})
+                "match_index")
+           {"S1" 2 "S2" 2 "S3" 0}))
+    (is (= (apply-state-update state {:path ["match_index"] :op "delete"})
+           {"log" [{"term" 1} {"term" 1} {"term" 2}]}))
+    (is (= (get (apply-state-update {} {:path ["votes"] :op "append" :values ["S1"]}) "votes")
+           ["S1"]))
+    (is (= (apply-state-update state {:path ["term"] :value 3 :op nil})
+           (assoc state "term" 3)))))
+
+(deftest independent-steps?-test
+  (let [ping {:msgtype "msg" :to "A" :from "B" :type "ping" :body {}}
+        tick {:msgtype "timeout" :to "A" :type "tick" :body {}}
+        step (fn [reads writes] {:footprint {:reads reads :writes writes}})]
+    (testing "events for different nodes"
+      (is (independent-steps? ping {} (assoc tick :to "B") {})))
+    (testing "footprints that don't overlap"
+      (is (independent-steps? ping (step [["pings"]] [["pings"]])
+                              tick (step [["ticks"]] [["ticks"]]))))
+    (testing "one writes part of what the other reads"
+      (is (not (independent-steps? ping (step [] [["log" 0]])
+                                   tick (step [["log"]] [])))))
+    (testing "no footprint"
+      (is (not (independent-steps? ping {} tick (step [] [])))))
+    (testing "one clears the other"
+      (is (not (independent-steps? ping (assoc (step [] []) :cleared-timeouts [tick])
+                                   tick (step [] [])))))))
+
+(deftest renamings-test
+  (is (= (renamings [["A" "B"] ["C" "D" "E"]])
+         (for [ab [{"A" "A" "B" "B"} {"A" "B" "B" "A"}]
+               cde [{"C" "C" "D" "D" "E" "E"} {"C" "C" "D" "E" "E" "D"}
+                    {"C" "D" "D" "C" "E" "E"} {"C" "D" "D" "E" "E" "C"}
+                    {"C" "E" "D" "C" "E" "D"} {"C" "E" "D" "D" "E" "C"}]]
+           (merge ab cde)))))
+
+(deftest canonical-fingerprint-test
+  (let [addresses ["votes" "voted_for" "leader" "match_index"]
+        state (fn [leader follower]
+                {:states {leader {"state" "Leader" "votes" [leader follower]
+                                  "match_index" {leader 3 follower 1}}
+                          follower {"state" "Follower" "voted_for" leader}
+                          "C" {"leader" leader "command" "A"}}
+                 :messages [{:from leader :to follower :type "AppendEntries" :body {}}]
+                 :timeouts [{:to follower :type "Election" :body {}}]})
+        fingerprint (fn [{:keys [states messages timeouts]}]
+                      [states (frequencies messages) (frequencies timeouts)])
+        [fp-ab renaming-ab] (canonical-fingerprint (state "A" "B") [["A" "B"]] addresses)
+        [fp-ba renaming-ba] (canonical-fingerprint (state "B" "A") [["A" "B"]] addresses)]
+    (is (= fp-ab fp-ba))
+    ;; The leader sorts first by signature, so is renamed "A", as symmetry.py
+    ;; renames it; "command" isn't an address, so its "A" is left alone
+    (is (= {"A" "A" "B" "B"} renaming-ab))
+    (is (= {"A" "B" "B" "A"} renaming-ba))
+    (is (= fp-ab (fingerprint (state "A" "B"))))
+    ;; However the groups list their nodes
+    (is (= fp-ab (first (canonical-fingerprint (state "A" "B") [["B" "A"]] addresses))))
+    (is (not= fp-ab (first (canonical-fingerprint
+                            (assoc-in (state "A" "B") [:states "C" "leader"] "B")
+                            [["A" "B"]] addresses))))
+    ;; Without groups a state is only the same as itself
+    (is (= (canonical-fingerprint (state "A" "B") [] addresses)
+           [(fingerprint (state "A" "B")) {}]))))
+
+(deftest canonical-fingerprint-ties-test
+  (let [state (fn [a b]
+                {:states {a {"term" 1 "voted_for" b} b {"term" 1 "voted_for" a}}
+                 :messages [{:from a :to b :type "RequestVote" :body {"value" "A"}}]
+                 :timeouts []})
+        [fp-ab renaming-ab] (canonical-fingerprint (state "A" "B") [["A" "B"]] ["voted_for"])
+        [fp-ba renaming-ba] (canonical-fingerprint (state "B" "A") [["A" "B"]] ["voted_for"])]
+    (testing "nodes that tie by state are told apart by their messages"
+      (is (= fp-ab fp-ba))
+      (is (= {"A" "A" "B" "B"} renaming-ab))
+      (is (= {"A" "B" "B" "A"} renaming-ba)))
+    (testing "only addresses are renamed"
+      (is (= [{"A" {"term" 1 "voted_for" "B"} "B" {"term" 1 "voted_for" "A"}}
+              {{:from "A" :to "B" :type "RequestVote" :body {"value" "A"}} 1}
+              {}]
+             fp-ba)))
+    (testing "nodes that tie every way keep their names"
+      (is (= {"A" "A" "B" "B"}
+             (second (canonical-fingerprint {:states {"A" {"term" 1} "B" {"term" 1}}
+                                             :messages [] :timeouts []}
+                                            [["A" "B"]] ["voted_for"])))))))
@@ -17,3 +17,107 @@
   (let [res (mc/dfs (->CoolNumberProblem 0 0) (fn [x y] (and (>= x 3) (<= x y))) 6)]
     (is (= (:result res) :found))
     (is (= (:trace res) [:inc-x :inc-x :inc-x :inc-y :inc-y :inc-y]))))
+
+(defrecord RestorableNumberProblem [x y restarts]
+  mc/IState
+  (restart! [this]
+    (swap! restarts inc)
+    (->RestorableNumberProblem 0 0 restarts))
+  (actions [this pred] [:inc-x :inc-y])
+  (run-action! [this action]
+    (if (= action :inc-x)
+      (->RestorableNumberProblem (inc x) y restarts)
+      (->RestorableNumberProblem x (inc y) restarts)))
+  (matches? [this pred] (pred x y))
+  mc/IRestorable
+  (restorable? [this] true))
+
+(deftest dfs-restorable-test
+  (let [restarts (atom 0)
+        res (mc/dfs (->RestorableNumberProblem 0 0 restarts)
+                    (fn [x y] (and (>= x 3) (<= x y))) 6)]
+    (is (= (:result res) :found))
+    (is (= (:trace res) [:inc-x :inc-x :inc-x :inc-y :inc-y :inc-y]))
+    (is (= @restarts 1))))
+
+(defrecord FingerprintedNumberProblem [x y runs]
+  mc/IState
+  (restart! [this] (->FingerprintedNumberProblem 0 0 runs))
+  (actions [this pred] [:inc-x :inc-y])
+  (run-action! [this action]
+    (swap! runs inc)
+    (if (= action :inc-x)
+      (->FingerprintedNumberProblem (inc x) y runs)
+      (->FingerprintedNumberProblem x (inc y) runs)))
+  (matches? [this pred] (pred x y))
+  mc/IRestorable
+  (restorable? [this] true)
+  mc/IFingerprinted
+  (fingerprint [this] [x y]))
+
+(deftest dfs-fingerprinted-test
+  (let [runs (atom 0)
+        res (mc/dfs (->FingerprintedNumberProblem 0 0 runs)
+                    (fn [x y] (and (>= x 3) (<= x y))) 6)]
+    (is (= (:result res) :found))
+    (is (= (:trace res) [:inc-x :inc-x :inc-x :inc-y :inc-y :inc-y])))
+  (let [runs (atom 0)
+        res (mc/dfs (->FingerprintedNumberProblem 0 0 runs) (fn [x y] false) 6)]
+    (is (= (:result res) :not-found))
+    ;; Without fingerprints each of the 126 traces would be run
+    (is (< @runs 126))))
+
+(defrecord OffsetNumberProblem [x0 y0 x y]
+  mc/IState
+  (restart! [this] (->OffsetNumberProblem x0 y0 x0 y0))
+  (actions [this pred] [:inc-x :inc-y])
+  (run-action! [this action]
+    (if (= action :inc-x)
+      (->OffsetNumberProblem x0 y0 (inc x) y)
+      (->OffsetNumberProblem x0 y0 x (inc y))))
+  (matches? [this pred] (pred x y)))
+
+(defn- offset-problem-after [trace]
+  (->OffsetNumberProblem (count (filter #{:inc-x} trace))
+                         (count (filter #{:inc-y} trace))
+                         0 0))
+
+(deftest split-frontier-test
+  (let [pred (fn [x y] (and (>= x 3) (<= x y)))
+        res (mc/split-frontier (->CoolNumberProblem 0 0) pred 3 6)]
+    (is (= (:frontier res) [[:inc-x :inc-x] [:inc-x :inc-y] [:inc-y :inc-x] [:inc-y :inc-y]]))
+    (is (= (mc/split-frontier (->CoolNumberProblem 0 0) (fn [x y] (= x 1)) 3 6)
+           {:result :found :trace [:inc-x] :state (->CoolNumberProblem 1 0)}))
+    (let [found (mc/dfs-frontier offset-problem-after (rest (:frontier res)) pred 6 2)]
+      (is (= (:result found) :found))
+      (is (= (take 2 (:trace found)) [:inc-x :inc-y]))
+      (is (pred (count (filter #{:inc-x} (:trace found)))
+                (count (filter #{:inc-y} (:trace found))))))))
+
+(defrecord CommutingNumberProblem [x y runs]
+  mc/IState
+  (restart! [this] (->CommutingNumberProblem 0 0 runs))
+  (actions [this pred] [:inc-x :inc-y])
+  (run-action! [this action]
+    (swap! runs inc)
+    (if (= action :inc-x)
+      (->CommutingNumberProblem (inc x) y runs)
+      (->CommutingNumberProblem x (inc y) runs)))
+  (matches? [this pred] (pred x y))
+  mc/IRestorable
+  (restorable? [this] true)
+  mc/IIndependent
+  (last-step [this] :inc)
+  (independent? [this a step-a b step-b] (not= a b)))
+
+(deftest dfs-sleep-set-test
+  (let [runs (atom 0)
+        res (mc/dfs (->CommutingNumberProblem 0 0 runs)
+                    (fn [x y] (and (>= x 3) (<= x y))) 6)]
+    (is (= (:result res) :found))
+    (is (= (:trace res) [:inc-x :inc-x :inc-x :inc-y :inc-y :inc-y])))
+  (let [runs (atom 0)
+        res (mc/dfs (->CommutingNumberProblem 0 0 runs) (fn [x y] false) 6)]
+    (is (= (:result res) :not-found))
+    ;; Only the traces with every :inc-x before every :inc-y are run
+    (is (= @runs 27))))